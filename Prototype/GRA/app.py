@@ -1,91 +1,61 @@
 from pathlib import Path
-from openai import OpenAI
-import requests, json, threading
-from fastapi import FastAPI, Request  # type: ignore
+import os, time, asyncio
+from fastapi import BackgroundTasks, FastAPI, Request  # type: ignore
+from common import http_client, locks, memory, metrics, llm, reply_stream, context, governor, resilience
 
 # === Configuration ===
 MMA_URL = "http://mma:8000/patient_goals"
 OA_URL = "http://oa:8000/receive_message"
 SCA_URL = "http://oa:8000/trigger_agent"
 
-MEMORY_FILE = Path("/app/memory/gra_conversations.json")
+MEMORY_PATH = Path("/app/memory/gra_conversations")  # see common/memory.py
+LEGACY_MEMORY_FILE = Path("/app/memory/gra_conversations.json")  # migrated on startup
 
 MODEL_NAME = "gpt-4.1"
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "1500"))  # per reply, see common/context.py
+
+OPENING_CACHE_TTL = 3600  # seconds a pre-generated opening stays usable
+
+# Sent instead of the generated reply when it fails on turn 12, which closes the review without a question
+CLOSING_FALLBACK_REPLY = "Thank you for reflecting on your goal with me today. The effort you are putting in really shows, so keep it up!"
 
 
 # === Initialization ===
 app = FastAPI()
-client = OpenAI()
+app.add_middleware(resilience.DeadlineMiddleware)  # applies the caller's X-Deadline-Ms to each request
+conversations = memory.open_store(MEMORY_PATH)
+conversations.migrate_from_json(LEGACY_MEMORY_FILE)
+patient_locks = locks.KeyedLock("patient")  # one turn or session start at a time per patient
 
 
 # === GPT Wrapper ===
-def ask_gpt(messages):
-    response = client.chat.completions.create(
-        model=MODEL_NAME,
-        messages=messages,
-        temperature=0.7
-    )
-    return response.choices[0].message.content
-
-
-# === Memory Handlers ===
-def load_memory():
-    if not MEMORY_FILE.exists():
-        return []
-    with open(MEMORY_FILE) as f:
-        try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            print("Warning: Memory file is not valid JSON. Starting fresh.", flush=True)
-            return []
-
-def save_message(new_record):
-    MEMORY_FILE.parent.mkdir(parents=True, exist_ok=True)
-    records = load_memory()
-
-    updated = False
-    for existing in records:
-        if existing.get("patient_id") == new_record.get("patient_id"):
-            if "chat_history" in new_record:
-                existing["chat_history"] = new_record["chat_history"]
-            if "selected_goal" in new_record:
-                existing["selected_goal"] = new_record["selected_goal"]
-            updated = True
-            break
-
-    if not updated:
-        records.append(new_record)
-
-    with open(MEMORY_FILE, "w") as f:
-        json.dump(records, f, indent=2)
-
-
-# === API Endpoints ===
-@app.post("/trigger")
-async def trigger(request: Request):
-    data = await request.json()
-    patient_id = data.get("patient_id")
-    turn_index = data.get("turn_index")
+async def ask_gpt(messages):
+    return await llm.ask(messages, model=MODEL_NAME, temperature=0.7, priority="handoff")
 
-    if not patient_id:
-        return {"status": "error", "reason": "Missing patient_id"}
 
-    print(f"GRA was triggered to do weekly SMART goal review for patient {patient_id}", flush=True)
+# === Opening Generation ===
+async def fetch_goals(patient_id, context=None):
+    """Returns `(preferred_name, smart_goals)` from the context OA prefetched, or from MMA without one."""
+    if context:
+        metrics.increment("patient context prefetched")
+        return context.get("preferred_name"), context.get("latest_goals", [])
 
+    metrics.increment("patient context fetched from MMA")
     try:
-        response = requests.get(f"{MMA_URL}/{patient_id}")
-        if response.status_code == 200:
-            response_data = response.json()
-            print(f"Retrieved {response_data} from MMA for patient {patient_id}", flush=True)
-        else:
-            print(f"Failed to fetch SMART goals from MMA: {response.status_code}", flush=True)
-            return {"status": "failed", "reason": "MMA fetch error"}
+        response = await http_client.aget(f"{MMA_URL}/{patient_id}")
     except Exception as e:
         print(f"Error contacting MMA: {e}", flush=True)
-        return {"status": "failed", "reason": str(e)}
-
-    preferred_name = response_data.get("preferred_name")
-    smart_goals = response_data.get("smart_goals", [])
+        raise
+    if response.status_code != 200:
+        print(f"Failed to fetch SMART goals from MMA: {response.status_code}", flush=True)
+        raise RuntimeError("MMA fetch error")
+    response_data = response.json()
+    print(f"Retrieved {response_data} from MMA for patient {patient_id}", flush=True)
+    return response_data.get("preferred_name"), response_data.get("smart_goals", [])
+
+async def generate_opening(patient_id, turn_index, context=None):
+    """Builds the first GRA message from the patient's MMA goals. Returns `(assistant_reply, smart_goals)`."""
+    preferred_name, smart_goals = await fetch_goals(patient_id, context)
 
     system_prompt = "You are a warm, empathetic health coach helping a patient review their SMART goals."
 
@@ -108,19 +78,89 @@ async def trigger(request: Request):
     ]
 
     # GPT generation placeholder
-    assistant_reply = ask_gpt(initial_prompt)
+    assistant_reply = await ask_gpt(initial_prompt)
     #assistant_reply = "Let's review your goals from the last session."
+    return assistant_reply, smart_goals
+
+
+# === Opening Cache ===
+# patient_id -> {"session_id", "turn_index", "created", "task"}; the task resolves to generate_opening's result
+opening_cache = {}
+
+async def take_cached_opening(patient_id, session_id, turn_index):
+    """Returns the pre-generated opening for this session, or None if it is missing, stale or failed."""
+    entry = opening_cache.pop(patient_id, None)
+    if not entry:
+        return None
+    if (not session_id or entry["session_id"] != session_id or entry["turn_index"] != turn_index
+            or time.monotonic() - entry["created"] > OPENING_CACHE_TTL):
+        entry["task"].cancel()  # a discarded generation must not keep running and hold an LLM slot
+        return None
+    try:
+        # Waits for the generation if the handoff arrives while it is still running
+        return await entry["task"]
+    except Exception as e:
+        print(f"Pre-generated opening for patient {patient_id} failed: {e}", flush=True)
+        return None
+
+
+# === API Endpoints ===
+@app.post("/pregenerate")
+async def pregenerate(request: Request):
+    data = await request.json()
+    patient_id = data.get("patient_id")
+    session_id = data.get("session_id")
+    turn_index = data.get("turn_index")
+
+    if not patient_id or not session_id or not turn_index:
+        return {"status": "error", "reason": "Missing patient_id, session_id or turn_index"}
+
+    previous = opening_cache.get(patient_id)
+    if previous:
+        previous["task"].cancel()
+
+    opening_cache[patient_id] = {
+        "session_id": session_id,
+        "turn_index": turn_index,
+        "created": time.monotonic(),
+        "task": asyncio.create_task(generate_opening(patient_id, turn_index, data.get("patient_context")))
+    }
+    print(f"GRA started pre-generating the opening for patient {patient_id}", flush=True)
+    return {"status": "pregenerating", "patient_id": patient_id}
+
+@app.post("/trigger")
+async def trigger(request: Request, background_tasks: BackgroundTasks):
+    data = await request.json()
+    patient_id = data.get("patient_id")
+    turn_index = data.get("turn_index")
+
+    if not patient_id:
+        return {"status": "error", "reason": "Missing patient_id"}
+
+    print(f"GRA was triggered to do weekly SMART goal review for patient {patient_id}", flush=True)
+
+    opening = await take_cached_opening(patient_id, data.get("session_id"), turn_index)
+    if opening:
+        metrics.increment("opening cache hits")
+    else:
+        metrics.increment("opening cache misses")
+        try:
+            opening = await generate_opening(patient_id, turn_index, data.get("patient_context"))
+        except Exception as e:
+            return {"status": "failed", "reason": str(e)}
+
+    assistant_reply, smart_goals = opening
     chat_history = [{"role": "assistant", "content": assistant_reply}]
 
-    save_message({
-        "patient_id": patient_id,
-        "chat_history": chat_history,
-        "smart_goals": smart_goals
-    })
+    async with patient_locks.hold(patient_id):
+        await asyncio.to_thread(conversations.update, patient_id, {
+            "chat_history": chat_history,
+            "smart_goals": smart_goals
+        })
 
-    def notify_oa():
+    async def notify_oa():
         try:
-            requests.post(OA_URL, json={
+            await http_client.apost(OA_URL, json={
                 "patient_id": patient_id,
                 "turn_index": turn_index,
                 "message": assistant_reply
@@ -129,12 +169,15 @@ async def trigger(request: Request):
         except Exception as e:
             print(f"Failed to notify OA: {e}", flush=True)
 
-    threading.Thread(target=notify_oa, daemon=True).start()
+    # Sent after the response so OA, which is waiting on this trigger, is free to receive the message
+    background_tasks.add_task(notify_oa)
 
     return {"status": "GRA triggered", "patient_id": patient_id}
 
 @app.post("/receive_message")
 async def receive_message(request: Request):
+    started = time.perf_counter()  # the patient has been waiting since their message arrived
+    resilience.start_deadline(resilience.TURN_BUDGET)
     data = await request.json()
     patient_id = data.get("patient_id")
     user_input = data.get("user_input")
@@ -145,8 +188,12 @@ async def receive_message(request: Request):
 
     print(f"Received '{user_input}' from {patient_id} (turn {turn_index})", flush=True)
 
-    records = load_memory()
-    patient_entry = next((r for r in records if r.get("patient_id") == patient_id), None)
+    async with patient_locks.hold(patient_id):
+        return await take_turn(patient_id, user_input, turn_index, started)
+
+async def take_turn(patient_id, user_input, turn_index, started):
+    """Reads the conversation, replies and saves both; runs under the patient's lock so turns never overwrite each other."""
+    patient_entry = await asyncio.to_thread(conversations.get, patient_id)
     if not patient_entry:
         return {"status": "error", "reason": "Patient session not found"}
 
@@ -156,7 +203,8 @@ async def receive_message(request: Request):
     turn_index += 1
 
     if turn_index == 7:
-        selected_goal = user_input.strip()
+        # Stored cut, as the patient's reply can be of any length and the goal is repeated in every later prompt
+        selected_goal = context.truncate_middle(user_input.strip(), context.PINNED_MAX_TOKENS)
         patient_entry["selected_goal"] = selected_goal
     else:
         selected_goal = patient_entry.get("selected_goal", "your selected goal")
@@ -177,19 +225,25 @@ async def receive_message(request: Request):
 
     assistant_reply = ""
     if turn_index < 13:
-        full_prompt = [
-                {"role": "system", "content": "You are a warm, empathetic health coach helping a patient review their SMART goals."},
-                *chat_history,
-                {"role": "user", "content": assistant_prompt}
-            ]
-        assistant_reply = ask_gpt(full_prompt)       
+        full_prompt = context.build_prompt(
+            "You are a warm, empathetic health coach helping a patient review their SMART goals.",
+            chat_history,
+            assistant_prompt,
+            budget=PROMPT_TOKEN_BUDGET,
+            pinned={"Goal the patient selected for review": patient_entry.get("selected_goal")}
+        )
+        assistant_reply, ttft = await reply_stream.stream_reply(
+            patient_id, turn_index, full_prompt, model=MODEL_NAME, temperature=0.7, started=started,
+            fallback=CLOSING_FALLBACK_REPLY if turn_index == 12 else reply_stream.FALLBACK_REPLY
+        )
         #assistant_reply = assistant_prompt
         chat_history.append({"role": "assistant", "content": assistant_reply})
         try:
-            oa_response = requests.post(OA_URL, json={
+            oa_response = await http_client.apost(OA_URL, json={
                 "patient_id": patient_id,
                 "turn_index": turn_index,
-                "message": assistant_reply
+                "message": assistant_reply,
+                "ttft_ms": round(ttft * 1000)
             })
             if oa_response.status_code == 200:
                 print(f"Sent HC message to OA for patient {patient_id} (turn {turn_index})", flush=True)
@@ -200,7 +254,7 @@ async def receive_message(request: Request):
     elif turn_index == 13:
         agent_to_trigger = "SCA"
         try:
-            oa_response = requests.post(SCA_URL, json={
+            oa_response = await http_client.apost(SCA_URL, json={
                 "patient_id": patient_id,
                 "turn_index": turn_index,
                 "agent_to_trigger": agent_to_trigger
@@ -212,10 +266,13 @@ async def receive_message(request: Request):
         except Exception as e:
             print(f"Error triggering {agent_to_trigger} for patient {patient_id}: {e}", flush=True)
 
-    save_message({
-        "patient_id": patient_id,
+    await asyncio.to_thread(conversations.update, patient_id, {
         "chat_history": chat_history,
         "selected_goal": selected_goal
     })
 
-    return {"status": "message processed", "turn_index": turn_index}
\ No newline at end of file
+    return {"status": "message processed", "turn_index": turn_index}
+
+@app.get("/metrics")
+async def get_metrics():
+    return {**metrics.snapshot(), "llm_cache": llm.cache_stats(), "llm_governor": governor.stats(), "breakers": resilience.breaker_states(), "memory": conversations.stats(), "patient_locks": patient_locks.stats()}
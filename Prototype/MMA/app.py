@@ -1,23 +1,92 @@
-import pandas as pd
 from pathlib import Path
-from openai import OpenAI
-import time, requests, json
+from openai import AsyncOpenAI
+import os, time, json, uuid, asyncio, hashlib, threading
 from datetime import datetime
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from common import http_client, metrics, llm, governor, resilience
+from session_index import SessionIndex
+from note_store import NoteStore, note_hash
 
 # === Configuration ===
 OA_URL = "http://oa:8000/new_sessions"
 
-SESSION_METADATA_FILE = Path("memory/session_metadata_mock.json")
-SESSION_NOTES_FILE = Path("memory/session_notes_mock.json")
+SESSION_METADATA_FILE = Path("memory/session_metadata_mock.json")  # legacy JSON store, migrated on startup
+SESSION_INDEX_DB = Path("memory/session_index.db")
+SESSION_NOTES_FILE = Path("memory/session_notes_mock.json")  # extracted patient profiles
 WEEKLY_GOALS_FILE = Path("memory/weekly_smart_goals_mock.json")
+EXTRACTION_CACHE_FILE = Path("memory/extraction_cache.jsonl")  # one {"key", "result"} line per cached note
+LEGACY_EXTRACTION_CACHE_FILE = Path("memory/extraction_cache.json")  # migrated on startup
+NOTE_STORE_DB = Path("memory/notes.db")  # raw notes, referenced by hash from the files above
 
 MODEL_NAME = "gpt-4.1" 
 
+# LLM quota shared by all extraction calls (see TokenBucketLimiter)
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("MMA_REQUESTS_PER_MINUTE", "500"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("MMA_TOKENS_PER_MINUTE", "30000"))
+EXTRACTION_CONCURRENCY = int(os.getenv("MMA_EXTRACTION_CONCURRENCY", "8"))  # notes processed at once
+EXTRACTION_RETRIES = int(os.getenv("MMA_EXTRACTION_RETRIES", "3"))
+RETRY_BACKOFF = 2  # seconds, doubled on every retry
+OUTPUT_TOKENS_ESTIMATE = 300  # reserved per call for the tool arguments
+
+# "separate": one call per extractor; "combined": a single call returning profile and goals together.
+# Can be overridden per batch with POST /extract?mode=...
+EXTRACTION_MODES = ("separate", "combined")
+EXTRACTION_MODE = os.getenv("MMA_EXTRACTION_MODE", "separate")
+
+INDEX_WATCH_INTERVAL = 5  # seconds between mtime checks of the notes and goals files
+GOAL_HISTORY_WINDOW = 4  # past sessions' goals returned by /patient_context
+MAX_CONTEXT_BATCH = 1000  # patient ids per /patient_context request
+JOB_RETENTION = 24 * 3600  # seconds a finished extraction job stays available at GET /jobs/{job_id}
+
+
+PATIENT_INFO_EXTRACTION_PROMPT = (
+    "You are an expert at extracting structured information from health coaching session notes. "
+    "Extract the exact parts of text, don't rephrase the text! "  
+    "This is an NLU task, and not an NLG task! "      
+    "For the preferred name, extract only actual first names or nicknames — do not return generic terms like "
+    "'patient', 'pt', 'he', 'she', or 'client'. If a valid name cannot be found, leave the field empty. "
+    "Hobbies must not include exercise or food-related activities. "
+    "Avoid repeating text across family, friends, or travel fields. "
+    "Include only concrete travel plans or experiences in 'travel' (not desires or dreams). "
+    "If travel is family-related, keep it in 'family' and not 'travel'."
+    "Always return valid JSON output. "
+)
+
+GOAL_EXTRACTION_PROMPT = (
+    "You are an expert assistant that extracts only SMART weekly goals from health coaching session notes. " 
+    "Extract the exact parts of text, don't rephrase the text! "  
+    "This is an NLU task, and not an NLG task! "    
+    "Only include goals that are: Specific, Measurable, Achievable, Relevant, and Time-bound (SMART). "
+    "Do not include vague or broad categories like 'Exercise', 'Medication', or 'Diet' unless they are written as specific SMART goals. "
+    "Ignore 6-month, long-term, or vague intentions. Focus only on short-term, concrete weekly SMART goals that the patient committed to."
+    "Always respond in JSON format."
+)
+
+COMBINED_EXTRACTION_PROMPT = (
+    "You are an expert at extracting structured information and SMART weekly goals from health coaching session notes. "
+    "Extract the exact parts of text, don't rephrase the text! "
+    "This is an NLU task, and not an NLG task! "
+    "For the preferred name, extract only actual first names or nicknames — do not return generic terms like "
+    "'patient', 'pt', 'he', 'she', or 'client'. If a valid name cannot be found, leave the field empty. "
+    "Hobbies must not include exercise or food-related activities. "
+    "Avoid repeating text across family, friends, or travel fields. "
+    "Include only concrete travel plans or experiences in 'travel' (not desires or dreams). "
+    "If travel is family-related, keep it in 'family' and not 'travel'. "
+    "For goals, only include goals that are: Specific, Measurable, Achievable, Relevant, and Time-bound (SMART). "
+    "Do not include vague or broad categories like 'Exercise', 'Medication', or 'Diet' unless they are written as specific SMART goals. "
+    "Ignore 6-month, long-term, or vague intentions. Focus only on short-term, concrete weekly SMART goals that the patient committed to. "
+    "Always return valid JSON output."
+)
+
 
 # === Initialization ===
 app = FastAPI()
-client = OpenAI()
+app.add_middleware(resilience.DeadlineMiddleware)  # applies the caller's X-Deadline-Ms to each request
+llm.client = AsyncOpenAI(max_retries=0)  # retries are handled per note by with_retries
+sessions = SessionIndex(SESSION_INDEX_DB)
+sessions.migrate_from_json(SESSION_METADATA_FILE)
+note_store = NoteStore(NOTE_STORE_DB)
 
 open_tool_schema = [
     {
@@ -61,39 +130,146 @@ goal_tool_schema = [
     }
 ]
 
+combined_tool_schema = [
+    {
+        "type": "function",
+        "function": {
+            "name": "extract_patient_info_and_weekly_smart_goals",
+            "description": (
+                "Extract structured patient info and only the weekly SMART goals from health coaching session notes. "
+                "Ignore long-term or monthly goals."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    **open_tool_schema[0]["function"]["parameters"]["properties"],
+                    **goal_tool_schema[0]["function"]["parameters"]["properties"]
+                },
+                "required": (
+                    open_tool_schema[0]["function"]["parameters"]["required"]
+                    + goal_tool_schema[0]["function"]["parameters"]["required"]
+                )
+            }
+        }
+    }
+]
+
+
+# === Rate Limiting ===
+class TokenBucketLimiter:
+    """Spreads LLM calls over the API quota, in requests per minute and tokens per minute.
+
+    Both buckets refill continuously. Callers reserve an estimate of the tokens a
+    call will use and `settle` the difference once the actual usage is known.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.requests = float(requests_per_minute)
+        self.tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self.updated = now - self.updated, now
+        self.requests = min(self.requests_per_minute, self.requests + elapsed * self.requests_per_minute / 60)
+        self.tokens = min(self.tokens_per_minute, self.tokens + elapsed * self.tokens_per_minute / 60)
+
+    async def acquire(self, tokens: int):
+        tokens = min(tokens, self.tokens_per_minute)
+        # Waiters are served in order: the first one holds the lock until it fits in the buckets
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep(max(
+                    (1 - self.requests) * 60 / self.requests_per_minute,
+                    (tokens - self.tokens) * 60 / self.tokens_per_minute
+                ))
+
+    def settle(self, reserved: int, used: int):
+        self.tokens -= used - reserved
+
+
+limiter = TokenBucketLimiter(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+extraction_slots = asyncio.Semaphore(EXTRACTION_CONCURRENCY)
+
 
 # === GPT Wrappers ===
-def extract_patient_info(note_text: str) -> dict:
-    """Extract structured personal information from health coaching notes."""
-    PATIENT_INFO_EXTRACTION_PROMPT = (
-        "You are an expert at extracting structured information from health coaching session notes. "
-        "Extract the exact parts of text, don't rephrase the text! "  
-        "This is an NLU task, and not an NLG task! "      
-        "For the preferred name, extract only actual first names or nicknames — do not return generic terms like "
-        "'patient', 'pt', 'he', 'she', or 'client'. If a valid name cannot be found, leave the field empty. "
-        "Hobbies must not include exercise or food-related activities. "
-        "Avoid repeating text across family, friends, or travel fields. "
-        "Include only concrete travel plans or experiences in 'travel' (not desires or dreams). "
-        "If travel is family-related, keep it in 'family' and not 'travel'."
-        "Always return valid JSON output. "
+def estimate_tokens(*texts) -> int:
+    return sum(len(t) for t in texts) // 4 + OUTPUT_TOKENS_ESTIMATE
+
+async def call_extraction_tool(system_prompt: str, user_prompt: str, tools: list):
+    """Makes one rate-limited tool call and returns the parsed tool arguments, or None if no tool was called.
+
+    Answers from the LLM gateway's response cache don't use the rate limit.
+    """
+    reserved = estimate_tokens(system_prompt, user_prompt, json.dumps(tools))
+    response = await llm.chat(
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        model=MODEL_NAME,
+        tools=tools,
+        tool_choice="auto",
+        response_format={"type": "json_object"},
+        before_request=lambda: limiter.acquire(reserved),
+        priority="batch"
     )
-    try:
-        response = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": PATIENT_INFO_EXTRACTION_PROMPT},
-                {"role": "user", "content": f"Extract structured info from:\n{note_text}"}
-            ],
-            tools=open_tool_schema,
-            tool_choice="auto",
-            response_format={"type": "json_object"}
-        )
-        if response.choices[0].message.tool_calls:
-            args = response.choices[0].message.tool_calls[0].function.arguments
-            return json.loads(args)
-    except Exception as e:
-        print(f"Error during patient info extraction: {e}", flush=True)
-
+    if not response["cached"] and response["usage"]:
+        limiter.settle(reserved, response["usage"]["total_tokens"])
+    if response["tool_calls"]:
+        return json.loads(response["tool_calls"][0]["arguments"])
+    return None
+
+async def with_retries(label: str, call):
+    for attempt in range(EXTRACTION_RETRIES + 1):
+        try:
+            return await call()
+        except Exception as e:
+            if attempt == EXTRACTION_RETRIES:
+                raise
+            delay = RETRY_BACKOFF * 2 ** attempt
+            print(f"{label} failed ({e}), retrying in {delay}s", flush=True)
+            await asyncio.sleep(delay)
+
+async def extract_patient_info(note_text: str) -> dict:
+    """Extract structured personal information from health coaching notes. Raises if every attempt fails."""
+    result = await with_retries("Patient info extraction", lambda: call_extraction_tool(
+        PATIENT_INFO_EXTRACTION_PROMPT,
+        f"Extract structured info from:\n{note_text}",
+        open_tool_schema
+    ))
+    return result if result is not None else empty_patient_info()
+
+async def extract_weekly_goals(note_text: str) -> dict:
+    """Extract SMART weekly goals from coaching session notes. Raises if every attempt fails."""
+    result = await with_retries("Weekly SMART goal extraction", lambda: call_extraction_tool(
+        GOAL_EXTRACTION_PROMPT,
+        f"Extract weekly SMART goals from the following:\n{note_text}",
+        goal_tool_schema
+    ))
+    return result if result is not None else {"goals": []}
+
+async def extract_patient_info_and_goals(note_text: str):
+    """Extract personal information and SMART weekly goals in one call. Returns `(patient_info, weekly_goals)`; raises if every attempt fails."""
+    result = await with_retries("Combined extraction", lambda: call_extraction_tool(
+        COMBINED_EXTRACTION_PROMPT,
+        f"Extract structured info and weekly SMART goals from:\n{note_text}",
+        combined_tool_schema
+    ))
+    if result is None:
+        return empty_patient_info(), {"goals": []}
+    patient_info = {key: result.get(key, default) for key, default in empty_patient_info().items()}
+    return patient_info, {"goals": result.get("goals", [])}
+
+def empty_patient_info() -> dict:
     return {
         "preferred_name": "",
         "hobbies": [],
@@ -102,71 +278,295 @@ def extract_patient_info(note_text: str) -> dict:
         "travel": []
     }
 
-def extract_weekly_goals(note_text: str) -> dict:
-    """Extract SMART weekly goals from coaching session notes."""
-    GOAL_EXTRACTION_PROMPT = (
-        "You are an expert assistant that extracts only SMART weekly goals from health coaching session notes. " 
-        "Extract the exact parts of text, don't rephrase the text! "  
-        "This is an NLU task, and not an NLG task! "    
-        "Only include goals that are: Specific, Measurable, Achievable, Relevant, and Time-bound (SMART). "
-        "Do not include vague or broad categories like 'Exercise', 'Medication', or 'Diet' unless they are written as specific SMART goals. "
-        "Ignore 6-month, long-term, or vague intentions. Focus only on short-term, concrete weekly SMART goals that the patient committed to."
-        "Always respond in JSON format."
-    )
+
+# === Extraction Cache ===
+# Results are keyed by model, extraction mode, prompt version and note hash, so editing a
+# prompt or a tool schema, or switching models, invalidates the affected entries automatically.
+PROMPT_VERSIONS = {
+    mode: hashlib.sha256(json.dumps(prompts_and_schemas).encode()).hexdigest()[:12]
+    for mode, prompts_and_schemas in {
+        "separate": [PATIENT_INFO_EXTRACTION_PROMPT, GOAL_EXTRACTION_PROMPT, open_tool_schema, goal_tool_schema],
+        "combined": [COMBINED_EXTRACTION_PROMPT, combined_tool_schema]
+    }.items()
+}
+
+def cache_key(note_text: str, mode: str) -> str:
+    return f"{MODEL_NAME}/{mode}-{PROMPT_VERSIONS[mode]}/{note_hash(note_text)}"
+
+def extraction_cost(note_text: str, mode: str):
+    """LLM calls and estimated tokens needed to extract one note in `mode`."""
+    if mode == "combined":
+        return 1, estimate_tokens(COMBINED_EXTRACTION_PROMPT, note_text, json.dumps(combined_tool_schema))
+    return 2, (estimate_tokens(PATIENT_INFO_EXTRACTION_PROMPT, note_text, json.dumps(open_tool_schema))
+               + estimate_tokens(GOAL_EXTRACTION_PROMPT, note_text, json.dumps(goal_tool_schema)))
+
+def load_extraction_cache() -> dict:
+    cache = {}
+    if EXTRACTION_CACHE_FILE.exists():
+        with open(EXTRACTION_CACHE_FILE) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    cache[entry["key"]] = entry["result"]
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    # e.g. the last line, cut short by a crash while appending
+                    print("Warning: skipping an invalid line in EXTRACTION_CACHE_FILE.", flush=True)
+    if LEGACY_EXTRACTION_CACHE_FILE.exists():
+        try:
+            with open(LEGACY_EXTRACTION_CACHE_FILE) as f:
+                legacy = {key: result for key, result in json.load(f).items() if key not in cache}
+            append_extraction_cache(legacy)
+            cache.update(legacy)
+            LEGACY_EXTRACTION_CACHE_FILE.rename(LEGACY_EXTRACTION_CACHE_FILE.with_suffix(".json.migrated"))
+        except json.JSONDecodeError:
+            print("Warning: LEGACY_EXTRACTION_CACHE_FILE is not valid JSON. Skipping migration.", flush=True)
+    return cache
+
+def append_extraction_cache(entries: dict):
+    """Appends new cache entries to EXTRACTION_CACHE_FILE; the entries already stored are never rewritten."""
+    if not entries:
+        return
+    EXTRACTION_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with open(EXTRACTION_CACHE_FILE, "a") as f:
+        f.write("".join(json.dumps({"key": key, "result": result}) + "\n" for key, result in entries.items()))
+
+async def save_extraction_cache():
+    """Persists the entries cached since the last save.
+
+    They are taken on the event loop, where extractions add entries, so the write
+    in the thread never iterates a dict that is still changing.
+    """
+    entries = dict(unsaved_cache_entries)
+    unsaved_cache_entries.clear()
     try:
-        response = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": GOAL_EXTRACTION_PROMPT},
-                {"role": "user", "content": f"Extract weekly SMART goals from the following:\n{note_text}"}
-            ],
-            tools=goal_tool_schema,
-            tool_choice="auto",
-            response_format={"type": "json_object"}
-        )
-        if response.choices[0].message.tool_calls:
-            args = response.choices[0].message.tool_calls[0].function.arguments
-            return json.loads(args)
+        await asyncio.to_thread(append_extraction_cache, entries)
     except Exception as e:
-        print(f"Weekly SMART goal extraction error: {e}", flush=True)
-
-    return {"goals": []}
+        # The results are still cached in memory; they are retried with the next save
+        print(f"Failed to save the extraction cache: {e!r}", flush=True)
+        unsaved_cache_entries.update(entries)
+
+extraction_cache = load_extraction_cache()
+unsaved_cache_entries = {}  # cache key -> result, added since the last save_extraction_cache
+inflight_extractions = {}  # cache key -> task, so duplicate notes in a batch are extracted once
+
+def record_cache_lookup(stats: dict, note_text: str, mode: str, hit: bool):
+    if hit:
+        saved_calls, saved_tokens = extraction_cost(note_text, mode)
+        updates = {"hits": 1, "llm_calls_saved": saved_calls, "tokens_saved_estimate": saved_tokens}
+    else:
+        updates = {"misses": 1}
+    for name, value in updates.items():
+        stats[name] = stats.get(name, 0) + value
+        metrics.increment(f"extraction cache {name}", value)
+
+async def extract_note_uncached(note_text: str, mode: str):
+    """Returns `(patient_info, weekly_goals, errors)`; a failed extractor yields empty fields and an entry in `errors`."""
+    async with extraction_slots:
+        if mode == "combined":
+            try:
+                patient_info, weekly_goals = await extract_patient_info_and_goals(note_text)
+            except Exception as e:
+                print(f"Error during combined extraction: {e}", flush=True)
+                return empty_patient_info(), {"goals": []}, [f"combined extraction: {e}"]
+        else:
+            patient_info, weekly_goals = await asyncio.gather(
+                extract_patient_info(note_text),
+                extract_weekly_goals(note_text.strip()),
+                return_exceptions=True
+            )
+
+    errors = []
+    if isinstance(patient_info, Exception):
+        print(f"Error during patient info extraction: {patient_info}", flush=True)
+        errors.append(f"patient info extraction: {patient_info}")
+        patient_info = empty_patient_info()
+    if isinstance(weekly_goals, Exception):
+        print(f"Weekly SMART goal extraction error: {weekly_goals}", flush=True)
+        errors.append(f"weekly goal extraction: {weekly_goals}")
+        weekly_goals = {"goals": []}
+
+    # Failed extractions are not cached so the next run tries again
+    if not errors:
+        key = cache_key(note_text, mode)
+        extraction_cache[key] = unsaved_cache_entries[key] = {"patient_info": patient_info, "weekly_goals": weekly_goals}
+    return patient_info, weekly_goals, errors
+
+async def extract_note(note_text: str, stats: dict, mode: str = EXTRACTION_MODE):
+    """Returns `(patient_info, weekly_goals, errors)` for a note, from the cache when it was already extracted."""
+    key = cache_key(note_text, mode)
+    cached = extraction_cache.get(key)
+    if cached:
+        record_cache_lookup(stats, note_text, mode, hit=True)
+        result = cached["patient_info"], cached["weekly_goals"], []
+    else:
+        task = inflight_extractions.get(key)
+        if task is None:
+            record_cache_lookup(stats, note_text, mode, hit=False)
+            task = asyncio.ensure_future(extract_note_uncached(note_text, mode))
+            inflight_extractions[key] = task
+            task.add_done_callback(lambda _: inflight_extractions.pop(key, None))
+        else:
+            record_cache_lookup(stats, note_text, mode, hit=True)
+        result = await task
+
+    # Copies keep callers from mutating cached results
+    return json.loads(json.dumps(result))
+
+
+# === Read Model ===
+class PatientIndex:
+    """In-memory view of the notes and goals files, indexed by patient.
+
+    Holds each patient's profile, their goal history sorted by date and their
+    latest goals, so lookups never touch the disk. /extract updates the patients
+    it touched; a watcher thread reloads a file if its mtime changes otherwise.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = {}
+        self.goal_history = {}  # patient_id -> [{"date", "goals"}], oldest first
+        self.latest_goals = {}
+        self.mtimes = {}
+
+    @staticmethod
+    def mtime(path):
+        return path.stat().st_mtime_ns if path.exists() else None
+
+    @staticmethod
+    def build_goal_history(goal_entries) -> dict:
+        history = {}
+        for item in goal_entries:
+            history.setdefault(item["patient_id"], []).append(item)
+        for patient_id, items in history.items():
+            items.sort(key=lambda x: datetime.strptime(x["date"], "%Y-%m-%d"))
+            history[patient_id] = [{"date": x["date"], "goals": x.get("output", {}).get("goals", [])} for x in items]
+        return history
+
+    def update_profiles(self, patient_notes: dict, patient_ids):
+        """Refreshes the profiles of `patient_ids` after /extract wrote `patient_notes`."""
+        with self.lock:
+            for patient_id in patient_ids:
+                self.profiles[patient_id] = patient_notes[patient_id]["output"]
+            self.mtimes[SESSION_NOTES_FILE] = self.mtime(SESSION_NOTES_FILE)
+
+    def update_goals(self, goal_entries, patient_ids):
+        """Refreshes the goals of `patient_ids` after /extract wrote `goal_entries`."""
+        history = self.build_goal_history(e for e in goal_entries if e["patient_id"] in patient_ids)
+        with self.lock:
+            for patient_id, entries in history.items():
+                self.goal_history[patient_id] = entries
+                self.latest_goals[patient_id] = entries[-1]["goals"]
+            self.mtimes[WEEKLY_GOALS_FILE] = self.mtime(WEEKLY_GOALS_FILE)
+
+    def context(self, patient_id: str, history_window: int = GOAL_HISTORY_WINDOW):
+        """Everything the agents need about one patient, or None if MMA knows nothing about them."""
+        with self.lock:
+            profile = self.profiles.get(patient_id)
+            history = self.goal_history.get(patient_id, [])
+            if profile is None and not history:
+                return None
+            profile = profile or {}
+            return {
+                "patient_id": patient_id,
+                "profile": profile,
+                "preferred_name": profile.get("preferred_name") or "there",
+                "latest_goals": self.latest_goals.get(patient_id, []),
+                "goal_history": history[-history_window:] if history_window > 0 else []
+            }
 
+    def reload_changed_files(self):
+        """Rebuilds the index from any file whose mtime differs from the last one seen; readers keep the old view meanwhile."""
+        notes_mtime = self.mtime(SESSION_NOTES_FILE)
+        if notes_mtime != self.mtimes.get(SESSION_NOTES_FILE):
+            notes = load_json_file(SESSION_NOTES_FILE, {})
+            profiles = {patient_id: entry["output"] for patient_id, entry in notes.items()}
+            with self.lock:
+                self.profiles = profiles
+                self.mtimes[SESSION_NOTES_FILE] = notes_mtime
+            print(f"Read model loaded {len(profiles)} patient profiles.", flush=True)
+
+        goals_mtime = self.mtime(WEEKLY_GOALS_FILE)
+        if goals_mtime != self.mtimes.get(WEEKLY_GOALS_FILE):
+            history = self.build_goal_history(load_json_file(WEEKLY_GOALS_FILE, []))
+            latest = {patient_id: entries[-1]["goals"] for patient_id, entries in history.items()}
+            with self.lock:
+                self.goal_history, self.latest_goals = history, latest
+                self.mtimes[WEEKLY_GOALS_FILE] = goals_mtime
+            print(f"Read model loaded goals for {len(history)} patients.", flush=True)
+
+    def watch(self):
+        while True:
+            try:
+                self.reload_changed_files()
+            except Exception as e:
+                print(f"Read model reload failed: {e}", flush=True)
+            time.sleep(INDEX_WATCH_INTERVAL)
+
+
+def load_json_file(path, default):
+    if path.exists():
+        with open(path) as f:
+            return json.load(f)
+    return default
+
+def migrate_embedded_notes():
+    """Moves raw notes embedded in the profile and goal files (legacy `input` fields) into the note store.
+
+    Records written before they referenced their notes get a `note_hashes` list: profiles
+    from every note stored for the patient, goal entries from their single `note_hash`.
+    """
+    profiles = load_json_file(SESSION_NOTES_FILE, {})
+    goal_entries = load_json_file(WEEKLY_GOALS_FILE, [])
+    notes = [(patient_id, None, note) for patient_id, entry in profiles.items() for note in entry.get("input", [])]
+    notes += [(entry["patient_id"], entry.get("date"), entry["input"]) for entry in goal_entries if "input" in entry]
+    if notes:
+        note_store.put(notes)
+
+    profiles_to_migrate = [(patient_id, entry) for patient_id, entry in profiles.items() if "note_hashes" not in entry]
+    goals_to_migrate = [entry for entry in goal_entries if "note_hashes" not in entry]
+    if not profiles_to_migrate and not goals_to_migrate:
+        return
+
+    for patient_id, entry in profiles_to_migrate:
+        entry.pop("input", None)
+        entry["note_hashes"] = [row["note_hash"] for row in note_store.hashes_for(patient_id)]
+    for entry in goals_to_migrate:
+        hash_ = note_hash(entry.pop("input")) if "input" in entry else entry.pop("note_hash", None)
+        entry["note_hashes"] = [hash_] if hash_ else []
+    with open(SESSION_NOTES_FILE, "w") as f:
+        json.dump(profiles, f, indent=2)
+    with open(WEEKLY_GOALS_FILE, "w") as f:
+        json.dump(goal_entries, f, indent=2)
+    print(f"Moved {len(notes)} embedded note(s) into {NOTE_STORE_DB} and added note hashes to "
+          f"{len(profiles_to_migrate)} profile(s) and {len(goals_to_migrate)} goal entries", flush=True)
 
-# === API Endpoints ===
-@app.post("/extract")
-async def extract(request: Request):
-    data = await request.json()
-    print(f"Received {len(data)} session entries for processing.", flush=True)
+patient_index = PatientIndex()
 
-    # 1. Update session metadata
-    session_df = pd.DataFrame(data)[['health_coach', 'study_id', 'date']]
-    if SESSION_METADATA_FILE.exists():
-        with open(SESSION_METADATA_FILE) as f:
-            existing = pd.DataFrame(json.load(f))
-    else:
-        existing = pd.DataFrame(columns=session_df.columns)
 
-    combined_sessions = pd.concat([existing, session_df], ignore_index=True)
-    combined_sessions.drop_duplicates(subset=['study_id', 'date'], inplace=True)
-    combined_sessions.sort_values(by=['study_id', 'date'], ascending=[False, False], inplace=True)
+# === Batch Merge ===
+async def merge_batch(data: list, extracted: list) -> dict:
+    """Merges a batch of extracted notes into the memory files and sends the latest sessions to OA.
 
-    with open(SESSION_METADATA_FILE, "w") as f:
-        json.dump(combined_sessions.to_dict(orient="records"), f, indent=2)
+    `extracted` holds the `(patient_info, weekly_goals, errors)` of each entry in `data`.
+    """
+    # 1. Update session metadata
+    latest_sessions = await asyncio.to_thread(sessions.add, data)
+    session_count = await asyncio.to_thread(sessions.count)
+    print(f"Session metadata updated: {session_count} sessions, "
+          f"{len(latest_sessions)} patients with a newer latest session.", flush=True)
 
-    print(f"Session metadata updated with {len(combined_sessions)} sessions.", flush=True)
+    # 2. Store the raw notes; profiles and goals only reference them by hash
+    hashes = await asyncio.to_thread(note_store.put, [(row["study_id"], row["date"], row["note"]) for row in data])
 
-    # 2. Extract structured session notes
+    # 3. Merge structured session notes
     patient_notes = {}
     if SESSION_NOTES_FILE.exists():
         with open(SESSION_NOTES_FILE) as f:
             patient_notes = json.load(f)
 
-    for row in data:
+    for row, (structured, _, _), hash_ in zip(data, extracted, hashes):
         patient_id = row["study_id"]
-        note = row["note"]
-        structured = extract_patient_info(note)
-        time.sleep(1)
 
         for key in ["hobbies", "family", "friends", "travel"]:
             if isinstance(structured[key], str):
@@ -175,7 +575,7 @@ async def extract(request: Request):
         if patient_id not in patient_notes:
             patient_notes[patient_id] = {
                 "patient_id": patient_id,
-                "input": [],
+                "note_hashes": [],
                 "output": {
                     "preferred_name": structured["preferred_name"],
                     "hobbies": [],
@@ -186,9 +586,8 @@ async def extract(request: Request):
             }
 
         entry = patient_notes[patient_id]
-        if note not in entry["input"]:
-            entry["input"].append(note)
-
+        if hash_ not in entry.setdefault("note_hashes", []):
+            entry["note_hashes"].append(hash_)
         for key in ["hobbies", "family", "friends", "travel"]:
             entry["output"][key] = list(set(entry["output"][key] + structured[key]))
 
@@ -197,22 +596,21 @@ async def extract(request: Request):
 
     with open(SESSION_NOTES_FILE, "w") as f:
         json.dump(patient_notes, f, indent=2)
+    patient_index.update_profiles(patient_notes, {row["study_id"] for row in data})
 
     print(f"Session notes updated with {len(patient_notes)} patients.", flush=True)
 
-    # 3. Extract SMART goals
+    # 4. Merge SMART goals
     smart_goals = {}
     if WEEKLY_GOALS_FILE.exists():
         with open(WEEKLY_GOALS_FILE) as f:
             for item in json.load(f):
                 smart_goals[f"{item['patient_id']}|{item['date']}"] = item
 
-    for row in data:
+    for row, (_, result, _), hash_ in zip(data, extracted, hashes):
         patient_id = row["study_id"]
         date = row["date"]
-        full_text = row["note"].strip()
 
-        result = extract_weekly_goals(full_text)
         goals = result.get("goals", [])
 
         if goals:
@@ -220,11 +618,13 @@ async def extract(request: Request):
             if key not in smart_goals:
                 smart_goals[key] = {
                     "patient_id": patient_id,
-                    "input": full_text,
+                    "note_hashes": [],
                     "date": date,
                     "output": {"goals": []}
                 }
             entry = smart_goals[key]
+            if hash_ not in entry.setdefault("note_hashes", []):
+                entry["note_hashes"].append(hash_)
 
             def clean(g): return g.strip().rstrip(".,").lower()
 
@@ -234,72 +634,260 @@ async def extract(request: Request):
 
             entry["output"]["goals"] = sorted({g.capitalize() for g in merged})
 
-        time.sleep(1)
-
     with open(WEEKLY_GOALS_FILE, "w") as f:
         json.dump(sorted(smart_goals.values(), key=lambda x: (x["patient_id"], x["date"]), reverse=True), f, indent=2)
+    patient_index.update_goals(smart_goals.values(), {row["study_id"] for row in data})
 
     print(f"SMART goals updated with {len(smart_goals)} entries.", flush=True)
 
-    # 4. Notify OA with latest session dates
-    latest_sessions = (
-        combined_sessions.sort_values(by=["study_id", "date"], ascending=[True, False])
-        .drop_duplicates(subset="study_id", keep="first")
-        .to_dict(orient="records")
-    )
-
-    time.sleep(1)
-    try:
-        res = requests.post(OA_URL, json=latest_sessions)
-        if res.status_code == 200:
-            print(f"Sent {len(latest_sessions)} session entries to OA.", flush=True)
-        else:
-            print(f"OA responded with error: {res.status_code} - {res.text}", flush=True)
-    except Exception as e:
-        print(f"Error sending session metadata to OA: {e}", flush=True)
+    # 5. Notify OA of the patients whose latest session changed, including any OA did not confirm before
+    pending_sessions = await asyncio.to_thread(sessions.pending)
+    if pending_sessions:
+        try:
+            res = await http_client.apost(OA_URL, json=pending_sessions)
+            if res.status_code == 200:
+                await asyncio.to_thread(sessions.mark_notified, pending_sessions)
+                print(f"Sent {len(pending_sessions)} session entries to OA.", flush=True)
+            else:
+                print(f"OA responded with error: {res.status_code} - {res.text}; "
+                      f"{len(pending_sessions)} session entries stay pending.", flush=True)
+        except Exception as e:
+            print(f"Error sending session metadata to OA: {e}; "
+                  f"{len(pending_sessions)} session entries stay pending.", flush=True)
+    else:
+        print("No patient has a newer session; OA not notified.", flush=True)
 
     return {
-        "status": "saved",
-        "sessions": len(combined_sessions),
+        "sessions": session_count,
+        "updated_patients": len(latest_sessions),
         "patients": len(patient_notes),
         "goals": len(smart_goals)
     }
 
+
+# === Extraction Jobs ===
+SESSION_ENTRY_FIELDS = ("study_id", "health_coach", "date", "note")
+
+class ExtractionJob:
+    """One upload to /extract, tracked until its notes are merged into the memory files.
+
+    Each note starts extracting as soon as its line arrives. Once the upload is
+    complete and every note is done, the batch is merged in one pass (see
+    merge_batch). Per-note progress, results and errors are kept for GET /jobs/{job_id}.
+    """
+
+    def __init__(self, mode: str):
+        self.id = uuid.uuid4().hex
+        self.mode = mode
+        self.status = "receiving"  # -> "extracting" -> "merging" -> "done" | "failed"
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.rows = []   # valid session entries, in upload order
+        self.notes = []  # progress of every uploaded line, valid or not
+        self.tasks = []
+        self.cache_stats = {"hits": 0, "misses": 0, "llm_calls_saved": 0, "tokens_saved_estimate": 0}
+        self.summary = None
+
+    def add(self, line_number: int, row):
+        """Validates one uploaded session entry and starts extracting its note."""
+        missing = [k for k in SESSION_ENTRY_FIELDS if not isinstance(row, dict) or k not in row]
+        progress = {"line": line_number, "study_id": row.get("study_id") if isinstance(row, dict) else None}
+        if missing:
+            progress.update(status="invalid", error=f"missing fields {missing}")
+        else:
+            progress.update(date=row["date"], status="pending")
+            self.rows.append(row)
+            self.tasks.append(asyncio.ensure_future(self.extract(row, progress)))
+        self.notes.append(progress)
+
+    def reject(self, line_number: int, error: str):
+        self.notes.append({"line": line_number, "study_id": None, "status": "invalid", "error": error})
+
+    async def extract(self, row: dict, progress: dict):
+        progress["status"] = "extracting"
+        patient_info, weekly_goals, errors = await extract_note(row["note"], self.cache_stats, self.mode)
+        progress["status"] = "error" if errors else "done"
+        progress["result"] = {"patient_info": patient_info, "goals": weekly_goals.get("goals", [])}
+        if errors:
+            progress["error"] = "; ".join(errors)
+        return patient_info, weekly_goals, errors
+
+    async def run(self):
+        """Waits for every note of the completed upload, then merges the batch."""
+        self.status = "extracting"
+        started = time.monotonic()
+        try:
+            extracted = await asyncio.gather(*self.tasks)
+            await save_extraction_cache()
+            print(f"Job {self.id}: extracted {len(self.rows)} notes in {time.monotonic() - started:.1f}s "
+                  f"({self.cache_stats['hits']} cache hits, {self.cache_stats['misses']} misses).", flush=True)
+            self.status = "merging"
+            self.summary = await merge_batch(self.rows, extracted) if self.rows else None
+            self.status = "done"
+        except Exception as e:
+            print(f"Job {self.id} failed: {e!r}", flush=True)
+            self.status, self.error = "failed", repr(e)
+        self.finished_at = time.time()
+
+    def fail(self, error: str):
+        # Notes already extracting are left to finish; their results land in the cache for the next upload
+        self.status, self.error = "failed", error
+        self.finished_at = time.time()
+
+    def to_dict(self) -> dict:
+        counts = {}
+        for note in self.notes:
+            counts[note["status"]] = counts.get(note["status"], 0) + 1
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "extraction_mode": self.mode,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "received": len(self.notes),
+            "progress": counts,
+            "extraction_cache": self.cache_stats,
+            "summary": self.summary,
+            "notes": self.notes
+        }
+
+
+jobs = {}  # job_id -> ExtractionJob; kept in memory, so job history is lost on restart
+pending_tasks = set()  # running jobs, kept referenced until they finish
+
+def create_job(mode: str) -> ExtractionJob:
+    now = time.time()
+    for job_id in [j.id for j in jobs.values() if j.finished_at and now - j.finished_at > JOB_RETENTION]:
+        del jobs[job_id]
+    job = ExtractionJob(mode)
+    jobs[job.id] = job
+    return job
+
+async def iter_ndjson_lines(request: Request):
+    """Yields the non-empty lines of a streamed request body as they arrive."""
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+# === API Endpoints ===
+@app.post("/extract")
+async def extract(request: Request):
+    """Starts an extraction job and returns its id once the upload is received.
+
+    The body is either NDJSON (`Content-Type: application/x-ndjson`, one session
+    entry per line, extracted as the lines arrive) or a JSON array of entries.
+    Poll GET /jobs/{job_id} for progress.
+    """
+    mode = request.query_params.get("mode", EXTRACTION_MODE)
+    if mode not in EXTRACTION_MODES:
+        return {"status": "error", "reason": f"Unknown extraction mode '{mode}', expected one of {EXTRACTION_MODES}"}
+
+    job = create_job(mode)
+    try:
+        if "ndjson" in request.headers.get("content-type", ""):
+            line_number = 0
+            async for line in iter_ndjson_lines(request):
+                line_number += 1
+                try:
+                    job.add(line_number, json.loads(line))
+                except json.JSONDecodeError as e:
+                    job.reject(line_number, f"invalid JSON: {e}")
+        else:
+            data = await request.json()
+            if not isinstance(data, list):
+                raise ValueError("expected a JSON array of session entries")
+            for line_number, row in enumerate(data, start=1):
+                job.add(line_number, row)
+    except Exception as e:
+        job.fail(f"upload failed: {e!r}")
+        print(f"Job {job.id}: {job.error}", flush=True)
+        return JSONResponse({"status": "error", "reason": job.error, "job_id": job.id}, status_code=400)
+
+    print(f"Job {job.id}: received {len(job.notes)} session entries ({mode} extraction).", flush=True)
+    task = asyncio.create_task(job.run())
+    pending_tasks.add(task)
+    task.add_done_callback(pending_tasks.discard)
+    return JSONResponse(
+        {"status": "accepted", "job_id": job.id, "received": len(job.notes), "status_url": f"/jobs/{job.id}"},
+        status_code=202
+    )
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse({"status": "error", "reason": f"Unknown job {job_id}"}, status_code=404)
+    return job.to_dict()
+
 @app.get("/patient_notes/{patient_id}")
 def get_notes(patient_id: str):
-    if SESSION_NOTES_FILE.exists():
-        with open(SESSION_NOTES_FILE) as f:
-            notes = json.load(f)
-        if patient_id in notes:
-            print(f"Sent notes to SOA for patient {patient_id}", flush=True)
-            return notes[patient_id]["output"]
+    profile = patient_index.profiles.get(patient_id)
+    if profile is not None:
+        print(f"Sent notes to SOA for patient {patient_id}", flush=True)
+        return profile
     return {}
 
 @app.get("/patient_goals/{patient_id}")
 def get_goals(patient_id: str):
-    if WEEKLY_GOALS_FILE.exists():
-        with open(WEEKLY_GOALS_FILE) as f:
-            all_goals = json.load(f)
-    else:
-        all_goals = []
-
-    patient_goals = [g for g in all_goals if g["patient_id"] == patient_id]
-    recent_goals = []
-
-    if patient_goals:
-        latest = max(patient_goals, key=lambda x: datetime.strptime(x["date"], "%Y-%m-%d"))
-        recent_goals = latest.get("output", {}).get("goals", [])
-    else:
+    recent_goals = patient_index.latest_goals.get(patient_id)
+    if recent_goals is None:
+        recent_goals = []
         print(f"No SMART goals found for {patient_id}", flush=True)
 
-    preferred_name = "there"
-    if SESSION_NOTES_FILE.exists():
-        with open(SESSION_NOTES_FILE) as f:
-            session_data = json.load(f)
-        preferred_name = session_data.get(patient_id, {}).get("output", {}).get("preferred_name", "there")
+    preferred_name = patient_index.profiles.get(patient_id, {}).get("preferred_name", "there")
 
     print(f"Sent SMART goals to GRA for patient {patient_id}", flush=True)
     return {
         "preferred_name": preferred_name,
         "smart_goals": recent_goals
-    }
\ No newline at end of file
+    }
+
+@app.post("/patient_context")
+async def get_patient_context(request: Request):
+    """Profile, latest goals and recent goal history for many patients in one request."""
+    data = await request.json()
+    patient_ids = data.get("patient_ids")
+    if not isinstance(patient_ids, list) or not patient_ids:
+        return {"status": "error", "reason": "Missing patient_ids"}
+    if len(patient_ids) > MAX_CONTEXT_BATCH:
+        return {"status": "error", "reason": f"At most {MAX_CONTEXT_BATCH} patient_ids per request"}
+    history_window = int(data.get("goal_history", GOAL_HISTORY_WINDOW))
+
+    patients, missing = {}, []
+    for patient_id in dict.fromkeys(patient_ids):
+        context = patient_index.context(patient_id, history_window)
+        if context is None:
+            missing.append(patient_id)
+        else:
+            patients[patient_id] = context
+
+    print(f"Sent context for {len(patients)} patients ({len(missing)} unknown)", flush=True)
+    return {"status": "ok", "patients": patients, "missing": missing}
+
+@app.get("/notes/{hash_}")
+def get_note(hash_: str):
+    text = note_store.get(hash_)
+    if text is None:
+        return JSONResponse({"status": "error", "reason": f"Unknown note {hash_}"}, status_code=404)
+    return {"note_hash": hash_, "note": text}
+
+@app.get("/metrics")
+def get_metrics():
+    return {**metrics.snapshot(), "llm_cache": llm.cache_stats(), "llm_governor": governor.stats(), "breakers": resilience.breaker_states()}
+
+
+# === Startup ===
+@app.on_event("startup")
+def startup_event():
+    migrate_embedded_notes()
+    patient_index.reload_changed_files()
+    threading.Thread(target=patient_index.watch, daemon=True).start()
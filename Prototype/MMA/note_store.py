@@ -0,0 +1,71 @@
+import hashlib, sqlite3, threading
+from pathlib import Path
+
+
+def note_hash(note_text: str) -> str:
+    return hashlib.sha256(note_text.encode()).hexdigest()
+
+
+class NoteStore:
+    """Raw coaching notes addressed by the SHA-256 of their text, stored in SQLite (WAL mode).
+
+    Profile and goal records reference notes by hash instead of embedding them,
+    so the lookup files stay the size of the extracted data however many notes a
+    patient accumulates. A note ingested twice is stored once.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS notes (
+                hash TEXT PRIMARY KEY,
+                text TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS patient_notes (
+                patient_id TEXT NOT NULL,
+                note_hash TEXT NOT NULL,
+                date TEXT,
+                PRIMARY KEY (patient_id, note_hash)
+            );
+        """)
+
+    def put(self, notes) -> list:
+        """Stores `(patient_id, date, text)` tuples and returns the hash of each text, in order."""
+        notes = list(notes)
+        hashes = [note_hash(text) for _, _, text in notes]
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO notes (hash, text) VALUES (?, ?)",
+                    [(h, text) for h, (_, _, text) in zip(hashes, notes)]
+                )
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO patient_notes (patient_id, note_hash, date) VALUES (?, ?, ?)",
+                    [(patient_id, h, date) for h, (patient_id, date, _) in zip(hashes, notes)]
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return hashes
+
+    def get(self, hash_: str):
+        """The note with this hash, or None."""
+        with self.lock:
+            row = self.conn.execute("SELECT text FROM notes WHERE hash = ?", (hash_,)).fetchone()
+        return row["text"] if row else None
+
+    def hashes_for(self, patient_id: str) -> list:
+        """`{"note_hash", "date"}` of every note ingested for the patient, oldest first."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT note_hash, date FROM patient_notes WHERE patient_id = ? ORDER BY date, rowid", (patient_id,)
+            ).fetchall()
+        return [dict(r) for r in rows]
@@ -0,0 +1,131 @@
+import json, sqlite3, threading
+from pathlib import Path
+
+
+class SessionIndex:
+    """Coaching sessions keyed by (study_id, date), stored in SQLite (WAL mode).
+
+    Alongside the sessions it keeps each patient's latest session, so adding a
+    batch costs O(batch) and reports exactly the patients whose latest session
+    moved, without re-reading or re-sorting the sessions already stored. A moved
+    latest session stays pending until `mark_notified` confirms OA received it.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                study_id TEXT NOT NULL,
+                date TEXT NOT NULL,
+                health_coach TEXT,
+                PRIMARY KEY (study_id, date)
+            );
+            CREATE TABLE IF NOT EXISTS latest_sessions (
+                study_id TEXT PRIMARY KEY,
+                date TEXT NOT NULL,
+                health_coach TEXT,
+                notified INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        columns = [row["name"] for row in self.conn.execute("PRAGMA table_info(latest_sessions)")]
+        if "notified" not in columns:
+            # Indexes created before the flag existed send every latest session once more
+            self.conn.execute("ALTER TABLE latest_sessions ADD COLUMN notified INTEGER NOT NULL DEFAULT 0")
+
+    def _add(self, sessions) -> dict:
+        changed = {}
+        for s in sessions:
+            # The first coach recorded for a session is kept, as with the old metadata file
+            inserted = self.conn.execute(
+                "INSERT OR IGNORE INTO sessions (study_id, date, health_coach) VALUES (?, ?, ?)",
+                (s["study_id"], s["date"], s.get("health_coach"))
+            ).rowcount
+            if not inserted:
+                continue
+            # ISO dates compare correctly as strings
+            moved = self.conn.execute(
+                "INSERT INTO latest_sessions (study_id, date, health_coach) VALUES (?, ?, ?) "
+                "ON CONFLICT (study_id) DO UPDATE SET date = excluded.date, health_coach = excluded.health_coach, notified = 0 "
+                "WHERE excluded.date > latest_sessions.date",
+                (s["study_id"], s["date"], s.get("health_coach"))
+            ).rowcount
+            if moved:
+                changed[s["study_id"]] = {"health_coach": s.get("health_coach"), "study_id": s["study_id"], "date": s["date"]}
+        return changed
+
+    def add(self, sessions) -> list:
+        """Adds `{"study_id", "date", "health_coach"}` entries, skipping sessions already indexed.
+
+        Returns the new latest session of every patient whose latest session changed.
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                changed = self._add(sessions)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return list(changed.values())
+
+    def pending(self) -> list:
+        """The latest sessions that changed since OA last confirmed receiving them."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT health_coach, study_id, date FROM latest_sessions WHERE notified = 0 ORDER BY study_id"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def mark_notified(self, entries):
+        """Clears the pending flag of the given latest sessions, unless they moved again since."""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany(
+                    "UPDATE latest_sessions SET notified = 1 WHERE study_id = ? AND date = ?",
+                    [(e["study_id"], e["date"]) for e in entries]
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def count(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def migrate_from_json(self, json_path: Path) -> int:
+        """Imports a legacy `session_metadata_mock.json` once, then renames it to `*.migrated`.
+
+        Returns the number of imported sessions.
+        """
+        if not json_path.exists():
+            return 0
+        try:
+            with open(json_path) as f:
+                raw = json.load(f)
+        except json.JSONDecodeError:
+            print(f"Warning: {json_path} is not valid JSON. Skipping migration.", flush=True)
+            return 0
+
+        sessions = [s for s in raw if s.get("study_id") and s.get("date")]
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                before = self.conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+                self._add(sessions)
+                imported = self.conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - before
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+        json_path.rename(json_path.with_name(json_path.name + ".migrated"))
+        print(f"Migrated {imported} session(s) from {json_path} to {self.path}", flush=True)
+        return imported
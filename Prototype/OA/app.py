@@ -1,19 +1,55 @@
 from pathlib import Path
-import time, threading, json, requests
+import os, time, uuid, threading, json, heapq, asyncio
 from datetime import datetime, timedelta
 from fastapi import FastAPI, Request 
+from fastapi.responses import StreamingResponse
+from common import http_client, locks, metrics, resilience
+from conversation_store import ConversationStore
 
 # === Configuration ===
 MMA_URL = "http://mma:8000/extract"
+MMA_JOB_URL = "http://mma:8000/jobs/{job_id}"
+MMA_CONTEXT_URL = "http://mma:8000/patient_context"
 AGENT_URL = "http://{agent}:8000/trigger"
+PREGENERATE_URL = "http://{agent}:8000/pregenerate"
+
+# Phase openings that don't depend on patient replies; generated as soon as SOA opens a session
+PREGENERATED_OPENINGS = {"GRA": 6, "SCA": 13}  # agent -> turn index of its opening message
 
 SESSION_NOTES_FILE = Path("memory/session_notes_mock.json")
 REVIEW_SCHEDULE_FILE = Path("memory/review_schedule.json")
-GOAL_REVIEW_FILE = Path("memory/goal_reviews.json")
+GOAL_REVIEW_FILE = Path("memory/goal_reviews.json")  # legacy JSON store, migrated on startup
+GOAL_REVIEW_DB = Path("memory/goal_reviews.db")
+
+REVIEW_HOUR = 9
+REVIEW_GRACE = timedelta(hours=1)  # reviews already this overdue when the schedule is loaded at startup are skipped as missed
+MMA_EXTRACTION_HOUR = 0
+MMA_UPLOAD_TIMEOUT = 60  # seconds to stream the notes to MMA; extraction then runs as a background job
+MMA_JOB_TIMEOUT = 3600  # seconds to keep polling an extraction job before giving up on it
+MMA_JOB_POLL_INTERVAL = 10
+
+# Patient context (profile and goals) is prefetched from MMA for each review batch and
+# handed to the agents with their triggers, so they don't call MMA during live turns
+CONTEXT_AGENTS = ("soa", "gra")
+CONTEXT_BATCH_SIZE = 500  # patient ids per /patient_context request
+PATIENT_CONTEXT_TTL = 6 * 3600  # seconds; long enough to cover a review session
+
+STREAM_KEEPALIVE = 15  # seconds between keep-alive comments on idle message streams
+STREAM_MAX_DURATION = 300  # seconds; clients reconnect with ?after=<last id> to keep listening
+
+# Fan-out of review triggers (see fan_out_triggers)
+TRIGGER_CONCURRENCY = int(os.getenv("OA_TRIGGER_CONCURRENCY", "50"))
+TRIGGER_TIMEOUT = float(os.getenv("OA_TRIGGER_TIMEOUT", "60"))  # seconds per agent request
+TRIGGER_BATCH_DEADLINE = float(os.getenv("OA_TRIGGER_BATCH_DEADLINE", "1800"))  # seconds per batch
+TRIGGER_RETRY_DELAY = float(os.getenv("OA_TRIGGER_RETRY_DELAY", "900"))  # seconds before a failed or deferred review is tried again
+TRIGGER_RETRIES = int(os.getenv("OA_TRIGGER_RETRIES", "3"))  # retries of one review before it is given up for the week
 
 
 # === Initialization ===
 app = FastAPI()
+app.add_middleware(resilience.DeadlineMiddleware)  # applies the caller's X-Deadline-Ms to each request
+conversations = ConversationStore(GOAL_REVIEW_DB)
+conversations.migrate_from_json(GOAL_REVIEW_FILE)
 
 
 # === Memory Handlers ===
@@ -26,79 +62,173 @@ def load_review_schedule():
             print("Warning: REVIEW_SCHEDULE_FILE is not valid JSON. Starting fresh.", flush=True)
     return {}
 
-def load_goal_reviews():
-    if GOAL_REVIEW_FILE.exists():
-        try:
-            with open(GOAL_REVIEW_FILE) as f:
-                raw = json.load(f)
-                return [json.loads(e) if isinstance(e, str) else e for e in raw]
-        except json.JSONDecodeError:
-            print("Warning: GOAL_REVIEW_FILE is not valid JSON. Starting fresh.", flush=True)
-    return []
+schedule_lock = threading.Lock()  # the API and the orchestration loop both rewrite REVIEW_SCHEDULE_FILE
+
+def save_review_times(review_times):
+    """Persists `{patient_id: next_review_time}` to REVIEW_SCHEDULE_FILE."""
+    with schedule_lock:
+        schedule = load_review_schedule()
+        patients = schedule.setdefault("patients", {})
+        for patient_id, review_time in review_times.items():
+            patients[patient_id] = {"next_review_time": review_time.isoformat()}
+        REVIEW_SCHEDULE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(REVIEW_SCHEDULE_FILE, "w") as f:
+            json.dump(schedule, f, indent=2)
+
+def load_goal_review(patient_id):
+    return conversations.load(patient_id)
 
 def save_message(new_record):
-    GOAL_REVIEW_FILE.parent.mkdir(parents=True, exist_ok=True)
-    records = load_goal_reviews()
+    conversations.append(
+        new_record["patient_id"],
+        new_record.get("chat_history", []),
+        new_record.get("turn_index")
+    )
+
+
+# === Message Stream ===
+# One event per patient with listeners; it is set and replaced whenever a message is stored
+message_events = {}
+partial_replies = {}  # patient_id -> {"turn_index", "text"} of a reply an agent is still generating
+patient_locks = locks.KeyedLock("patient")  # stores one patient's messages in the order they arrive
+
+def notify_new_message(patient_id):
+    event = message_events.pop(patient_id, None)
+    if event:
+        event.set()
+
+async def stream_messages(patient_id, after_id, max_duration):
+    loop = asyncio.get_running_loop()
+    stop_at = loop.time() + max_duration
+    last_id = after_id
+    sent_partial = None
+
+    while loop.time() < stop_at:
+        # Grab the event before reading so a message stored in between still wakes us up
+        event = message_events.setdefault(patient_id, asyncio.Event())
+        messages = await asyncio.to_thread(conversations.messages_since, patient_id, last_id)
+        for message in messages:
+            last_id = message["id"]
+            yield f"id: {last_id}\nevent: message\ndata: {json.dumps(message)}\n\n"
+        if messages:
+            continue
 
-    updated = False
-    for record in records:
-        if record.get("patient_id") == new_record.get("patient_id"):
-            if "chat_history" in new_record:
-                record["chat_history"].extend(new_record.get("chat_history", []))
-            if "turn_index" in new_record:
-                record["turn_index"] = new_record.get("turn_index")
-            updated = True
-            break
+        # Partial replies carry no id: a reconnecting client only needs the stored messages
+        partial = partial_replies.get(patient_id)
+        if partial and (partial["turn_index"], len(partial["text"])) != sent_partial:
+            sent_partial = (partial["turn_index"], len(partial["text"]))
+            yield f"event: partial\ndata: {json.dumps(partial)}\n\n"
+            continue
 
-    if not updated:
-        records.append(new_record)
+        try:
+            await asyncio.wait_for(event.wait(), min(STREAM_KEEPALIVE, max(0, stop_at - loop.time())))
+        except asyncio.TimeoutError:
+            yield ": keep-alive\n\n"
 
-    with open(GOAL_REVIEW_FILE, "w") as f:
-        json.dump(records, f, indent=2)
 
+# === Patient Context ===
+patient_contexts = {}  # patient_id -> {"context", "fetched"}
 
-# === Trigger Helper (used by both loop and endpoint) ===
-def trigger_agent_sync(patient_id: str, turn_index: int, agent_to_trigger: str) -> dict:
-    agent = agent_to_trigger.lower()
-    url = AGENT_URL.format(agent=agent)
+async def prefetch_patient_context(patient_ids) -> int:
+    """Fetches the MMA context of `patient_ids` in batched requests. Returns how many patients were found."""
+    patient_ids = list(dict.fromkeys(patient_ids))
+    found = 0
+    for start in range(0, len(patient_ids), CONTEXT_BATCH_SIZE):
+        try:
+            response = await http_client.apost(MMA_CONTEXT_URL, json={"patient_ids": patient_ids[start:start + CONTEXT_BATCH_SIZE]})
+            response.raise_for_status()
+            patients = response.json().get("patients", {})
+        except Exception as e:
+            # Agents fetch from MMA themselves when no context comes with the trigger
+            print(f"Failed to prefetch patient context from MMA: {e!r}", flush=True)
+            continue
+        fetched = time.monotonic()
+        for patient_id, context in patients.items():
+            patient_contexts[patient_id] = {"context": context, "fetched": fetched}
+        found += len(patients)
+    return found
+
+def cached_patient_context(patient_id):
+    entry = patient_contexts.get(patient_id)
+    if entry and time.monotonic() - entry["fetched"] <= PATIENT_CONTEXT_TTL:
+        return entry["context"]
+    return None
+
+
+# === Opening Pre-generation ===
+active_sessions = {}  # patient_id -> id of the review session currently running
+pending_tasks = set()  # keeps fire-and-forget tasks referenced until they finish
+
+async def pregenerate_openings(patient_id, session_id):
+    resilience.clear_deadline()  # runs past the request that started the session
+    async def pregenerate(agent, turn_index):
+        payload = {"patient_id": patient_id, "session_id": session_id, "turn_index": turn_index}
+        context = cached_patient_context(patient_id) if agent.lower() in CONTEXT_AGENTS else None
+        if context:
+            payload["patient_context"] = context
+        try:
+            response = await http_client.apost(PREGENERATE_URL.format(agent=agent.lower()), json=payload)
+            response.raise_for_status()
+        except Exception as e:
+            # The handoff falls back to live generation
+            print(f"Failed to start {agent} pre-generation for patient {patient_id}: {e!r}", flush=True)
+
+    await asyncio.gather(*(pregenerate(agent, turn) for agent, turn in PREGENERATED_OPENINGS.items()))
+
+def start_session(patient_id):
+    session_id = uuid.uuid4().hex
+    active_sessions[patient_id] = session_id
+    task = asyncio.create_task(pregenerate_openings(patient_id, session_id))
+    pending_tasks.add(task)
+    task.add_done_callback(pending_tasks.discard)
 
-    print(f"OA received {agent_to_trigger} trigger request for {patient_id}", flush=True)
 
+# === Trigger Helpers (used by both loop and endpoint) ===
+def build_trigger_payload(patient_id: str, turn_index: int, agent: str) -> dict:
     payload = {
         "patient_id": patient_id,
-        "turn_index": turn_index  # default for most agents
+        "turn_index": turn_index,  # default for most agents
+        "session_id": active_sessions.get(patient_id)
     }
+    context = cached_patient_context(patient_id) if agent in CONTEXT_AGENTS else None
+    if context:
+        payload["patient_context"] = context
 
     # Special logic for SSA
     if agent == "ssa":
-        if not GOAL_REVIEW_FILE.exists():
-            return {"status": "error", "reason": "Goal review file not found."}
+        patient_entry = load_goal_review(patient_id)
+        if not patient_entry:
+            raise LookupError(f"No goal review conversation found for patient {patient_id}")
 
-        try:
-            with open(GOAL_REVIEW_FILE) as f:
-                entries = json.load(f)
-            patient_entry = next((e for e in entries if e.get("patient_id") == patient_id), None)
+        payload = {
+            "patient_id": patient_id,
+            "chat_history": patient_entry.get("chat_history")
+        }
 
-            if not patient_entry:
-                return {"status": "error", "reason": f"No entry found in goal_reviews.json for patient {patient_id}"}
+    return payload
 
-            payload = {
-                "patient_id": patient_id,
-                "chat_history": patient_entry.get("chat_history")
-            }
+async def trigger_agent_async(patient_id: str, turn_index: int, agent_to_trigger: str, timeout: float = TRIGGER_TIMEOUT) -> dict:
+    agent = agent_to_trigger.lower()
+    url = AGENT_URL.format(agent=agent)
 
-        except Exception as e:
-            return {"status": "error", "reason": f"Failed to load SCA payload: {e}"}
+    print(f"OA received {agent_to_trigger} trigger request for {patient_id}", flush=True)
 
     try:
-        response = requests.post(url, json=payload)
+        payload = await asyncio.to_thread(build_trigger_payload, patient_id, turn_index, agent)
+    except Exception as e:
+        return {"status": "error", "reason": f"Failed to load {agent_to_trigger} payload: {e}"}
+
+    try:
+        response = await http_client.apost(url, json=payload, timeout=timeout)
+        response.raise_for_status()
         print(f"Triggered {agent_to_trigger} for patient {patient_id}", flush=True)
         return {"status": "ok"}
     except Exception as e:
-        print(f"Failed to trigger {agent_to_trigger}: {e}", flush=True)
-        return {"status": "error", "reason": str(e)}
+        print(f"Failed to trigger {agent_to_trigger} for patient {patient_id}: {e!r}", flush=True)
+        return {"status": "error", "reason": repr(e)}
 
 def trigger_mma():
+    """Streams the session notes to MMA as NDJSON and watches the resulting extraction job in the background."""
 
     if not SESSION_NOTES_FILE.exists():
         return {"status": "error", "reason": "session_notes_mock.json not found"}
@@ -110,45 +240,254 @@ def trigger_mma():
         if not isinstance(payload, list) or not all(isinstance(p, dict) for p in payload):
             return {"status": "error", "reason": "Invalid JSON structure. Expected a list of dicts."}
 
-        mma_response = requests.post(MMA_URL, json=payload)
+        mma_response = http_client.post(
+            MMA_URL,
+            data=(json.dumps(entry).encode() + b"\n" for entry in payload),
+            headers={"Content-Type": "application/x-ndjson"},
+            timeout=(http_client.CONNECT_TIMEOUT, MMA_UPLOAD_TIMEOUT)
+        )
+        mma_response.raise_for_status()
+        job_id = mma_response.json()["job_id"]
+        threading.Thread(target=watch_mma_job, args=(job_id,), daemon=True).start()
 
-        return {
-            "status": "ok",
-            "sent": len(payload),
-            "mma_status": mma_response.status_code,
-            "mma_response": mma_response.json()
-        }
+        return {"status": "ok", "sent": len(payload), "job_id": job_id}
 
     except Exception as e:
+        print(f"Failed to start MMA extraction: {e}", flush=True)
         return {"status": "error", "reason": str(e)}
 
+def watch_mma_job(job_id: str):
+    """Polls an MMA extraction job until it finishes or MMA_JOB_TIMEOUT passes, and logs the outcome."""
+    deadline = time.monotonic() + MMA_JOB_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(MMA_JOB_POLL_INTERVAL)
+        try:
+            job = http_client.get(MMA_JOB_URL.format(job_id=job_id)).json()
+        except Exception as e:
+            print(f"Could not poll MMA job {job_id}: {e}", flush=True)
+            continue
+        if job.get("status") in ("done", "failed", "error"):
+            failed_notes = [n for n in job.get("notes", []) if n.get("status") in ("error", "invalid")]
+            print(f"MMA job {job_id} {job['status']}: {job.get('progress')} {job.get('error') or ''}", flush=True)
+            for note in failed_notes:
+                print(f"  line {note['line']} ({note.get('study_id')}): {note.get('error')}", flush=True)
+            return job
+    print(f"MMA job {job_id} still running after {MMA_JOB_TIMEOUT}s; no longer polling it.", flush=True)
+    return None
+
+
+# === Concurrent Trigger Fan-out ===
+async def fan_out_triggers(patient_ids, agent_to_trigger="SOA", turn_index=1,
+                           concurrency=TRIGGER_CONCURRENCY, timeout=TRIGGER_TIMEOUT,
+                           batch_deadline=TRIGGER_BATCH_DEADLINE) -> dict:
+    """Triggers `agent_to_trigger` for many patients with at most `concurrency` requests in flight.
+
+    Each request runs under a deadline of `timeout`, which the agent also receives,
+    so a busy agent answering late doesn't count against its circuit breaker.
+    Patients whose request has not started when `batch_deadline` expires are
+    reported as deferred instead of triggered; those rejected by an open breaker
+    are reported as failed. The orchestration loop reschedules both.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+    stop_at = loop.time() + batch_deadline
+    report = {"triggered": [], "failed": [], "deferred": []}
+
+    async def trigger_one(patient_id):
+        async with semaphore:
+            if loop.time() >= stop_at:
+                report["deferred"].append(patient_id)
+                return
+            resilience.start_deadline(timeout)  # each trigger runs in its own task, so this bounds only this one
+            result = await trigger_agent_async(patient_id, turn_index, agent_to_trigger, timeout)
+            report["triggered" if result["status"] == "ok" else "failed"].append(patient_id)
+
+    await asyncio.gather(*(trigger_one(patient_id) for patient_id in patient_ids))
+
+    return report
+
+
+# === Review Scheduler ===
+class ReviewScheduler:
+    """Min-heap of upcoming reviews keyed by `next_review_time`.
+
+    The heap may hold stale entries for patients whose review was moved; they are
+    skipped on pop by comparing against `self.due`, which always holds the
+    current review time of each scheduled patient.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.due = {}
+        self.cond = threading.Condition()
+
+    def load(self, schedule, now=None):
+        """Replaces the schedule; reviews more than REVIEW_GRACE overdue at `now` are skipped as missed."""
+        now = now or datetime.now()
+        with self.cond:
+            self.due, missed = {}, []
+            for patient_id, info in schedule.get("patients", {}).items():
+                if not info.get("next_review_time"):
+                    continue
+                review_time = datetime.fromisoformat(info["next_review_time"])
+                if now - review_time < REVIEW_GRACE:
+                    self.due[patient_id] = review_time
+                else:
+                    missed.append(patient_id)
+            if missed:
+                print(f"[{now}] Skipping {len(missed)} missed review(s): {', '.join(missed)}", flush=True)
+            self.heap = [(review_time, patient_id) for patient_id, review_time in self.due.items()]
+            heapq.heapify(self.heap)
+            self.cond.notify()
+
+    def update(self, patient_id, review_time):
+        with self.cond:
+            if self.due.get(patient_id) == review_time:
+                return
+            self.due[patient_id] = review_time
+            heapq.heappush(self.heap, (review_time, patient_id))
+            # Only wake the loop if the new entry is now the earliest one
+            if self.heap[0] == (review_time, patient_id):
+                self.cond.notify()
+
+    def retry(self, patient_id, review_time):
+        """Puts a popped review back at `review_time`, unless the patient got a new review meanwhile."""
+        with self.cond:
+            if patient_id in self.due:
+                return False
+            self.update(patient_id, review_time)
+            return True
+
+    def next_time(self):
+        while self.heap:
+            review_time, patient_id = self.heap[0]
+            if self.due.get(patient_id) == review_time:
+                return review_time
+            heapq.heappop(self.heap)
+        return None
+
+    def pop_due(self, now):
+        """Removes and returns the patients whose review is due at `now`, however late (e.g. after a long batch)."""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            review_time, patient_id = heapq.heappop(self.heap)
+            if self.due.get(patient_id) != review_time:
+                continue
+            del self.due[patient_id]
+            due.append(patient_id)
+        return due
+
+    def wait_until(self, deadline):
+        """Sleeps until `deadline`, or earlier if an earlier review gets scheduled."""
+        with self.cond:
+            next_review = self.next_time()
+            if next_review is not None and next_review < deadline:
+                deadline = next_review
+            timeout = (deadline - datetime.now()).total_seconds()
+            if timeout > 0:
+                self.cond.wait(timeout)
+
+    def run_due(self):
+        with self.cond:
+            now = datetime.now()
+            return now, self.pop_due(now)
+
+
+scheduler = ReviewScheduler()
+
+
+def next_extraction_time(now):
+    extraction_time = now.replace(hour=MMA_EXTRACTION_HOUR, minute=0, second=0, microsecond=0)
+    if extraction_time <= now:
+        extraction_time += timedelta(days=1)
+    return extraction_time
+
 
 # === Orchestration Loop ===
+trigger_attempts = {}  # patient_id -> failed or deferred triggers of the current review
+
+batch_loop = None  # event loop of the review batches, run by its own thread so the scheduler never waits on a batch
+
+def start_batch_loop():
+    global batch_loop
+    batch_loop = asyncio.new_event_loop()
+    threading.Thread(target=batch_loop.run_forever, daemon=True).start()
+
+def stop_batch_loop():
+    asyncio.run_coroutine_threadsafe(http_client.aclose(), batch_loop).result(timeout=5)  # the loop's shared client
+    batch_loop.call_soon_threadsafe(batch_loop.stop)
+
+async def run_review_batch(now, patient_ids) -> dict:
+    """Prefetches the patients' context and triggers SOA for them, on the batch loop."""
+    found = await prefetch_patient_context(patient_ids)
+    print(f"[{now}] Prefetched MMA context for {found}/{len(patient_ids)} patient(s).", flush=True)
+    return await fan_out_triggers(patient_ids, agent_to_trigger="SOA", turn_index=1)
+
+def submit_review_batch(now, patient_ids):
+    """Starts a review batch on the batch loop; its result is logged and rescheduled when it finishes."""
+    started = time.monotonic()
+
+    def finished(future):
+        try:
+            report = future.result()
+        except Exception as e:
+            print(f"[{now}] Review batch failed: {e!r}", flush=True)
+            report = {"triggered": [], "failed": list(patient_ids), "deferred": []}
+        print(
+            f"[{now}] Review batch done in {time.monotonic() - started:.1f}s: "
+            f"{len(report['triggered'])} triggered, {len(report['failed'])} failed, "
+            f"{len(report['deferred'])} deferred", flush=True
+        )
+        if report["failed"] or report["deferred"]:
+            print(f"Failed: {report['failed']} | Deferred: {report['deferred']}", flush=True)
+        reschedule_unfinished(datetime.now(), report)
+
+    asyncio.run_coroutine_threadsafe(run_review_batch(now, patient_ids), batch_loop).add_done_callback(finished)
+
+def reschedule_unfinished(now, report):
+    """Puts failed and deferred reviews back on the schedule, up to TRIGGER_RETRIES times each."""
+    for patient_id in report["triggered"]:
+        trigger_attempts.pop(patient_id, None)
+
+    retry_at = now + timedelta(seconds=TRIGGER_RETRY_DELAY)
+    retried, given_up = {}, []
+    for patient_id in report["failed"] + report["deferred"]:
+        attempts = trigger_attempts.get(patient_id, 0) + 1
+        if attempts > TRIGGER_RETRIES:
+            trigger_attempts.pop(patient_id, None)
+            given_up.append(patient_id)
+        elif scheduler.retry(patient_id, retry_at):
+            trigger_attempts[patient_id] = attempts
+            retried[patient_id] = retry_at
+        else:
+            trigger_attempts.pop(patient_id, None)  # a new review was scheduled meanwhile
+
+    if retried:
+        save_review_times(retried)
+        print(f"[{now}] Retrying {len(retried)} review(s) at {retry_at}: {', '.join(retried)}", flush=True)
+    if given_up:
+        print(f"[{now}] Giving up on {len(given_up)} review(s) after {TRIGGER_RETRIES} retries: {', '.join(given_up)}", flush=True)
+
 def orchestration_loop():
     time.sleep(1)
     print("OA started", flush=True)
 
-    while True:
-        now = datetime.now().replace(second=0, microsecond=0)
-        
-        # Checking if a review session needs to be started every hour
-        if now.minute == 0:
-            print(f"[{now}] Hourly check-in running...", flush=True)
+    next_extraction = next_extraction_time(datetime.now())
 
-            schedule = load_review_schedule()
-            for patient_id, info in schedule.get("patients", {}).items():
-                next_review_time = datetime.fromisoformat(info["next_review_time"])
-                if now.date() == next_review_time.date() and now.hour == next_review_time.hour:
-                    trigger_agent_sync(patient_id, turn_index=1, agent_to_trigger="SOA")
+    while True:
+        # Sleeps until the earliest review or the nightly MMA extraction, whichever comes first
+        scheduler.wait_until(next_extraction)
 
-            # Triggering MMA to extraxct new session notes once a day (at midnight)
-            if now.hour == 0:
-                print(f"[{now}] Extracting infos from new health coaching notes...", flush=True)
-                trigger_mma()
+        now, due_patients = scheduler.run_due()
+        if due_patients:
+            print(f"[{now}] Starting review sessions for {len(due_patients)} patient(s)...", flush=True)
+            submit_review_batch(now, due_patients)
 
-            time.sleep(600)
-        else:
-            time.sleep(10)
+        # Triggering MMA to extract new session notes once a day (at midnight)
+        if now >= next_extraction:
+            print(f"[{now}] Extracting infos from new health coaching notes...", flush=True)
+            trigger_mma()
+            next_extraction = next_extraction_time(now)
 
 
 # === API Endpoints ===
@@ -157,23 +496,20 @@ async def receive_new_sessions(request: Request):
     payload = await request.json()
     print(f"OA received new sessions for {len(payload)} patients.", flush=True)
 
-    schedule = load_review_schedule()
-    schedule.setdefault("patients", {})
-
+    review_times = {}
     for entry in payload:
         patient_id = entry.get("study_id")
         if not patient_id or not entry.get("date"):
             continue
         last_session_date = datetime.fromisoformat(entry["date"])
         next_review = last_session_date + timedelta(days=7)
-        next_review_time = next_review.replace(hour=9, minute=0, second=0, microsecond=0)
+        next_review_time = next_review.replace(hour=REVIEW_HOUR, minute=0, second=0, microsecond=0)
 
-        schedule["patients"][patient_id] = {
-            "next_review_time": next_review_time.isoformat()
-        }
+        review_times[patient_id] = next_review_time
+        scheduler.update(patient_id, next_review_time)
+        patient_contexts.pop(patient_id, None)  # MMA has new notes for this patient
 
-    with open(REVIEW_SCHEDULE_FILE, "w") as f:
-        json.dump(schedule, f, indent=2)
+    await asyncio.to_thread(save_review_times, review_times)
 
     print(f"OA memory updated for {len(payload)} patients.", flush=True)
     return {"status": "received", "patients": len(payload)}
@@ -196,10 +532,69 @@ async def receive_message(request: Request):
         ]
     }
 
-    save_message(message)
+    async with patient_locks.hold(patient_id):
+        await asyncio.to_thread(save_message, message)
+        partial_replies.pop(patient_id, None)
+        notify_new_message(patient_id)
+    if data.get("ttft_ms") is not None:
+        metrics.record_latency("reply time to first token", data["ttft_ms"] / 1000)
+        metrics.record_latency(f"turn {turn_index} time to first token", data["ttft_ms"] / 1000)
+    if turn_index == 1:
+        start_session(patient_id)
     print(f"Received message '{assistant_message}' from a HC for patient {patient_id} (turn {turn_index})", flush=True)
     return {"status": "ok"}
 
+@app.post("/receive_reply")
+async def receive_reply(request: Request):
+    """A patient's reply from the UI; stored here so it takes the same patient lock as the health coach messages."""
+    data = await request.json()
+    patient_id = data.get("patient_id")
+    turn_index = data.get("turn_index")
+    reply = data.get("reply")
+
+    if not patient_id or not reply or turn_index is None:
+        return {"status": "error", "reason": "Missing data"}
+
+    async with patient_locks.hold(patient_id):
+        await asyncio.to_thread(save_message, {
+            "patient_id": patient_id,
+            "turn_index": turn_index,
+            "chat_history": [{"role": "user", "content": reply}]
+        })
+        notify_new_message(patient_id)
+    return {"status": "ok"}
+
+@app.post("/receive_chunk")
+async def receive_chunk(request: Request):
+    """The text generated so far of a reply that is still streaming from an agent."""
+    data = await request.json()
+    patient_id = data.get("patient_id")
+    turn_index = data.get("turn_index")
+    text = data.get("text")
+
+    if not patient_id or text is None or turn_index is None:
+        return {"status": "error", "reason": "Missing data"}
+
+    # Chunks may arrive out of order; each one holds the whole text so far, so the longest wins
+    current = partial_replies.get(patient_id)
+    if current is None or current["turn_index"] != turn_index or len(text) > len(current["text"]):
+        partial_replies[patient_id] = {"turn_index": turn_index, "text": text}
+        notify_new_message(patient_id)
+    return {"status": "ok"}
+
+@app.get("/stream/{patient_id}")
+async def stream(patient_id: str, request: Request, after: int = 0, timeout: float = STREAM_MAX_DURATION):
+    """Server-sent events with every new message of the patient, starting after message id `after`."""
+    try:
+        after = int(request.headers.get("last-event-id", after))
+    except ValueError:
+        pass  # a malformed Last-Event-ID resumes from `after`
+    return StreamingResponse(
+        stream_messages(patient_id, after, min(timeout, STREAM_MAX_DURATION)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
 @app.post("/trigger_agent")
 async def trigger_agent(request: Request):
     data = await request.json()
@@ -214,11 +609,22 @@ async def trigger_agent(request: Request):
     if not agent_to_trigger:
         return {"status": "error", "reason": "Missing agent_to_trigger"}
 
-    return trigger_agent_sync(patient_id, turn_index, agent_to_trigger)
+    return await trigger_agent_async(patient_id, turn_index, agent_to_trigger)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return {**metrics.snapshot(), "breakers": resilience.breaker_states(), "patient_locks": patient_locks.stats()}
 
 
 # === Startup Background Thread ===
 @app.on_event("startup")
 def startup_event():
+    scheduler.load(load_review_schedule())
+    start_batch_loop()
     thread = threading.Thread(target=orchestration_loop, daemon=True)
     thread.start()
+
+@app.on_event("shutdown")
+def shutdown_event():
+    stop_batch_loop()
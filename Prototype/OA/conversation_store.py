@@ -0,0 +1,136 @@
+import json, sqlite3, threading
+from pathlib import Path
+
+
+class ConversationStore:
+    """Goal review conversations keyed by patient, stored in SQLite (WAL mode).
+
+    Messages are appended as individual rows, so saving a message costs the same
+    regardless of how many patients or messages are already stored, and reading
+    one patient's conversation only touches that patient's rows. WAL mode lets
+    the FastAPI app and the Streamlit UI read and write the same file concurrently.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                patient_id TEXT PRIMARY KEY,
+                turn_index INTEGER,
+                created_seq INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                patient_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT
+            );
+            CREATE INDEX IF NOT EXISTS messages_by_patient ON messages (patient_id, id);
+        """)
+
+    def _append(self, patient_id, messages, turn_index):
+        self.conn.execute(
+            "INSERT INTO conversations (patient_id, turn_index, created_seq) "
+            "VALUES (?, ?, (SELECT COALESCE(MAX(created_seq), 0) + 1 FROM conversations)) "
+            "ON CONFLICT (patient_id) DO UPDATE SET turn_index = COALESCE(excluded.turn_index, turn_index)",
+            (patient_id, turn_index)
+        )
+        self.conn.executemany(
+            "INSERT INTO messages (patient_id, role, content) VALUES (?, ?, ?)",
+            [(patient_id, m.get("role"), m.get("content")) for m in messages]
+        )
+
+    def append(self, patient_id: str, messages: list, turn_index: int = None):
+        """Appends `messages` to the patient's conversation and updates its turn index."""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._append(patient_id, messages, turn_index)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def load(self, patient_id: str):
+        """Returns `{"patient_id", "turn_index", "chat_history", "last_message_id"}`, or None if the patient has no conversation."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT turn_index FROM conversations WHERE patient_id = ?", (patient_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            messages = self.conn.execute(
+                "SELECT id, role, content FROM messages WHERE patient_id = ? ORDER BY id", (patient_id,)
+            ).fetchall()
+        record = {
+            "patient_id": patient_id,
+            "chat_history": [{"role": m["role"], "content": m["content"]} for m in messages],
+            "last_message_id": messages[-1]["id"] if messages else 0
+        }
+        if row["turn_index"] is not None:
+            record["turn_index"] = row["turn_index"]
+        return record
+
+    def messages_since(self, patient_id: str, after_id: int = 0) -> list:
+        """Messages of one patient with an id greater than `after_id`, oldest first, each with its `id`."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, role, content FROM messages WHERE patient_id = ? AND id > ? ORDER BY id",
+                (patient_id, after_id)
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def patient_ids(self) -> list:
+        """Patients with a conversation, in the order their conversations were started."""
+        with self.lock:
+            rows = self.conn.execute("SELECT patient_id FROM conversations ORDER BY created_seq").fetchall()
+        return [r["patient_id"] for r in rows]
+
+    def migrate_from_json(self, json_path: Path) -> int:
+        """Imports a legacy `goal_reviews.json` once, then renames it to `*.migrated`.
+
+        Patients that already have a conversation in the store are left untouched.
+        Returns the number of imported patients.
+        """
+        if not json_path.exists():
+            return 0
+        try:
+            with open(json_path) as f:
+                raw = json.load(f)
+        except json.JSONDecodeError:
+            print(f"Warning: {json_path} is not valid JSON. Skipping migration.", flush=True)
+            return 0
+
+        imported = 0
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for entry in raw:
+                    entry = json.loads(entry) if isinstance(entry, str) else entry
+                    patient_id = entry.get("patient_id")
+                    if not patient_id:
+                        continue
+                    exists = self.conn.execute(
+                        "SELECT 1 FROM conversations WHERE patient_id = ?", (patient_id,)
+                    ).fetchone()
+                    if exists:
+                        continue
+                    self._append(patient_id, entry.get("chat_history", []), entry.get("turn_index"))
+                    imported += 1
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+        try:
+            json_path.rename(json_path.with_name(json_path.name + ".migrated"))
+        except FileNotFoundError:
+            pass  # already migrated by the other process sharing this store
+        print(f"Migrated {imported} conversation(s) from {json_path} to {self.path}", flush=True)
+        return imported
@@ -1,7 +1,7 @@
 import streamlit as st
-import json, requests, threading, time, base64
-from pathlib import Path
-from app import save_message
+import json, threading, time, base64
+from app import conversations
+from common import http_client, resilience
 
 
 # === Configuration ===
@@ -10,8 +10,10 @@ MAX_TURNS = {"SOA": 6, "GRA": 13, "SCA": 15}
 SOA_URL = "http://soa:8000/receive_message"
 GRA_URL = "http://gra:8000/receive_message"
 SCA_URL = "http://sca:8000/receive_message"
+OA_STREAM_URL = "http://localhost:8000/stream"
+OA_REPLY_URL = "http://localhost:8000/receive_reply"  # replies are stored by OA, under its per-patient lock
 
-REVIEWS_FILE = Path("memory/goal_reviews.json")
+REPLY_WAIT = 60  # seconds to listen for a reply before re-running the page and listening again
 
 # === Page Setup ===
 icon = "icon.png"
@@ -32,22 +34,44 @@ st.markdown(f'''
 ''', unsafe_allow_html=True)
 
 
-# === Wait until conversation file exists ===
+# === Wait until a conversation exists ===
 waiting = st.empty()
-while not REVIEWS_FILE.exists():
+while not (patient_ids := conversations.patient_ids()):
     waiting.subheader("Waiting for health coach to start the session...")
     time.sleep(1)
 waiting.empty()
 
 # === Load Session State ===
-with open(REVIEWS_FILE) as f:
-    file_data = json.load(f)
-
-entry = file_data[0]
+entry = conversations.load(patient_ids[0])
 patient_id = entry.get("patient_id", "")
 turn_index = int(entry.get("turn_index", 1))
 chat_history = entry.get("chat_history", [])
 
+# === Reply Stream ===
+def wait_for_reply(patient_id, after_id, placeholder):
+    """Blocks until OA streams a new health coach message for the patient, or REPLY_WAIT runs out.
+
+    While the reply is being generated, the text so far is rendered into `placeholder`.
+    """
+    try:
+        with http_client.get(
+            f"{OA_STREAM_URL}/{patient_id}",
+            params={"after": after_id, "timeout": REPLY_WAIT},
+            stream=True,
+            timeout=(http_client.CONNECT_TIMEOUT, REPLY_WAIT + 30)
+        ) as response:
+            for event in http_client.iter_events(response):
+                data = json.loads(event["data"])
+                if event.get("event") == "partial":
+                    placeholder.markdown(f"**Health coach:** {data['text']}▌")
+                elif data.get("role") == "assistant":
+                    return True
+    except Exception as e:
+        print(f"Message stream failed: {e}")
+        time.sleep(1)
+    return False
+
+
 # === Display Chat ===
 #st.subheader("Conversation")
 for turn in chat_history:
@@ -81,34 +105,50 @@ with st.form("reply_form"):
 # === Submit Action ===
 if submitted and st.session_state.user_reply.strip():
     reply = st.session_state.user_reply.strip()
+    try:
+        response = http_client.post(OA_REPLY_URL, json={
+            "patient_id": patient_id,
+            "turn_index": turn_index,
+            "reply": reply
+        }, timeout=(http_client.CONNECT_TIMEOUT, 10))
+        saved = response.status_code == 200 and response.json().get("status") == "ok"
+    except Exception as e:
+        print(f"Saving reply failed: {e}")
+        saved = False
+    if not saved:
+        st.error("Your reply could not be sent. Please try again.")
+        st.stop()
     chat_history.append({"role": "user", "content": reply})
 
-    updated_record = {
-        "patient_id": patient_id,
-        "turn_index": turn_index,
-        "chat_history": [{"role": "user", "content": reply}]
-    }
-    save_message(updated_record)
-
     def notify_agent():
         payload = {
             "patient_id": patient_id,
             "turn_index": turn_index,
             "user_input": reply
         }
+        # The agent answers once the reply is generated; it arrives here through OA's message stream
+        resilience.start_deadline(resilience.TURN_BUDGET)
+        timeout = (http_client.CONNECT_TIMEOUT, resilience.TURN_BUDGET)
         try:
             if turn_index < MAX_TURNS["SOA"]:
-                requests.post(SOA_URL, json=payload, timeout=1)
+                http_client.post(SOA_URL, json=payload, timeout=timeout)
             elif turn_index < MAX_TURNS["GRA"]:
-                requests.post(GRA_URL, json=payload, timeout=1)
+                http_client.post(GRA_URL, json=payload, timeout=timeout)
             elif turn_index < MAX_TURNS["SCA"]:
-                requests.post(SCA_URL, json=payload, timeout=1)
+                http_client.post(SCA_URL, json=payload, timeout=timeout)
         except Exception as e:
             print(f"Send failed: {e}")
 
     threading.Thread(target=notify_agent, daemon=True).start()
 
-    # Trigger UI refresh
-    time.sleep(3)
+    # Trigger UI refresh; the reply is picked up from the message stream below
     st.query_params.update({"clear": "true"})
-    st.rerun()
\ No newline at end of file
+    st.rerun()
+
+# === Wait for Reply ===
+# While the patient spoke last, listen on OA's message stream and refresh as soon as the reply lands
+if chat_history and chat_history[-1]["role"] == "user" and not session_complete:
+    partial_reply = st.empty()
+    with st.spinner("Health coach is typing..."):
+        wait_for_reply(patient_id, entry.get("last_message_id", 0), partial_reply)
+    st.rerun()
@@ -1,66 +1,100 @@
 from pathlib import Path
-from openai import OpenAI
-import requests, json, threading
+import os, time, asyncio
 from datetime import datetime, timedelta
-from fastapi import FastAPI, Request  # type: ignore
+from fastapi import BackgroundTasks, FastAPI, Request  # type: ignore
+from common import http_client, locks, memory, metrics, llm, reply_stream, context, governor, resilience
 
 # === Configuration ===
 OA_URL = "http://oa:8000/receive_message"
 SSA_URL = "http://oa:8000/trigger_agent"
 
-MEMORY_FILE = Path("/app/memory/sca_conversations.json")
+MEMORY_PATH = Path("/app/memory/sca_conversations")  # see common/memory.py
+LEGACY_MEMORY_FILE = Path("/app/memory/sca_conversations.json")  # migrated on startup
 
 MODEL_NAME = "gpt-4.1"
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "1500"))  # per reply, see common/context.py
+
+OPENING_CACHE_TTL = 3600  # seconds a pre-generated opening stays usable
+
+# Sent when the opening cannot be generated, so the check-in still starts
+FALLBACK_OPENING = ("Thank you for joining this check-in session! "
+                    "Do you have any feedback or suggestions for how we could make these conversations better?")
 
 
 # === Initialization ===
 app = FastAPI()
-client = OpenAI()
+app.add_middleware(resilience.DeadlineMiddleware)  # applies the caller's X-Deadline-Ms to each request
+conversations = memory.open_store(MEMORY_PATH)
+conversations.migrate_from_json(LEGACY_MEMORY_FILE)
+patient_locks = locks.KeyedLock("patient")  # one turn or session start at a time per patient
 
 
 # === GPT Wrapper ===
-def ask_gpt(messages):
-    response = client.chat.completions.create(
-        model=MODEL_NAME,
-        messages=messages,
-        temperature=0.7,
-    )
-    return response.choices[0].message.content
+async def ask_gpt(messages):
+    return await llm.ask(messages, model=MODEL_NAME, temperature=0.7, priority="handoff")
 
 
-# === Memory Handlers ===
-def load_memory():
-    if not MEMORY_FILE.exists():
-        return []
-    with open(MEMORY_FILE) as f:
-        try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            print("Warning: Memory file is not valid JSON. Starting fresh.", flush=True)
-            return []
+# === Opening Generation ===
+async def generate_opening():
+    system_prompt = "You are a warm, empathetic health coach closing a session."
+    initial_prompt = [
+        {"role": "system", "content": system_prompt},
+        {"role": "assistant", "content": (
+            f"Thank the client for joining this check-in session. "
+            "Ask if they have any feedback or suggestions for how to improve these conversations."
+        )}
+    ]
 
-def save_message(new_record):
-    MEMORY_FILE.parent.mkdir(parents=True, exist_ok=True)
-    records = load_memory()
+    # GPT generation placeholder
+    assistant_reply = await ask_gpt(initial_prompt)
+    #assistant_reply = "Thank you for this session"
+    return assistant_reply
 
-    updated = False
-    for record in records:
-        if record.get("patient_id") == new_record.get("patient_id"):
-            if "chat_history" in new_record:
-                record["chat_history"] = new_record.get("chat_history", [])
-            updated = True
-            break
 
-    if not updated:
-        records.append(new_record)
+# === Opening Cache ===
+# patient_id -> {"session_id", "created", "task"}; the task resolves to generate_opening's result
+opening_cache = {}
 
-    with open(MEMORY_FILE, "w") as f:
-        json.dump(records, f, indent=2)
+async def take_cached_opening(patient_id, session_id):
+    """Returns the pre-generated opening for this session, or None if it is missing, stale or failed."""
+    entry = opening_cache.pop(patient_id, None)
+    if not entry:
+        return None
+    if not session_id or entry["session_id"] != session_id or time.monotonic() - entry["created"] > OPENING_CACHE_TTL:
+        entry["task"].cancel()  # a discarded generation must not keep running and hold an LLM slot
+        return None
+    try:
+        # Waits for the generation if the handoff arrives while it is still running
+        return await entry["task"]
+    except Exception as e:
+        print(f"Pre-generated opening for patient {patient_id} failed: {e}", flush=True)
+        return None
 
 
 # === API Endpoints ===
+@app.post("/pregenerate")
+async def pregenerate(request: Request):
+    data = await request.json()
+    patient_id = data.get("patient_id")
+    session_id = data.get("session_id")
+
+    if not patient_id or not session_id:
+        return {"status": "error", "reason": "Missing patient_id or session_id"}
+
+    previous = opening_cache.get(patient_id)
+    if previous:
+        previous["task"].cancel()
+
+    opening_cache[patient_id] = {
+        "session_id": session_id,
+        "created": time.monotonic(),
+        "task": asyncio.create_task(generate_opening())
+    }
+    print(f"SCA started pre-generating the opening for patient {patient_id}", flush=True)
+    return {"status": "pregenerating", "patient_id": patient_id}
+
 @app.post("/trigger")
-async def trigger(request: Request):
+async def trigger(request: Request, background_tasks: BackgroundTasks):
     data = await request.json()
     patient_id = data.get("patient_id")
     turn_index = data.get("turn_index")
@@ -70,29 +104,29 @@ async def trigger(request: Request):
 
     print(f"SCA was triggered to do weekly SMART goal review for patient {patient_id}", flush=True)
 
-    system_prompt = "You are a warm, empathetic health coach closing a session."
-    initial_prompt = [
-        {"role": "system", "content": system_prompt},
-        {"role": "assistant", "content": (
-            f"Thank the client for joining this check-in session. "
-            "Ask if they have any feedback or suggestions for how to improve these conversations."
-        )}
-    ]
-
-    # GPT generation placeholder
-    assistant_reply = ask_gpt(initial_prompt)
-    #assistant_reply = "Thank you for this session"
+    assistant_reply = await take_cached_opening(patient_id, data.get("session_id"))
+    if assistant_reply:
+        metrics.increment("opening cache hits")
+    else:
+        metrics.increment("opening cache misses")
+        try:
+            assistant_reply = await generate_opening()
+        except Exception as e:
+            print(f"Opening for patient {patient_id} failed, sending fallback: {e!r}", flush=True)
+            metrics.increment("opening fallbacks")
+            assistant_reply = FALLBACK_OPENING
+            resilience.clear_deadline()  # delivering the fallback must not fail on the deadline that caused it
 
     chat_history = [{"role": "assistant", "content": assistant_reply}]
 
-    save_message({
-        "patient_id": patient_id,
-        "chat_history": chat_history
-    })
+    async with patient_locks.hold(patient_id):
+        await asyncio.to_thread(conversations.update, patient_id, {
+            "chat_history": chat_history
+        })
 
-    def notify_oa():
+    async def notify_oa():
         try:
-            response = requests.post(OA_URL, json={
+            response = await http_client.apost(OA_URL, json={
                 "patient_id": patient_id,
                 "turn_index": turn_index,
                 "message": assistant_reply
@@ -101,12 +135,15 @@ async def trigger(request: Request):
         except Exception as e:
             print(f"Failed to notify OA: {e}", flush=True)
 
-    threading.Thread(target=notify_oa, daemon=True).start()
+    # Sent after the response so OA, which is waiting on this trigger, is free to receive the message
+    background_tasks.add_task(notify_oa)
 
     return {"status": "SCA triggered", "patient_id": patient_id}
 
 @app.post("/receive_message")
 async def receive_message(request: Request):
+    started = time.perf_counter()  # the patient has been waiting since their message arrived
+    resilience.start_deadline(resilience.TURN_BUDGET)
     data = await request.json()
     patient_id = data.get("patient_id")
     user_input = data.get("user_input")
@@ -117,8 +154,12 @@ async def receive_message(request: Request):
 
     print(f"Received '{user_input}' from {patient_id} (turn {turn_index})", flush=True)
 
-    records = load_memory()
-    patient_entry = next((r for r in records if r.get("patient_id") == patient_id), None)
+    async with patient_locks.hold(patient_id):
+        return await take_turn(patient_id, user_input, turn_index, started)
+
+async def take_turn(patient_id, user_input, turn_index, started):
+    """Reads the conversation, replies and saves both; runs under the patient's lock so turns never overwrite each other."""
+    patient_entry = await asyncio.to_thread(conversations.get, patient_id)
     if not patient_entry:
         return {"status": "error", "reason": "Patient session not found"}
 
@@ -139,19 +180,24 @@ async def receive_message(request: Request):
     )
 
     # GPT generation placeholder
-    full_prompt = [
-                {"role": "system", "content": "You are a warm, empathetic health coach closing a session."},
-                *chat_history,
-                {"role": "user", "content": assistant_prompt}
-            ]
-    assistant_reply = ask_gpt(full_prompt)
+    full_prompt = context.build_prompt(
+        "You are a warm, empathetic health coach closing a session.",
+        chat_history,
+        assistant_prompt,
+        budget=PROMPT_TOKEN_BUDGET
+    )
+    assistant_reply, ttft = await reply_stream.stream_reply(
+        patient_id, turn_index, full_prompt, model=MODEL_NAME, temperature=0.7, started=started,
+        fallback=f"Thank you for your feedback, we will take it into account. Your next weekly check-in will be on {next_review}. See you then!"
+    )
     #assistant_reply = assistant_prompt
     chat_history.append({"role": "assistant", "content": assistant_reply})
     try:
-        oa_response = requests.post(OA_URL, json={
+        oa_response = await http_client.apost(OA_URL, json={
             "patient_id": patient_id,
             "turn_index": turn_index,
-            "message": assistant_reply
+            "message": assistant_reply,
+            "ttft_ms": round(ttft * 1000)
         })
         if oa_response.status_code == 200:
             print(f"Sent HC message to OA for patient {patient_id} (turn {turn_index})", flush=True)
@@ -162,7 +208,7 @@ async def receive_message(request: Request):
 
     try:
         agent_to_trigger = "SSA"
-        oa_response = requests.post(SSA_URL, json={
+        oa_response = await http_client.apost(SSA_URL, json={
             "patient_id": patient_id,
             "turn_index": turn_index,
             "agent_to_trigger": agent_to_trigger
@@ -174,9 +220,12 @@ async def receive_message(request: Request):
     except Exception as e:
         print(f"Error triggering {agent_to_trigger} for patient {patient_id}: {e}", flush=True)
 
-    save_message({
-        "patient_id": patient_id,
+    await asyncio.to_thread(conversations.update, patient_id, {
         "chat_history": chat_history
     })
 
     return {"status": "message processed", "turn_index": turn_index}
+
+@app.get("/metrics")
+async def get_metrics():
+    return {**metrics.snapshot(), "llm_cache": llm.cache_stats(), "llm_governor": governor.stats(), "breakers": resilience.breaker_states(), "memory": conversations.stats(), "patient_locks": patient_locks.stats()}
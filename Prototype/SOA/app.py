@@ -1,61 +1,33 @@
-import requests, json
+import time, asyncio
 from pathlib import Path
-from openai import OpenAI
 from fastapi import FastAPI, Request  # type: ignore
+from common import http_client, locks, memory, metrics, llm, reply_stream, governor, resilience
 
 # === Configuration ===
 MMA_URL = "http://mma:8000/patient_notes"
 OA_URL = "http://oa:8000/receive_message"
 GRA_URL = "http://oa:8000/trigger_agent"
 
-MEMORY_FILE = Path("/app/memory/soa_conversations.json")
+MEMORY_PATH = Path("/app/memory/soa_conversations")  # see common/memory.py
+LEGACY_MEMORY_FILE = Path("/app/memory/soa_conversations.json")  # migrated on startup
 
 MODEL_NAME = "gpt-4.1"
 
+# Sent when the opening cannot be generated, so the session still starts
+FALLBACK_OPENING = "Hi {name}, it's good to see you! How would you rate your energy level today?"
+
 
 # === Initialization ===
 app = FastAPI()
-client = OpenAI()
+app.add_middleware(resilience.DeadlineMiddleware)  # applies the caller's X-Deadline-Ms to each request
+conversations = memory.open_store(MEMORY_PATH)
+conversations.migrate_from_json(LEGACY_MEMORY_FILE)
+patient_locks = locks.KeyedLock("patient")  # one turn or session start at a time per patient
 
 
 # === GPT Wrapper ===
-def ask_gpt(messages):
-    response = client.chat.completions.create(
-        model=MODEL_NAME,
-        messages=messages,
-        temperature=0.7,
-    )
-    return response.choices[0].message.content
-
-
-# === Memory Handlers ===
-def load_memory():
-    if not MEMORY_FILE.exists():
-        return []
-    with open(MEMORY_FILE) as f:
-        try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            print("Warning: Could not decode memory file. Returning empty list.", flush=True)
-            return []
-
-def save_message(new_record):
-    MEMORY_FILE.parent.mkdir(parents=True, exist_ok=True)
-    records = load_memory()
-
-    updated = False
-    for record in records:
-        if record.get("patient_id") == new_record.get("patient_id"):
-            if "chat_history" in new_record:
-                record["chat_history"] = new_record.get("chat_history", [])
-            updated = True
-            break
-
-    if not updated:
-        records.append(new_record)
-
-    with open(MEMORY_FILE, "w") as f:
-        json.dump(records, f, indent=2)
+async def ask_gpt(messages):
+    return await llm.ask(messages, model=MODEL_NAME, temperature=0.7, priority="handoff")
 
 
 # === API Endpoints ===
@@ -68,17 +40,24 @@ async def trigger(request: Request):
 
     print(f"SOA was triggered to do weekly SMART goal review for patient {patient_id}", flush=True)
 
-    try:
-        response = requests.get(f"{MMA_URL}/{patient_id}")
-        if response.status_code == 200:
-            notes = response.json()
-            print(f"Retrieved {notes} from MMA for patient {patient_id}", flush=True)
-        else:
-            print(f"Failed to fetch notes from MMA (status {response.status_code})", flush=True)
-            return {"status": "failed", "reason": "MMA fetch error"}
-    except Exception as e:
-        print(f"Error contacting MMA: {e}", flush=True)
-        return {"status": "failed", "reason": str(e)}
+    context = data.get("patient_context")
+    if context:
+        # Prefetched by OA for the review batch
+        metrics.increment("patient context prefetched")
+        notes = context.get("profile", {})
+    else:
+        metrics.increment("patient context fetched from MMA")
+        try:
+            response = await http_client.aget(f"{MMA_URL}/{patient_id}")
+            if response.status_code == 200:
+                notes = response.json()
+                print(f"Retrieved {notes} from MMA for patient {patient_id}", flush=True)
+            else:
+                print(f"Failed to fetch notes from MMA (status {response.status_code})", flush=True)
+                return {"status": "failed", "reason": "MMA fetch error"}
+        except Exception as e:
+            print(f"Error contacting MMA: {e}", flush=True)
+            return {"status": "failed", "reason": str(e)}
 
     preferred_name = notes.get("preferred_name")
 
@@ -89,19 +68,25 @@ async def trigger(request: Request):
     ]
 
     # GPT generation placeholder
-    assistant_reply = ask_gpt(initial_prompt)
+    try:
+        assistant_reply = await ask_gpt(initial_prompt)
+    except Exception as e:
+        print(f"Opening for patient {patient_id} failed, sending fallback: {e!r}", flush=True)
+        metrics.increment("opening fallbacks")
+        assistant_reply = FALLBACK_OPENING.format(name=preferred_name or "there")
+        resilience.clear_deadline()  # delivering the fallback must not fail on the deadline that caused it
     #assistant_reply = "Hi there, what is your energy level?"
 
     chat_history = [{"role": "assistant", "content": assistant_reply}]
 
-    save_message({
-        "patient_id": patient_id,
-        "notes": notes,
-        "chat_history": chat_history
-    })
+    async with patient_locks.hold(patient_id):
+        await asyncio.to_thread(conversations.update, patient_id, {
+            "notes": notes,
+            "chat_history": chat_history
+        })
 
     try:
-        oa_response = requests.post(OA_URL, json={
+        oa_response = await http_client.apost(OA_URL, json={
             "patient_id": patient_id,
             "turn_index": 1,
             "message": assistant_reply
@@ -117,6 +102,8 @@ async def trigger(request: Request):
 
 @app.post("/receive_message")
 async def receive_message(request: Request):
+    started = time.perf_counter()  # the patient has been waiting since their message arrived
+    resilience.start_deadline(resilience.TURN_BUDGET)
     data = await request.json()
     patient_id = data.get("patient_id")
     user_input = data.get("user_input")
@@ -127,8 +114,12 @@ async def receive_message(request: Request):
 
     print(f"Received '{user_input}' from {patient_id} (turn {turn_index})", flush=True)
 
-    records = load_memory()
-    patient_entry = next((r for r in records if r.get("patient_id") == patient_id), None)
+    async with patient_locks.hold(patient_id):
+        return await take_turn(patient_id, user_input, turn_index, started)
+
+async def take_turn(patient_id, user_input, turn_index, started):
+    """Reads the conversation, replies and saves both; runs under the patient's lock so turns never overwrite each other."""
+    patient_entry = await asyncio.to_thread(conversations.get, patient_id)
     if not patient_entry:
         return {"status": "error", "reason": "Patient session not found"}
 
@@ -170,14 +161,17 @@ async def receive_message(request: Request):
                 *chat_history,
                 {"role": "user", "content": assistant_prompt}
             ]
-        assistant_reply = ask_gpt(full_prompt)
+        assistant_reply, ttft = await reply_stream.stream_reply(
+            patient_id, turn_index, full_prompt, model=MODEL_NAME, temperature=0.7, started=started
+        )
         #assistant_reply = assistant_prompt
         chat_history.append({"role": "assistant", "content": assistant_reply})
         try:
-            oa_response = requests.post(OA_URL, json={
+            oa_response = await http_client.apost(OA_URL, json={
                 "patient_id": patient_id,
                 "turn_index": turn_index,
-                "message": assistant_reply
+                "message": assistant_reply,
+                "ttft_ms": round(ttft * 1000)
             })
             if oa_response.status_code == 200:
                 print(f"Sent HC message to OA for patient {patient_id} (turn {turn_index})", flush=True)
@@ -188,7 +182,7 @@ async def receive_message(request: Request):
     elif turn_index == 6:
         agent_to_trigger = "GRA"
         try:
-            oa_response = requests.post(GRA_URL, json={
+            oa_response = await http_client.apost(GRA_URL, json={
                 "patient_id": patient_id,
                 "turn_index": turn_index,
                 "agent_to_trigger": agent_to_trigger
@@ -200,9 +194,12 @@ async def receive_message(request: Request):
         except Exception as e:
             print(f"Error triggering {agent_to_trigger} for patient {patient_id}: {e}", flush=True)
 
-    save_message({
-        "patient_id": patient_id,
+    await asyncio.to_thread(conversations.update, patient_id, {
         "chat_history": chat_history
     })
 
     return {"status": "message processed", "turn_index": turn_index}
+
+@app.get("/metrics")
+async def get_metrics():
+    return {**metrics.snapshot(), "llm_cache": llm.cache_stats(), "llm_governor": governor.stats(), "breakers": resilience.breaker_states(), "memory": conversations.stats(), "patient_locks": patient_locks.stats()}
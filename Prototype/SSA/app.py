@@ -1,60 +1,84 @@
-import json
+import os, json, time, uuid, asyncio
 from pathlib import Path
-from openai import OpenAI
 from fastapi import FastAPI, Request # type: ignore
+from fastapi.responses import JSONResponse  # type: ignore
+from common import memory, metrics, llm, governor, resilience
 
 # === Configuration ===
-SUMMARY_FILE = Path("memory/session_summaries.json")
+SUMMARY_PATH = Path("memory/session_summaries")  # see common/memory.py
+LEGACY_SUMMARY_FILE = Path("memory/session_summaries.json")  # migrated on startup
+QUEUE_DIR = Path("memory/summary_queue")  # one file per job until its summary is saved
+FAILED_DIR = QUEUE_DIR / "failed"  # jobs out of retries; move a file back to QUEUE_DIR to retry it on restart
 
 MODEL_NAME = "gpt-4.1"
 
+SUMMARY_WORKERS = int(os.getenv("SSA_SUMMARY_WORKERS", "4"))
+SUMMARY_RETRIES = int(os.getenv("SSA_SUMMARY_RETRIES", "3"))
+RETRY_BACKOFF = 2  # seconds before the first retry, doubled on every further one
+JOB_RETENTION = 24 * 3600  # seconds a finished job stays visible in GET /jobs/{job_id}
+
 
 # === Initialization ===
 app = FastAPI()
-client = OpenAI()
+app.add_middleware(resilience.DeadlineMiddleware)  # applies the caller's X-Deadline-Ms to each request
+summaries = memory.open_store(SUMMARY_PATH)  # each patient's summaries under "sessions", oldest first
+summaries.migrate_from_json(LEGACY_SUMMARY_FILE, group="sessions")
 
 
 # === GPT Wrapper ===
-def ask_gpt(messages):
-    response = client.chat.completions.create(
-        model=MODEL_NAME,
-        messages=messages,
-        temperature=0.7
-    )
-    return response.choices[0].message.content
+async def ask_gpt(messages):
+    return await llm.ask(messages, model=MODEL_NAME, temperature=0.7, priority="summary")
 
 
 # === Memory Handlers ===
-def save_summary_to_file(patient_id, chat_history, summary):
-    if SUMMARY_FILE.exists():
-        with open(SUMMARY_FILE) as f:
-            summaries = json.load(f)
-    else:
-        summaries = []
-
-    summaries.append({
-        "patient_id": patient_id,
-        "chat_history": chat_history,
-        "summary": summary
-    })
-
-    SUMMARY_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with open(SUMMARY_FILE, "w") as f:
-        json.dump(summaries, f, indent=2)
-
+def save_summary(patient_id, chat_history, summary):
+    summaries.append(patient_id, "sessions", {"chat_history": chat_history, "summary": summary})
     print(f"Session summary for {patient_id} saved", flush=True)
 
 
-# === API Endpoints ===
-@app.post("/trigger")
-async def trigger(request: Request):
-    data = await request.json()
-    chat_history = data.get("chat_history", [])
-    patient_id = data.get("patient_id")
-
-    if not patient_id or not chat_history:
-        return {"status": "error", "reason": "Missing patient_id or chat_history"}
-
+# === Summary Queue ===
+# Jobs are spooled to QUEUE_DIR before /trigger answers, so a restart picks up where it left off
+queue = None  # asyncio.Queue of job ids, created on startup
+jobs = {}  # job_id -> job; the chat history is dropped once the summary is saved
+pending_tasks = set()  # workers and delayed retries, kept referenced while they run
+
+def spool_job(job):
+    QUEUE_DIR.mkdir(parents=True, exist_ok=True)
+    path = QUEUE_DIR / f"{job['job_id']}.json"
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump({k: job[k] for k in ("job_id", "patient_id", "chat_history", "queued_at")}, f)
+    tmp.replace(path)
+
+def unspool_job(job_id, failed=False):
+    path = QUEUE_DIR / f"{job_id}.json"
+    if failed:
+        FAILED_DIR.mkdir(parents=True, exist_ok=True)
+        path.replace(FAILED_DIR / path.name)
+    else:
+        path.unlink(missing_ok=True)
+
+def load_spooled_jobs():
+    spooled = []
+    for path in QUEUE_DIR.glob("*.json"):
+        try:
+            with open(path) as f:
+                spooled.append(json.load(f))
+        except json.JSONDecodeError:
+            print(f"Warning: {path} is not valid JSON. Skipping it.", flush=True)
+    return sorted(spooled, key=lambda job: job["queued_at"])
+
+def enqueue(job):
+    job.update(status="queued", attempts=0, error=None, finished_at=None)
+    jobs[job["job_id"]] = job
+    queue.put_nowait(job["job_id"])
+
+async def retry_later(job_id, delay):
+    await asyncio.sleep(delay)
+    jobs[job_id]["status"] = "queued"
+    queue.put_nowait(job_id)
+
+async def summarize(patient_id, chat_history):
     # Format chat history
     summary_input = "Here is the full conversation between the health coach and the patient:\n\n"
     for turn in chat_history:
@@ -67,10 +91,115 @@ async def trigger(request: Request):
         {"role": "system", "content": "You are a summarization assistant for health coaching conversations."},
         {"role": "user", "content": summary_input}
     ]
-    summary = ask_gpt(messages)
+    summary = await ask_gpt(messages)
     #summary = "This is summary!"
+    return summary
+
+async def worker():
+    while True:
+        job_id = await queue.get()
+        job = jobs[job_id]
+        if job["attempts"] == 0:
+            metrics.record_latency("summary queue wait", time.time() - job["queued_at"])
+        job["status"] = "running"
+        started = time.perf_counter()
+        try:
+            summary = await summarize(job["patient_id"], job["chat_history"])
+            await asyncio.to_thread(save_summary, job["patient_id"], job["chat_history"], summary)
+        except Exception as e:
+            job["attempts"] += 1
+            job["error"] = repr(e)
+            if job["attempts"] > SUMMARY_RETRIES:
+                print(f"Summary for {job['patient_id']} failed after {job['attempts']} attempts: {e!r}", flush=True)
+                metrics.increment("summaries failed")
+                try:
+                    await asyncio.to_thread(unspool_job, job_id, True)
+                except Exception as move_error:
+                    print(f"Failed to move summary job {job_id} to {FAILED_DIR}: {move_error!r}", flush=True)
+                job.update(status="failed", finished_at=time.time())
+                job.pop("chat_history")
+            else:
+                delay = RETRY_BACKOFF * 2 ** (job["attempts"] - 1)
+                print(f"Summary for {job['patient_id']} failed ({e!r}), retrying in {delay}s", flush=True)
+                metrics.increment("summary retries")
+                job["status"] = "retrying"
+                task = asyncio.create_task(retry_later(job_id, delay))
+                pending_tasks.add(task)
+                task.add_done_callback(pending_tasks.discard)
+        else:
+            # The summary is saved, so a failure from here on must not summarize the session again
+            try:
+                await asyncio.to_thread(unspool_job, job_id)
+            except Exception as e:
+                print(f"Failed to remove spooled summary job {job_id}, remove it before restarting: {e!r}", flush=True)
+            metrics.record_latency("summary generation", time.perf_counter() - started)
+            metrics.increment("summaries done")
+            job.update(status="done", finished_at=time.time())
+            job.pop("chat_history")
+        finally:
+            queue.task_done()
+
+def backlog() -> dict:
+    now = time.time()
+    for job_id in [j["job_id"] for j in jobs.values() if j["finished_at"] and now - j["finished_at"] > JOB_RETENTION]:
+        del jobs[job_id]
+    waiting = [j for j in jobs.values() if j["status"] in ("queued", "retrying")]
+    counts = {status: 0 for status in ("queued", "running", "retrying", "done", "failed")}
+    for job in jobs.values():
+        counts[job["status"]] += 1
+    return {
+        "workers": SUMMARY_WORKERS,
+        **counts,
+        "oldest_waiting_s": round(now - min(j["queued_at"] for j in waiting), 1) if waiting else None
+    }
+
+
+# === API Endpoints ===
+@app.post("/trigger")
+async def trigger(request: Request):
+    """Queues the session for summarization and returns 202 with the job id."""
+    data = await request.json()
+    chat_history = data.get("chat_history", [])
+    patient_id = data.get("patient_id")
 
-    # Save to file
-    save_summary_to_file(patient_id, chat_history, summary)
+    if not patient_id or not chat_history:
+        return {"status": "error", "reason": "Missing patient_id or chat_history"}
+
+    job = {"job_id": uuid.uuid4().hex, "patient_id": patient_id, "chat_history": chat_history, "queued_at": time.time()}
+    await asyncio.to_thread(spool_job, job)
+    enqueue(job)
+    print(f"Queued session summary for {patient_id} (job {job['job_id']}, {queue.qsize()} waiting)", flush=True)
+    return JSONResponse(
+        {"status": "queued", "job_id": job["job_id"], "status_url": f"/jobs/{job['job_id']}"},
+        status_code=202
+    )
 
-    return {"status": "ok", "summary": summary}
\ No newline at end of file
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse({"status": "error", "reason": f"Unknown job {job_id}"}, status_code=404)
+    return {k: v for k, v in job.items() if k != "chat_history"}
+
+@app.get("/queue")
+async def get_queue():
+    return backlog()
+
+@app.get("/metrics")
+async def get_metrics():
+    return {**metrics.snapshot(), "llm_cache": llm.cache_stats(), "llm_governor": governor.stats(), "breakers": resilience.breaker_states(), "memory": summaries.stats(), "summary_queue": backlog()}
+
+
+# === Startup ===
+@app.on_event("startup")
+async def startup_event():
+    global queue
+    queue = asyncio.Queue()
+    spooled = await asyncio.to_thread(load_spooled_jobs)
+    for job in spooled:
+        enqueue(job)
+    if spooled:
+        print(f"Re-queued {len(spooled)} session summaries from {QUEUE_DIR}", flush=True)
+    for _ in range(SUMMARY_WORKERS):
+        task = asyncio.create_task(worker())
+        pending_tasks.add(task)
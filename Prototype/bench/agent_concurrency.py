@@ -0,0 +1,74 @@
+"""Throughput of one agent process under concurrent patient turns.
+
+Sends `-n` POST requests to an agent endpoint with at most `-c` in flight and
+reports requests/s and latency percentiles. Run it once against a build where the
+agents block the event loop and once against the async build to compare, e.g.
+
+    python bench/agent_concurrency.py http://localhost:8005/trigger -n 100 -c 20
+
+The default payload is a short SSA conversation, since SSA /trigger is stateless.
+Point OPENAI_BASE_URL at a stub server to benchmark without spending API credits.
+"""
+import sys, json, time, asyncio, argparse
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from common import metrics
+
+DEFAULT_PAYLOAD = {
+    "patient_id": "bench_patient",
+    "chat_history": [
+        {"role": "assistant", "content": "Hi! How is your energy level today?"},
+        {"role": "user", "content": "Pretty good, I walked three times this week."},
+        {"role": "assistant", "content": "That's great to hear. Thank you for joining today!"}
+    ]
+}
+
+
+async def run(url, payload, n, concurrency, timeout):
+    semaphore = asyncio.Semaphore(concurrency)
+    samples, errors = [], 0
+
+    async def one(client, i):
+        nonlocal errors
+        body = dict(payload, patient_id=f"{payload.get('patient_id', 'bench_patient')}_{i}")
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.post(url, json=body)
+                response.raise_for_status()
+                samples.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(one(client, i) for i in range(n)))
+        elapsed = time.perf_counter() - started
+
+    return elapsed, samples, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("url", help="agent endpoint, e.g. http://localhost:8005/trigger")
+    parser.add_argument("-n", type=int, default=100, help="total requests (default: 100)")
+    parser.add_argument("-c", "--concurrency", type=int, default=20, help="requests in flight (default: 20)")
+    parser.add_argument("--payload", help="JSON file with the request body (default: a short SSA conversation)")
+    parser.add_argument("--timeout", type=float, default=300, help="per-request timeout in seconds (default: 300)")
+    args = parser.parse_args()
+
+    payload = json.loads(Path(args.payload).read_text()) if args.payload else DEFAULT_PAYLOAD
+    elapsed, samples, errors = asyncio.run(run(args.url, payload, args.n, args.concurrency, args.timeout))
+
+    stats = metrics.summarize(samples)
+    print(f"{args.n} requests, concurrency {args.concurrency}: {elapsed:.2f}s, "
+          f"{len(samples) / elapsed:.2f} req/s, {errors} errors")
+    print(f"latency p50={stats['p50_ms']} ms  p95={stats['p95_ms']} ms  p99={stats['p99_ms']} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Side-by-side comparison of two bench/loadgen.py reports, e.g. of two builds replaying one cassette.
+
+    python bench/compare_runs.py before.json after.json
+
+For every run name present in both files, it prints wall time, throughput and the
+p50/p95 latency of each turn and hop, with the change from the first report to the
+second.
+"""
+import sys, json, argparse
+
+
+def change(before, after):
+    if before is None or after is None:
+        return ""
+    if not before:
+        return "n/a"
+    return f"{100 * (after - before) / before:+.1f}%"
+
+def compare(name, before, after):
+    print(f"\n=== {name} ===")
+    print(f"{'':<40} {'before':>10} {'after':>10} {'change':>8}")
+    for field in ("elapsed_s", "sessions_per_min", "turns_per_s", "error_rate"):
+        b, a = before.get(field), after.get(field)
+        print(f"{field:<40} {b!s:>10} {a!s:>10} {change(b, a):>8}")
+    for section in ("turns", "hops"):
+        labels = list(before.get(section, {})) + [l for l in after.get(section, {}) if l not in before.get(section, {})]
+        for label in labels:
+            for stat in ("p50_ms", "p95_ms"):
+                b = before.get(section, {}).get(label, {}).get(stat)
+                a = after.get(section, {}).get(label, {}).get(stat)
+                print(f"{label + ' ' + stat[:3]:<40} {b!s:>10} {a!s:>10} {change(b, a):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before", help="loadgen.py --out report of the baseline build")
+    parser.add_argument("after", help="loadgen.py --out report of the build under test")
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    shared = [name for name in before if name in after]
+    if not shared:
+        sys.exit(f"No run in common between {args.before} ({', '.join(before)}) and {args.after} ({', '.join(after)})")
+    for name in shared:
+        compare(name, before[name], after[name])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""Per-hop latency of a fresh connection per call vs. the pooled keep-alive session.
+
+With the compose stack running, point it at any GET endpoint, e.g.
+
+    python bench/http_keepalive.py http://localhost:8001/patient_notes/patient_1
+
+Inside the stack, every service also reports its own per-hop latencies at GET /metrics.
+"""
+import sys, time, argparse
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from common import http_client, metrics
+
+
+def run(label, call, url, n):
+    samples = []
+    for _ in range(n):
+        started = time.perf_counter()
+        call(url, timeout=10).raise_for_status()
+        samples.append(time.perf_counter() - started)
+    stats = metrics.summarize(samples)
+    print(f"{label:<22} p50={stats['p50_ms']:>8} ms  p95={stats['p95_ms']:>8} ms  mean={stats['mean_ms']:>8} ms")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("url", help="GET endpoint to call, e.g. http://mma:8000/patient_notes/patient_1")
+    parser.add_argument("-n", type=int, default=200, help="requests per mode (default: 200)")
+    args = parser.parse_args()
+
+    http_client.get(args.url, timeout=10)  # warm the pool so the first pooled call doesn't pay the handshake
+
+    fresh = run("fresh connection", requests.get, args.url, args.n)
+    pooled = run("pooled keep-alive", http_client.get, args.url, args.n)
+    print(f"saved per hop: p50={fresh['p50_ms'] - pooled['p50_ms']:.2f} ms, mean={fresh['mean_ms'] - pooled['mean_ms']:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
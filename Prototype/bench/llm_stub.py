@@ -0,0 +1,198 @@
+"""Offline stand-in for the OpenAI chat completions API, for load tests without API spend.
+
+Answers POST /v1/chat/completions, both streamed and not, and tool calls, whose
+arguments are filled in from the tool's JSON schema. The latency of each call is a
+time to first token drawn from a distribution, plus the completion tokens at a
+fixed generation rate. A fraction of calls can fail with HTTP 500 or 429.
+
+Point the services at it with OPENAI_BASE_URL=http://<host>:<port>/v1 (see
+docker-compose.bench.yml), or run it on the host (needs fastapi and uvicorn):
+
+    python bench/llm_stub.py --port 8010 --ttft lognormal:400,0.5 --error-rate 0.02
+
+Settings come from the command line or the environment (STUB_TTFT_MS,
+STUB_TOKENS_PER_S, STUB_COMPLETION_TOKENS, STUB_ERROR_RATE, STUB_RATE_LIMIT_RATE,
+STUB_SEED). They can be changed at runtime with POST /stub/config, which also
+resets the request counters returned by GET /stub/config.
+
+Latency distributions, in milliseconds: "400" (fixed), "uniform:200,800" or
+"lognormal:400,0.5" (median and sigma).
+"""
+import os, json, math, time, random, asyncio, argparse
+
+from fastapi import FastAPI, Request  # type: ignore
+from fastapi.responses import JSONResponse, StreamingResponse  # type: ignore
+
+# === Configuration ===
+DEFAULTS = {
+    "ttft_ms": os.getenv("STUB_TTFT_MS", "lognormal:400,0.5"),
+    "tokens_per_s": float(os.getenv("STUB_TOKENS_PER_S", "60")),
+    "completion_tokens": int(os.getenv("STUB_COMPLETION_TOKENS", "60")),
+    "error_rate": float(os.getenv("STUB_ERROR_RATE", "0")),
+    "rate_limit_rate": float(os.getenv("STUB_RATE_LIMIT_RATE", "0")),
+    "seed": int(os.getenv("STUB_SEED", "0"))
+}
+CHUNK_INTERVAL = 0.05  # seconds between streamed chunks
+
+WORDS = ("thank you for sharing that with me it sounds like the past week had some real wins "
+         "what helped you most on the days when it felt harder to keep going").split()
+# Tool call string fields whose stub value must survive the services' own checks, e.g.
+# MMA drops goals of three words or fewer
+FIELD_VALUES = {
+    "goals": "Walk 30 minutes after dinner on Monday, Wednesday and Friday",
+    "preferred_name": "Sam"
+}
+
+
+def parse_distribution(spec: str):
+    """A sampler `rng -> seconds` for a latency distribution given in milliseconds."""
+    kind, _, args = str(spec).partition(":")
+    if not args:
+        value = float(kind) / 1000
+        return lambda rng: value
+    params = [float(p) for p in args.split(",")]
+    if kind == "uniform" and len(params) == 2:
+        low, high = params[0] / 1000, params[1] / 1000
+        return lambda rng: rng.uniform(low, high)
+    if kind == "lognormal" and len(params) == 2:
+        mu, sigma = math.log(params[0] / 1000), params[1]
+        return lambda rng: rng.lognormvariate(mu, sigma)
+    raise ValueError(f"Unknown latency distribution '{spec}'")
+
+
+# === State ===
+config = {}
+stats = {}
+rng = random.Random()
+sample_ttft = None
+
+def configure(**changes):
+    global sample_ttft
+    updated = {**DEFAULTS, **config, **{k: v for k, v in changes.items() if v is not None}}
+    unknown = set(updated) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown settings: {sorted(unknown)}")
+    sample_ttft = parse_distribution(updated["ttft_ms"])
+    config.clear()
+    config.update(updated)
+    rng.seed(config["seed"])
+    stats.update({"requests": 0, "streamed": 0, "tool_calls": 0, "injected_errors": 0, "injected_rate_limits": 0})
+
+configure()
+
+
+# === Fake Responses ===
+def fake_value(schema: dict, name: str = "value"):
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: fake_value(sub, key) for key, sub in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [fake_value(schema.get("items", {}), name)]
+    if kind in ("integer", "number"):
+        return 1
+    if kind == "boolean":
+        return True
+    if "enum" in schema:
+        return schema["enum"][0]
+    return FIELD_VALUES.get(name, f"stub {name.replace('_', ' ')}")
+
+def fake_text(tokens: int) -> list:
+    """`tokens` words, one token each."""
+    return [WORDS[i % len(WORDS)] for i in range(tokens)]
+
+def count_tokens(messages: list) -> int:
+    return sum(len(str(m.get("content") or "")) for m in messages) // 4
+
+def error_response(status: int, message: str, kind: str):
+    headers = {"retry-after": "1"} if status == 429 else None
+    return JSONResponse({"error": {"message": message, "type": kind}}, status_code=status, headers=headers)
+
+
+# === API ===
+app = FastAPI()
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+
+    roll = rng.random()
+    if roll < config["error_rate"]:
+        stats["injected_errors"] += 1
+        return error_response(500, "Injected server error", "server_error")
+    if roll < config["error_rate"] + config["rate_limit_rate"]:
+        stats["injected_rate_limits"] += 1
+        return error_response(429, "Injected rate limit", "rate_limit_exceeded")
+
+    ttft = sample_ttft(rng)
+    tokens = config["completion_tokens"]
+    usage = {"prompt_tokens": count_tokens(body.get("messages", [])), "completion_tokens": tokens}
+    usage["total_tokens"] = usage["prompt_tokens"] + tokens
+    base = {"id": f"stub-{stats['requests']}", "created": int(time.time()), "model": body.get("model", "stub")}
+
+    if body.get("stream"):
+        stats["streamed"] += 1
+        words = fake_text(tokens)
+        per_chunk = max(1, round(config["tokens_per_s"] * CHUNK_INTERVAL))
+
+        async def events():
+            await asyncio.sleep(ttft)
+            for i in range(0, len(words), per_chunk):
+                text = " ".join(words[i:i + per_chunk]) + " "
+                chunk = {**base, "object": "chat.completion.chunk",
+                         "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(per_chunk / config["tokens_per_s"])
+            done = {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            yield f"data: {json.dumps(done)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    await asyncio.sleep(ttft + tokens / config["tokens_per_s"])
+    message = {"role": "assistant", "content": " ".join(fake_text(tokens))}
+    if body.get("tools"):
+        stats["tool_calls"] += 1
+        function = body["tools"][0]["function"]
+        arguments = fake_value(function.get("parameters", {}))
+        message = {"role": "assistant", "content": None, "tool_calls": [{
+            "id": f"call-{stats['requests']}", "type": "function",
+            "function": {"name": function["name"], "arguments": json.dumps(arguments)}
+        }]}
+    return {**base, "object": "chat.completion", "usage": usage,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": message}]}
+
+@app.get("/stub/config")
+def get_config():
+    return {"config": config, "stats": stats}
+
+@app.post("/stub/config")
+async def set_config(request: Request):
+    try:
+        configure(**await request.json())
+    except (ValueError, TypeError) as e:
+        return JSONResponse({"status": "error", "reason": str(e)}, status_code=400)
+    print(f"Stub reconfigured: {config}", flush=True)
+    return {"status": "ok", "config": config}
+
+
+def main():
+    import uvicorn  # type: ignore
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--ttft", dest="ttft_ms", help=f"time to first token in ms (default: {DEFAULTS['ttft_ms']})")
+    parser.add_argument("--tokens-per-s", type=float, help=f"generation rate (default: {DEFAULTS['tokens_per_s']:g})")
+    parser.add_argument("--completion-tokens", type=int, help=f"tokens per reply (default: {DEFAULTS['completion_tokens']})")
+    parser.add_argument("--error-rate", type=float, help="fraction of calls answered with HTTP 500")
+    parser.add_argument("--rate-limit-rate", type=float, help="fraction of calls answered with HTTP 429")
+    parser.add_argument("--seed", type=int, help="random seed for latencies and injected errors")
+    args = vars(parser.parse_args())
+    host, port = args.pop("host"), args.pop("port")
+    configure(**args)
+    uvicorn.run(app, host=host, port=port)
+
+
+if __name__ == "__main__":
+    main()
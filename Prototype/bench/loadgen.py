@@ -0,0 +1,274 @@
+"""End-to-end load test of the weekly review: simulated patients through SOA -> GRA -> SCA -> SSA.
+
+Each patient gets a synthetic session note, extracted by MMA, and a review started
+through SOA /trigger. The patient then answers every health coach message like the
+Streamlit UI does: the reply is stored through OA's /receive_reply, then sent to the
+agent's /receive_message, and the next message is awaited on OA's /stream. The last
+reply (turn 13) also makes SCA hand the session to SSA for the summary.
+
+Reports, over all patients:
+- per-turn latency, from the patient's reply to the health coach's next message
+  (turn 1 is the opening, from SOA /trigger), and its time to first token
+- per-hop latency of the HTTP calls the patients make
+- sessions per minute, turns per second and the error rate
+
+Run the stack against the LLM stub and drive it, e.g.
+
+    docker compose -f docker-compose.yml -f docker-compose.bench.yml up --build
+    python bench/loadgen.py --patients 20 --concurrency 10 --scenario baseline
+    python bench/loadgen.py --patients 20 --suite --out results.json
+
+--scenario and --suite reconfigure the stub (POST /stub/config) before each run,
+so the numbers are repeatable. Without --stub, the agents' own LLM is used.
+"""
+import sys, json, time, uuid, asyncio, argparse
+from collections import defaultdict
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from common import metrics
+
+SERVICES = {
+    "mma": "http://localhost:8001",
+    "soa": "http://localhost:8002",
+    "gra": "http://localhost:8003",
+    "sca": "http://localhost:8004",
+    "oa": "http://localhost:8006"
+}
+
+# LLM stub settings per scenario, see bench/llm_stub.py
+SCENARIOS = {
+    "baseline": {"ttft_ms": "lognormal:400,0.5", "tokens_per_s": 60, "error_rate": 0, "rate_limit_rate": 0},
+    "slow_llm": {"ttft_ms": "lognormal:1500,0.6", "tokens_per_s": 25, "error_rate": 0, "rate_limit_rate": 0},
+    "flaky_llm": {"ttft_ms": "lognormal:400,0.5", "tokens_per_s": 60, "error_rate": 0.05, "rate_limit_rate": 0.05},
+    # Every call fails: the LLM breakers open and patient turns get the holding reply
+    "llm_outage": {"ttft_ms": "lognormal:400,0.5", "tokens_per_s": 60, "error_rate": 1, "rate_limit_rate": 0}
+}
+
+LAST_TURN = 13  # the patient's reply to the SCA opening; SCA closes the session and triggers SSA
+PATIENT_REPLIES = {
+    1: "I'm feeling pretty good today, maybe a 7 out of 10.",
+    2: "A 7 means I have energy but I'm a little tired from work.",
+    3: "I went for a long walk with my family on Sunday and it felt great.",
+    4: "We walked by the river and stopped for breakfast afterwards.",
+    5: "Yes, I'd like to keep doing that.",
+    6: "Walk 30 minutes after dinner on Monday, Wednesday and Friday",
+    7: "It helped me clear my head after work.",
+    8: "Seeing my step count go up was the most rewarding part.",
+    9: "Rainy evenings were hard, so I walked in the mall instead.",
+    10: "I'd say 70%.",
+    11: "I'd like to keep the goal and add a Saturday walk.",
+    12: "That sounds like a good plan for next week.",
+    13: "Thanks, the session was helpful."
+}
+SESSION_NOTE = (
+    "Client, {name}, enjoys gardening and cooking with her daughter. She is planning a trip to Penang in December.\n\n"
+    "Goals setting:\n1. Walk 30 minutes after dinner on Monday, Wednesday and Friday.\n"
+    "2. Eat two servings of vegetables at dinner, five days per week."
+)
+
+
+# === Recording ===
+class Results:
+    def __init__(self):
+        self.turns = defaultdict(list)  # turn -> seconds until the health coach message arrived
+        self.ttft = defaultdict(list)  # turn -> seconds until its first partial
+        self.hops = defaultdict(list)  # "AGENT /endpoint" -> seconds
+        self.errors = defaultdict(int)  # "turn N" -> count
+        self.attempted = 0
+        self.completed_sessions = 0
+
+    def report(self, elapsed: float, patients: int) -> dict:
+        turns = sum(len(samples) for samples in self.turns.values())
+        return {
+            "patients": patients,
+            "completed_sessions": self.completed_sessions,
+            "elapsed_s": round(elapsed, 2),
+            "sessions_per_min": round(60 * self.completed_sessions / elapsed, 2) if elapsed else None,
+            "turns_per_s": round(turns / elapsed, 2) if elapsed else None,
+            "turn_attempts": self.attempted,
+            "turn_errors": sum(self.errors.values()),
+            "error_rate": round(sum(self.errors.values()) / self.attempted, 4) if self.attempted else None,
+            "errors": dict(self.errors),
+            "turns": {f"turn {t}": metrics.summarize(s) for t, s in sorted(self.turns.items())},
+            "time_to_first_token": {f"turn {t}": metrics.summarize(s) for t, s in sorted(self.ttft.items())},
+            "hops": {hop: metrics.summarize(s) for hop, s in sorted(self.hops.items())}
+        }
+
+
+# === Simulated Patient ===
+async def next_assistant_message(client, patient_id, after_id, started, timeout, arrivals):
+    """Id of the next health coach message on OA's stream.
+
+    Seconds since `started` until the first partial and until the message go into
+    `arrivals` as "partial" and "message".
+    """
+    params = {"after": after_id, "timeout": timeout}
+    async with client.stream("GET", f"{SERVICES['oa']}/stream/{patient_id}", params=params, timeout=timeout + 30) as response:
+        response.raise_for_status()
+        event = {}
+        async for line in response.aiter_lines():
+            if line:
+                field, _, value = line.partition(":")
+                event[field] = value[1:] if value.startswith(" ") else value
+                continue
+            if event.get("event") == "partial" and "partial" not in arrivals:
+                arrivals["partial"] = time.perf_counter() - started
+            elif event.get("event") == "message" and json.loads(event["data"]).get("role") == "assistant":
+                arrivals["message"] = time.perf_counter() - started
+                return int(event["id"])
+            event = {}
+    raise TimeoutError(f"No health coach message for {patient_id} within {timeout}s")
+
+async def post_step(client, results, hop, url, payload, timeout):
+    started = time.perf_counter()
+    response = await client.post(url, json=payload, timeout=timeout)
+    results.hops[hop].append(time.perf_counter() - started)
+    response.raise_for_status()
+    body = response.json()
+    if body.get("status") in ("error", "failed"):
+        raise RuntimeError(f"{hop}: {body.get('reason')}")
+
+async def turn(client, results, hop, url, payload, after_id, turn_index, timeout, reply=None):
+    """Posts the patient's side of a turn and waits for the health coach's reply. Returns its message id.
+
+    With `reply`, the patient's message is first stored through OA /receive_reply, as the UI does.
+    """
+    results.attempted += 1
+    started = time.perf_counter()
+    arrivals = {}
+    listener = asyncio.create_task(
+        next_assistant_message(client, payload["patient_id"], after_id, started, timeout, arrivals)
+    )
+    try:
+        if reply is not None:
+            await post_step(client, results, "OA /receive_reply", f"{SERVICES['oa']}/receive_reply", reply, timeout)
+        await post_step(client, results, hop, url, payload, timeout)
+        message_id = await asyncio.wait_for(listener, timeout)
+    except BaseException:
+        listener.cancel()
+        results.errors[f"turn {turn_index}"] += 1
+        raise
+    results.turns[turn_index].append(arrivals["message"])
+    if "partial" in arrivals:
+        results.ttft[turn_index].append(arrivals["partial"])
+    return message_id
+
+async def run_patient(client, results, patient_id, think_time, timeout):
+    try:
+        last_id = await turn(client, results, "SOA /trigger", f"{SERVICES['soa']}/trigger",
+                             {"patient_id": patient_id}, 0, 1, timeout)
+        for turn_index in range(1, LAST_TURN + 1):
+            await asyncio.sleep(think_time)
+            agent = "soa" if turn_index < 6 else "gra" if turn_index < 13 else "sca"
+            # SCA's response to the last reply includes handing the session to SSA
+            hop = f"{agent.upper()} /receive_message" + (" + SSA /trigger" if turn_index == LAST_TURN else "")
+            payload = {"patient_id": patient_id, "turn_index": turn_index, "user_input": PATIENT_REPLIES[turn_index]}
+            reply = {"patient_id": patient_id, "turn_index": turn_index, "reply": PATIENT_REPLIES[turn_index]}
+            last_id = await turn(client, results, hop, f"{SERVICES[agent]}/receive_message",
+                                 payload, last_id, turn_index + 1, timeout, reply=reply)
+        results.completed_sessions += 1
+    except Exception as e:
+        print(f"{patient_id}: session aborted: {e!r}", flush=True)
+
+
+# === Runs ===
+async def seed_patients(client, patient_ids, timeout):
+    """Extracts a synthetic session note per patient in MMA, so SOA and GRA find a profile and goals."""
+    body = "".join(json.dumps({
+        "study_id": patient_id,
+        "health_coach": "HC_bench",
+        "date": time.strftime("%Y-%m-%d"),
+        "note": SESSION_NOTE.format(name=f"Patient {i}")
+    }) + "\n" for i, patient_id in enumerate(patient_ids))
+    response = await client.post(f"{SERVICES['mma']}/extract", content=body,
+                                 headers={"Content-Type": "application/x-ndjson"}, timeout=timeout)
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = (await client.get(f"{SERVICES['mma']}/jobs/{job_id}")).json()
+        if job["status"] in ("done", "failed"):
+            return job
+        await asyncio.sleep(1)
+    raise TimeoutError(f"MMA job {job_id} did not finish within {timeout}s")
+
+async def run(args, scenario=None) -> dict:
+    async with httpx.AsyncClient(timeout=args.timeout, limits=httpx.Limits(max_connections=4 * args.concurrency + 10)) as client:
+        if scenario:
+            response = await client.post(f"{args.stub}/stub/config", json=SCENARIOS[scenario])
+            response.raise_for_status()
+
+        tag = uuid.uuid4().hex[:6]
+        patient_ids = [f"load_{tag}_{i:04d}" for i in range(args.patients)]
+        if args.seed:
+            started = time.perf_counter()
+            job = await seed_patients(client, patient_ids, args.timeout * 10)
+            print(f"Seeded {len(patient_ids)} patients in MMA in {time.perf_counter() - started:.1f}s (job {job['status']})", flush=True)
+
+        results = Results()
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def one(patient_id):
+            async with semaphore:
+                await run_patient(client, results, patient_id, args.think_time, args.timeout)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(p) for p in patient_ids))
+        report = results.report(time.perf_counter() - started, args.patients)
+
+        if scenario:
+            report["stub"] = (await client.get(f"{args.stub}/stub/config")).json()
+    return report
+
+def print_report(name, report):
+    print(f"\n=== {name} ===")
+    print(f"{report['completed_sessions']}/{report['patients']} sessions in {report['elapsed_s']}s: "
+          f"{report['sessions_per_min']} sessions/min, {report['turns_per_s']} turns/s, "
+          f"error rate {report['error_rate']} ({report['turn_errors']}/{report['turn_attempts']} turns)")
+    for title, series in (("Turn latency", report["turns"]), ("Time to first token", report["time_to_first_token"]), ("Hops", report["hops"])):
+        if not series:
+            continue
+        print(f"{title:<40} {'n':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for label, s in series.items():
+            print(f"  {label:<38} {s['count']:>5} {s['p50_ms']:>9} {s['p95_ms']:>9} {s['p99_ms']:>9}")
+    if "stub" in report:
+        stats = report["stub"]["stats"]
+        # The agents' OpenAI clients retry injected errors, so they rarely surface as failed turns
+        print(f"LLM stub: {stats['requests']} calls, {stats['injected_errors']} injected errors, "
+              f"{stats['injected_rate_limits']} injected rate limits")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=10, help="simulated patients per run (default: 10)")
+    parser.add_argument("-c", "--concurrency", type=int, default=10, help="sessions in progress at once (default: 10)")
+    parser.add_argument("--think-time", type=float, default=0, help="seconds a patient takes to reply (default: 0)")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for each reply (default: 120)")
+    parser.add_argument("--no-seed", dest="seed", action="store_false", help="skip extracting synthetic notes in MMA")
+    parser.add_argument("--stub", default="http://localhost:8010", help="LLM stub for --scenario/--suite")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--scenario", choices=sorted(SCENARIOS), help="configure the stub with this scenario first")
+    group.add_argument("--suite", action="store_true", help="run every scenario in turn")
+    parser.add_argument("--out", help="also write the reports to this JSON file")
+    for name, url in SERVICES.items():
+        parser.add_argument(f"--{name}", default=url, help=f"{name.upper()} base URL (default: {url})")
+    args = parser.parse_args()
+    SERVICES.update({name: getattr(args, name).rstrip("/") for name in SERVICES})
+
+    scenarios = sorted(SCENARIOS) if args.suite else [args.scenario]
+    reports = {}
+    for scenario in scenarios:
+        name = scenario or "run"
+        reports[name] = asyncio.run(run(args, scenario))
+        print_report(name, reports[name])
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
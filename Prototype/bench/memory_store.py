@@ -0,0 +1,88 @@
+"""Per-turn storage cost of the agent memory backends as the number of stored patients grows.
+
+For each patient count, it fills a fresh store with that many patients and then
+times one turn: read the patient's record, append two messages, save it. The
+previous whole-file JSON handlers ("legacy") are timed the same way for comparison.
+
+    python bench/memory_store.py --patients 100 1000 5000 --turns 200
+"""
+import sys, json, time, random, argparse, tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from common import memory, metrics
+
+HISTORY = [
+    {"role": "assistant", "content": "How are you feeling today, on a scale from 1 to 10?"},
+    {"role": "user", "content": "Maybe a 7, I slept well and went for a walk this morning."}
+] * 6
+
+
+class LegacyStore:
+    """The handlers the agents used before common/memory.py: one JSON file, rewritten on every save."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not self.path.exists():
+            return []
+        with open(self.path) as f:
+            return json.load(f)
+
+    def get(self, patient_id):
+        return next((r for r in self.load() if r.get("patient_id") == patient_id), None)
+
+    def update(self, patient_id, fields):
+        records = self.load()
+        record = next((r for r in records if r.get("patient_id") == patient_id), None)
+        if record is None:
+            records.append({"patient_id": patient_id, **fields})
+        else:
+            record.update(fields)
+        with open(self.path, "w") as f:
+            json.dump(records, f, indent=2)
+
+
+def fill(store, patients):
+    if isinstance(store, LegacyStore):
+        with open(store.path, "w") as f:
+            json.dump([{"patient_id": f"p{i}", "chat_history": HISTORY} for i in range(patients)], f, indent=2)
+        return
+    for i in range(patients):
+        store.dirty[f"p{i}"] = {"patient_id": f"p{i}", "chat_history": HISTORY}
+    store.flush()
+
+def time_turns(store, patients, turns):
+    samples = []
+    for _ in range(turns):
+        patient_id = f"p{random.randrange(patients)}"
+        started = time.perf_counter()
+        record = store.get(patient_id)
+        chat_history = record["chat_history"][-len(HISTORY):] + HISTORY[:2]
+        store.update(patient_id, {"chat_history": chat_history})
+        samples.append(time.perf_counter() - started)
+    return metrics.summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, nargs="+", default=[100, 1000, 5000], help="stored patients per run")
+    parser.add_argument("--turns", type=int, default=200, help="timed turns per run")
+    parser.add_argument("--backends", nargs="+", default=["legacy", *memory.BACKENDS], help="legacy, json and/or sqlite")
+    args = parser.parse_args()
+
+    random.seed(0)
+    print(f"{'backend':<8} {'patients':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for backend in args.backends:
+        for patients in args.patients:
+            with tempfile.TemporaryDirectory() as tmp:
+                path = Path(tmp) / "conversations"
+                store = LegacyStore(path.with_suffix(".json")) if backend == "legacy" else memory.open_store(path, backend)
+                fill(store, patients)
+                stats = time_turns(store, patients, args.turns)
+            print(f"{backend:<8} {patients:>9} {stats['p50_ms']:>9} {stats['p95_ms']:>9}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""Compares MMA's "separate" (two calls per note) and "combined" (one call) extraction modes.
+
+By default the LLM is replaced by a stub that answers with recorded outputs: the
+profiles and weekly goals already stored in MMA/memory for the notes in
+OA/memory/session_notes_mock.json. Latency is simulated from the token volume.
+For each mode the script prints LLM calls, prompt and completion tokens, and wall
+time. It then compares each mode's fields with the recorded extractions, which
+were made earlier and independently of this run. With the stub this only checks
+the plumbing (each mode's schema and parsing carry every field through); the
+stub answers from the recordings, so it says nothing about extraction quality.
+With --live it reports how often each mode agrees with the recordings, per field.
+
+    python bench/mma_extraction_modes.py            # stubbed LLM, no API cost
+    python bench/mma_extraction_modes.py --live     # real OpenAI calls (needs OPENAI_API_KEY)
+
+Needs the MMA requirements (fastapi, openai) installed on the host.
+"""
+import os, sys, json, time, asyncio, argparse, tempfile
+from types import SimpleNamespace
+from pathlib import Path
+
+PROTOTYPE_DIR = Path(__file__).resolve().parents[1]
+NOTES_FILE = PROTOTYPE_DIR / "OA/memory/session_notes_mock.json"
+PROFILES_FILE = PROTOTYPE_DIR / "MMA/memory/session_notes_mock.json"
+GOALS_FILE = PROTOTYPE_DIR / "MMA/memory/weekly_smart_goals_mock.json"
+
+PROFILE_FIELDS = ["preferred_name", "hobbies", "family", "friends", "travel"]
+
+
+# === Stubbed LLM ===
+class StubCompletions:
+    """Answers tool calls with the recorded output of the note found in the user message."""
+
+    def __init__(self, recordings, base_latency, seconds_per_output_token):
+        self.recordings = recordings
+        self.base_latency = base_latency
+        self.seconds_per_output_token = seconds_per_output_token
+        self.calls = self.prompt_tokens = self.completion_tokens = 0
+
+    async def create(self, model, messages, tools, **kwargs):
+        user_message = messages[-1]["content"]
+        recorded = next(r for note, r in self.recordings.items() if note in user_message)
+        properties = tools[0]["function"]["parameters"]["properties"]
+        arguments = json.dumps({key: recorded[key] for key in properties})
+
+        prompt_tokens = (sum(len(m["content"]) for m in messages) + len(json.dumps(tools))) // 4
+        completion_tokens = len(arguments) // 4
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        await asyncio.sleep(self.base_latency + completion_tokens * self.seconds_per_output_token)
+
+        tool_call = SimpleNamespace(function=SimpleNamespace(name=tools[0]["function"]["name"], arguments=arguments))
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(tool_calls=[tool_call], content=None))],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens
+            )
+        )
+
+
+class CountingCompletions:
+    """Wraps the real client to count calls and tokens."""
+
+    def __init__(self, completions):
+        self.completions = completions
+        self.calls = self.prompt_tokens = self.completion_tokens = 0
+
+    async def create(self, **kwargs):
+        response = await self.completions.create(**kwargs)
+        self.calls += 1
+        if response.usage:
+            self.prompt_tokens += response.usage.prompt_tokens
+            self.completion_tokens += response.usage.completion_tokens
+        return response
+
+
+def load_recordings(notes):
+    with open(PROFILES_FILE) as f:
+        profiles = json.load(f)
+    with open(GOALS_FILE) as f:
+        goals = {(g["patient_id"], g["date"]): g["output"]["goals"] for g in json.load(f)}
+
+    recordings = {}
+    for row in notes:
+        profile = profiles.get(row["study_id"], {}).get("output", {})
+        recordings[row["note"].strip()] = {
+            **{field: profile.get(field, [] if field != "preferred_name" else "") for field in PROFILE_FIELDS},
+            "goals": goals.get((row["study_id"], row["date"]), [])
+        }
+    return recordings
+
+
+# === Comparison ===
+def split_recording(recorded):
+    """A recording in the `(patient_info, weekly_goals)` shape extract_note_uncached returns."""
+    return {field: recorded[field] for field in PROFILE_FIELDS}, {"goals": recorded["goals"]}
+
+def normalize(patient_info, weekly_goals):
+    fields = {field: sorted(v) if isinstance(v, list) else v for field, v in patient_info.items()}
+    fields["goals"] = sorted(weekly_goals.get("goals", []))
+    return fields
+
+async def compare(mma, batch, recordings, args):
+    """Extracts the batch once per mode; MMA's semaphore is bound to one event loop, so both share it."""
+    live_completions = mma.llm.openai_client().chat.completions
+    outputs = {}
+    for mode in mma.EXTRACTION_MODES:
+        if args.live:
+            completions = CountingCompletions(live_completions)
+        else:
+            completions = StubCompletions(recordings, args.base_latency, args.output_token_latency)
+        mma.llm.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(mma.extract_note_uncached(row["note"], mode) for row in batch))
+        elapsed = time.perf_counter() - started
+        outputs[mode] = [normalize(patient_info, weekly_goals) for patient_info, weekly_goals, _ in results]
+        print(f"{mode:<9} calls={completions.calls:<5} prompt_tokens={completions.prompt_tokens:<8} "
+              f"completion_tokens={completions.completion_tokens:<7} wall={elapsed:.2f}s")
+    return outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--live", action="store_true", help="call the real OpenAI API instead of the stub")
+    parser.add_argument("--repeat", type=int, default=20, help="copies of each note in the batch (default: 20)")
+    parser.add_argument("--base-latency", type=float, default=0.4, help="stub seconds per call (default: 0.4)")
+    parser.add_argument("--output-token-latency", type=float, default=0.02,
+                        help="stub seconds per completion token (default: 0.02)")
+    args = parser.parse_args()
+
+    with open(NOTES_FILE) as f:
+        notes = json.load(f)
+    recordings = load_recordings(notes)
+
+    # MMA reads and writes memory/ relative to the working directory, so run it in a scratch folder
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    os.chdir(tempfile.mkdtemp())
+    sys.path[:0] = [str(PROTOTYPE_DIR), str(PROTOTYPE_DIR / "MMA")]
+    import app as mma
+
+    mma.llm.CACHE_ENABLED = False  # every note must reach the (stubbed) model
+    if not args.live:
+        mma.limiter = mma.TokenBucketLimiter(10**6, 10**9)
+    # Copies differ only by a suffix, so the stub still finds the recorded note
+    batch = notes if args.live else [
+        dict(row, note=f"{row['note']}\n[copy {i}]") for i in range(args.repeat) for row in notes
+    ]
+
+    print(f"{len(batch)} notes, {'live OpenAI' if args.live else 'stubbed LLM'}")
+    outputs = asyncio.run(compare(mma, batch, recordings, args))
+
+    references = [normalize(*split_recording(recordings[row["note"].split("\n[copy")[0].strip()])) for row in batch]
+    if args.live:
+        # Free-text fields vary between runs, so agreement is reported rather than required
+        for mode in mma.EXTRACTION_MODES:
+            agreement = {
+                field: sum(out.get(field) == ref[field] for out, ref in zip(outputs[mode], references)) / len(batch)
+                for field in references[0]
+            }
+            print(f"{mode:<9} agreement with the recorded extractions: "
+                  + ", ".join(f"{field} {share:.0%}" for field, share in agreement.items()))
+        return
+
+    mismatches = [
+        (mode, row["study_id"], field)
+        for mode in mma.EXTRACTION_MODES
+        for row, out, ref in zip(batch, outputs[mode], references)
+        for field in ref if out.get(field) != ref[field]
+    ]
+    if mismatches:
+        print(f"{len(mismatches)} fields lost or changed between the stub and the parsed output:")
+        for mode, patient_id, field in sorted(set(mismatches)):
+            print(f"  {mode}: {patient_id}: {field}")
+        sys.exit(1)
+    print("Plumbing check passed: both modes carried every recorded field through (not an accuracy check).")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Lost-update stress test for the per-patient locks of common/locks.py.
+
+Drives the real SOA, GRA and SCA `/receive_message` handlers, and so their
+`take_turn`, against a temporary common/memory.py store. Only the LLM reply
+(`reply_stream.stream_reply`, which waits a simulated generation time) and the
+calls to other services (`http_client.apost`) are stubbed. Every turn of a
+patient's session is sent at once, and all patients run in parallel. Afterwards
+every patient must hold every user message and reply. With --no-lock the same
+run shows the updates that are lost without the locks.
+
+    python bench/patient_lock_stress.py --patients 500
+    python bench/patient_lock_stress.py --patients 500 --no-lock
+"""
+import os, sys, time, random, asyncio, argparse, tempfile, importlib.util
+from collections import Counter
+from contextlib import asynccontextmanager, redirect_stdout
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+from common import http_client, locks, memory, reply_stream
+
+# Patient turns each agent handles in a session (see MAX_TURNS in OA/streamlit_app.py)
+AGENT_TURNS = {"SOA": range(1, 6), "GRA": range(6, 13), "SCA": range(13, 14)}
+
+
+def load_agent(name, tmp):
+    """Imports the agent's app.py with its startup store in `tmp` and no legacy migration."""
+    open_store = memory.open_store
+    spec = importlib.util.spec_from_file_location(f"{name.lower()}_app", ROOT / name / "app.py")
+    module = importlib.util.module_from_spec(spec)
+    with mock.patch.object(memory, "open_store", lambda path, backend=None: open_store(Path(tmp) / path.name, backend)), \
+            mock.patch.object(memory.MemoryStore, "migrate_from_json", return_value=0):
+        spec.loader.exec_module(module)
+    return module
+
+class NoLock:
+    @asynccontextmanager
+    async def hold(self, key):
+        yield
+
+class FakeRequest:
+    def __init__(self, data):
+        self.data = data
+
+    async def json(self):
+        return self.data
+
+
+async def run(agents, backend, tmp, patients, reply_time, use_lock):
+    replies = Counter()  # patient_id -> replies generated
+
+    async def fake_reply(patient_id, turn_index, messages, model, temperature=None, started=None, fallback=None):
+        await asyncio.sleep(random.uniform(0, 2 * reply_time))  # the LLM generating the reply
+        replies[patient_id] += 1
+        return f"reply {turn_index}", 0.0
+
+    async def fake_post(url, **kwargs):
+        return SimpleNamespace(status_code=200)
+
+    # Agent patients are kept apart so each agent's own turns are counted
+    sessions = {name: [f"{name.lower()}-p{p}" for p in range(patients)] for name in agents}
+    for name, agent in agents.items():
+        agent.conversations = memory.open_store(Path(tmp) / backend / f"{name.lower()}_conversations", backend)
+        agent.patient_locks = locks.KeyedLock("patient") if use_lock else NoLock()
+        for patient_id in sessions[name]:
+            agent.conversations.update(patient_id, {"chat_history": []})
+
+    turns = [
+        (name, agents[name].receive_message(FakeRequest({"patient_id": patient_id, "user_input": f"turn {turn}", "turn_index": turn})))
+        for name in agents for turn in AGENT_TURNS[name] for patient_id in sessions[name]
+    ]
+    with mock.patch.object(reply_stream, "stream_reply", fake_reply), mock.patch.object(http_client, "apost", fake_post), \
+            open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        started = time.perf_counter()
+        results = await asyncio.gather(*(turn for name, turn in turns))
+        elapsed = time.perf_counter() - started
+
+    # Every processed turn saves the patient's message, plus the reply if one was generated
+    expected = Counter()
+    for (name, _), result in zip(turns, results):
+        expected[name] += result.get("status") == "message processed"
+    total = lost = 0
+    for name, agent in agents.items():
+        stored = sum(len(agent.conversations.get(patient_id)["chat_history"]) for patient_id in sessions[name])
+        generated = sum(replies[patient_id] for patient_id in sessions[name])
+        total += expected[name] + generated
+        lost += expected[name] + generated - stored
+    return len(turns), elapsed, lost, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=500, help="patients per agent")
+    parser.add_argument("--reply-ms", type=float, default=5, help="mean simulated reply time")
+    parser.add_argument("--backends", nargs="+", default=list(memory.BACKENDS), help="json and/or sqlite")
+    parser.add_argument("--no-lock", action="store_true", help="run the turns without the per-patient locks")
+    args = parser.parse_args()
+
+    random.seed(0)
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        agents = {name: load_agent(name, tmp) for name in AGENT_TURNS}
+        for backend in args.backends:
+            turns, elapsed, lost, total = asyncio.run(run(agents, backend, tmp, args.patients, args.reply_ms / 1000, not args.no_lock))
+            print(f"{backend:<7} {turns} turns in {elapsed:.2f}s ({turns / elapsed:.0f} turns/s): "
+                  f"{lost}/{total} messages lost", flush=True)
+            failed = failed or lost > 0
+    if failed and not args.no_lock:
+        sys.exit("Lost updates with the per-patient locks")
+
+
+if __name__ == "__main__":
+    main()
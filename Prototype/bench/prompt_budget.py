@@ -0,0 +1,92 @@
+"""Prompt tokens per turn with and without the token budget of common/context.py.
+
+Replays a synthetic goal review session, as GRA runs it: the patient names the
+goal to review, which is stored cut to context.PINNED_MAX_TOKENS and pinned to
+every prompt, then coach replies of a few sentences alternate with patient replies
+that are sometimes very long. The session is run once with a short goal and once
+with a goal of --long-goal-chars characters. For each turn it prints the prompt
+size when the whole history is sent, next to the size build_prompt produces; both
+get the same system prompt, pinned goal, history and instruction. With --live,
+every prompt is also sent to the model (OPENAI_BASE_URL / OPENAI_API_KEY), both
+ways, and the generation latency is reported.
+
+    python bench/prompt_budget.py --turns 12 --budget 1500
+    python bench/prompt_budget.py --turns 12 --live
+"""
+import sys, time, asyncio, argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from common import context, llm, metrics
+
+SYSTEM_PROMPT = "You are a warm, empathetic health coach helping a patient review their SMART goals."
+PINNED_LABEL = "Goal the patient selected for review"
+SHORT_GOAL = "Walk 30 minutes after dinner on Monday, Wednesday and Friday, and track the walks in my phone"
+COACH_REPLY = ("Thank you for sharing that with me. It sounds like the evening walks gave you some time to unwind. "
+               "What helped you keep going on the days when you felt tired?")
+SHORT_REPLY = "It went fine, I walked three times and felt good afterwards."
+LONG_REPLY = ("Honestly the week was a bit of a mix. On Monday I walked after dinner like we planned, but on Wednesday "
+              "my daughter had a school event and we got home late, so I only walked around the block for ten minutes. ") * 6
+
+
+def full_prompt(history, instruction, goal):
+    system = f"{SYSTEM_PROMPT}\n{PINNED_LABEL}: {goal}"
+    return [{"role": "system", "content": system}, *history, {"role": "user", "content": instruction}]
+
+async def timed_reply(messages, model):
+    started = time.perf_counter()
+    await llm.chat(messages, model=model, temperature=0.7, use_cache=False)
+    return time.perf_counter() - started
+
+async def run(name, goal_reply, turns, budget, live, model):
+    history = [
+        {"role": "assistant", "content": "Which of your goals would you like to review today?"},
+        {"role": "user", "content": goal_reply}
+    ]
+    goal = context.truncate_middle(goal_reply.strip(), context.PINNED_MAX_TOKENS)  # as GRA stores it
+    totals = {"full": [], "budgeted": []}
+    over_budget = False
+    print(f"\n=== {name} ({len(goal_reply)} characters) ===")
+    print(f"{'turn':>4} {'full tokens':>12} {'budgeted':>9}" + ("  full s  budgeted s" if live else ""))
+    for turn in range(1, turns + 1):
+        history.append({"role": "assistant", "content": COACH_REPLY})
+        history.append({"role": "user", "content": LONG_REPLY if turn % 3 == 0 else SHORT_REPLY})
+        instruction = f'Reflect on what the client said about "{goal}" and ask one follow-up question.'
+
+        full = full_prompt(history, instruction, goal)
+        budgeted = context.build_prompt(SYSTEM_PROMPT, history, instruction, budget, pinned={PINNED_LABEL: goal})
+        line = f"{turn:>4} {context.prompt_tokens(full):>12} {context.prompt_tokens(budgeted):>9}"
+        over_budget = over_budget or context.prompt_tokens(budgeted) > budget
+        if live:
+            full_s, budgeted_s = await timed_reply(full, model), await timed_reply(budgeted, model)
+            totals["full"].append(full_s)
+            totals["budgeted"].append(budgeted_s)
+            line += f"  {full_s:>6.2f}  {budgeted_s:>10.2f}"
+        print(line)
+
+    if live:
+        for name, samples in totals.items():
+            stats = metrics.summarize(samples)
+            print(f"{name:<9} latency p50={stats['p50_ms']} ms  p95={stats['p95_ms']} ms")
+    return over_budget
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=12, help="patient replies in the session (default: 12)")
+    parser.add_argument("--budget", type=int, default=1500, help="prompt token budget (default: 1500)")
+    parser.add_argument("--long-goal-chars", type=int, default=10000, help="length of the long goal (default: 10000)")
+    parser.add_argument("--live", action="store_true", help="also send every prompt to the model and time it")
+    parser.add_argument("--model", default="gpt-4.1", help="model for --live (default: gpt-4.1)")
+    args = parser.parse_args()
+
+    long_goal = (SHORT_GOAL + ". ") * (args.long_goal_chars // (len(SHORT_GOAL) + 2) + 1)
+    over_budget = False
+    for name, goal_reply in (("short goal", SHORT_GOAL), ("long goal", long_goal[:args.long_goal_chars])):
+        over_budget = asyncio.run(run(name, goal_reply, args.turns, args.budget, args.live, args.model)) or over_budget
+    if over_budget:
+        sys.exit(f"A budgeted prompt exceeded {args.budget} tokens")
+
+
+if __name__ == "__main__":
+    main()
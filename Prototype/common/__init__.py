@@ -0,0 +1,5 @@
+"""Helpers shared by all GoalGuardian services.
+
+Each service's Docker image receives a copy of this package through the
+`common` build context declared in docker-compose.yml.
+"""
@@ -0,0 +1,92 @@
+import re
+
+from common import metrics
+
+# === Configuration ===
+KEEP_MESSAGES = 6  # most recent messages sent verbatim
+DIGEST_LINE_TOKENS = 40  # per older message in the digest
+MESSAGE_MAX_TOKENS = 400  # a recent message longer than this is shortened if the prompt is over budget
+MESSAGE_OVERHEAD_TOKENS = 4  # role and separators added by the chat format
+PINNED_MAX_TOKENS = 100  # per pinned fact; facts taken from patient text should be stored cut to this
+PINNED_MIN_TOKENS = 20  # a pinned fact is never shortened below this to fit the budget
+
+ROLE_NAMES = {"assistant": "Coach", "user": "Patient"}
+
+
+def count_tokens(text: str) -> int:
+    """Approximate token count (about four characters per token for English text)."""
+    return (len(text or "") + 3) // 4
+
+def message_tokens(message: dict) -> int:
+    return count_tokens(message.get("content")) + MESSAGE_OVERHEAD_TOKENS
+
+def prompt_tokens(messages: list) -> int:
+    return sum(message_tokens(m) for m in messages)
+
+def shorten(text: str, max_tokens: int) -> str:
+    """The first sentence of `text`, cut to `max_tokens`."""
+    text = " ".join((text or "").split())
+    sentence = re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0]
+    max_chars = max_tokens * 4
+    return sentence if len(sentence) <= max_chars else sentence[:max_chars - 1].rstrip() + "…"
+
+def truncate_middle(text: str, max_tokens: int) -> str:
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    half = (max_chars - 5) // 2
+    return f"{text[:half].rstrip()} […] {text[-half:].lstrip()}"
+
+
+def build_prompt(system_prompt: str, chat_history: list, instruction: str, budget: int,
+                 pinned: dict = None, keep_messages: int = KEEP_MESSAGES) -> list:
+    """Chat messages for one turn, fitted into `budget` tokens where possible.
+
+    The system prompt, pinned facts (label -> text, appended to the system prompt,
+    each cut to PINNED_MAX_TOKENS), `instruction` and the last `keep_messages`
+    messages are sent verbatim. Older messages are compressed into a rolling digest
+    of one short line each, trimmed from the oldest end until the prompt fits; after
+    that, long recent messages are shortened, the oldest recent ones dropped and
+    finally the pinned facts shortened. The system prompt and instruction are never
+    cut, so the prompt can exceed a budget smaller than them.
+    """
+    originals = {label: str(text) for label, text in (pinned or {}).items() if text}
+    facts = {label: truncate_middle(text, PINNED_MAX_TOKENS) for label, text in originals.items()}
+
+    def system():
+        return system_prompt + "".join(f"\n{label}: {text}" for label, text in facts.items())
+
+    split = max(0, len(chat_history) - keep_messages)
+    older, recent = chat_history[:split], [dict(m) for m in chat_history[split:]]
+    digest = [f"{ROLE_NAMES.get(m['role'], m['role'])}: {shorten(m.get('content'), DIGEST_LINE_TOKENS)}" for m in older]
+
+    def assemble():
+        content = system()
+        if digest:
+            content += "\n\nEarlier in this session (summary):\n" + "\n".join(digest)
+        return [{"role": "system", "content": content}, *recent, {"role": "user", "content": instruction}]
+
+    messages = assemble()
+    full_tokens = prompt_tokens([{"role": "system", "content": system()}, *chat_history, {"role": "user", "content": instruction}])
+
+    # Shed the oldest context first: digest lines, then long recent messages, then recent messages, then pinned facts
+    while (over := prompt_tokens(messages) - budget) > 0:
+        longest = max(recent, key=message_tokens, default=None)
+        longest_fact = max(facts, key=lambda label: count_tokens(facts[label]), default=None)
+        if digest:
+            digest.pop(0)
+        elif longest and message_tokens(longest) - MESSAGE_OVERHEAD_TOKENS > MESSAGE_MAX_TOKENS:
+            longest["content"] = truncate_middle(longest["content"], MESSAGE_MAX_TOKENS)
+        elif len(recent) > 1:
+            recent.pop(0)
+        elif longest_fact and count_tokens(facts[longest_fact]) > PINNED_MIN_TOKENS:
+            fact_tokens = count_tokens(facts[longest_fact])
+            facts[longest_fact] = truncate_middle(originals[longest_fact], max(PINNED_MIN_TOKENS, min(fact_tokens - over, fact_tokens - 1)))
+        else:
+            break
+        messages = assemble()
+
+    sent_tokens = prompt_tokens(messages)
+    metrics.increment("prompt tokens sent", sent_tokens)
+    metrics.increment("prompt tokens saved", max(0, full_tokens - sent_tokens))
+    return messages
@@ -0,0 +1,252 @@
+import os, time, uuid, bisect, sqlite3, asyncio, threading, weakref
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+from common import metrics, resilience
+
+# === Configuration ===
+ENABLED = os.getenv("LLM_GOVERNOR", "1") != "0"
+STORE_PATH = Path(os.getenv("LLM_GOVERNOR_PATH", "memory/llm_governor.db"))  # shared by all services in docker-compose
+MAX_CONCURRENCY = int(os.getenv("LLM_GOVERNOR_CONCURRENCY", "16"))  # LLM calls in flight across all services
+REQUESTS_PER_MINUTE = int(os.getenv("LLM_GOVERNOR_RPM", "450"))  # LLM calls started across all services
+INTERACTIVE_RESERVE = int(os.getenv("LLM_GOVERNOR_INTERACTIVE_RESERVE", "2"))  # slots only patient turns may take
+
+POLL_INTERVAL = 0.05  # seconds before a waiting call's second attempt; doubled after each further one
+MAX_POLL_INTERVAL = 1.0  # seconds; cap of the backoff, well below WAITER_TIMEOUT
+WAITER_TIMEOUT = 10  # seconds; a waiter not seen for this long belonged to a process that died
+LEASE_TIMEOUT = 30  # seconds; a slot whose lease is not renewed for this long belonged to a process that died
+LEASE_RENEW_INTERVAL = 10  # seconds between lease renewals while a call holds its slot
+STATE_MAX_AGE = 5  # seconds the queue state reported by stats() may be out of date
+
+# Lower rank is served first
+PRIORITIES = {
+    "interactive": 0,  # replies to a patient's message
+    "handoff": 1,      # opening messages generated when a phase starts
+    "summary": 2,      # session summaries
+    "batch": 3         # note extraction
+}
+DEFAULT_PRIORITY = "batch"  # unlabelled calls never overtake patient turns
+
+
+# === Backing Store ===
+class GovernorStore:
+    """Waiting calls, held slots and recent call starts, shared through SQLite.
+
+    A local stand-in for a shared store such as Redis: every service points
+    LLM_GOVERNOR_PATH at the same file, and each admission decision runs in one
+    write transaction. A waiting call takes a free slot as soon as it asks, unless
+    the free slots are needed by calls of a higher priority class that are still
+    waiting. Within a class, the first call to ask gets the slot, so a free slot
+    never sits idle while another process backs off between its attempts. Held
+    slots are leased and renewed while the call runs, so the slots of a process
+    that died are reclaimed after LEASE_TIMEOUT.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _connect(self):
+        if self.conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS waiting (
+                    ticket TEXT PRIMARY KEY,
+                    rank INTEGER NOT NULL,
+                    enqueued REAL NOT NULL,
+                    seen REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS leases (
+                    ticket TEXT PRIMARY KEY,
+                    rank INTEGER NOT NULL,
+                    expires REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS starts (started REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS waiting_by_order ON waiting (rank, enqueued);
+                CREATE INDEX IF NOT EXISTS starts_by_time ON starts (started);
+            """)
+        return self.conn
+
+    def _transaction(self, work):
+        with self.lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(conn, time.time())
+                conn.execute("COMMIT")
+                return result
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, ticket: str, rank: int) -> float:
+        """Adds a waiting ticket; returns its enqueue time, which orders it within its rank."""
+        def work(conn, now):
+            conn.execute("INSERT INTO waiting (ticket, rank, enqueued, seen) VALUES (?, ?, ?, ?)", (ticket, rank, now, now))
+            return now
+        return self._transaction(work)
+
+    def try_acquire(self, ticket: str, rank: int) -> bool:
+        """Takes a slot for a waiting ticket if the limits allow it once higher priority waiters are served."""
+        def work(conn, now):
+            conn.execute("DELETE FROM waiting WHERE seen < ?", (now - WAITER_TIMEOUT,))
+            conn.execute("DELETE FROM leases WHERE expires < ?", (now,))
+            conn.execute("DELETE FROM starts WHERE started < ?", (now - 60,))
+            conn.execute("UPDATE waiting SET seen = ? WHERE ticket = ?", (now, ticket))
+
+            # Slots and starts are held back for the waiters of higher priority classes
+            ahead = conn.execute("SELECT COUNT(*) FROM waiting WHERE rank < ?", (rank,)).fetchone()[0]
+            limit = MAX_CONCURRENCY if rank == PRIORITIES["interactive"] else MAX_CONCURRENCY - INTERACTIVE_RESERVE
+            if conn.execute("SELECT COUNT(*) FROM leases").fetchone()[0] + ahead >= max(1, limit):
+                return False
+            if conn.execute("SELECT COUNT(*) FROM starts").fetchone()[0] + ahead >= REQUESTS_PER_MINUTE:
+                return False
+
+            conn.execute("DELETE FROM waiting WHERE ticket = ?", (ticket,))
+            conn.execute("INSERT INTO leases (ticket, rank, expires) VALUES (?, ?, ?)", (ticket, rank, now + LEASE_TIMEOUT))
+            conn.execute("INSERT INTO starts (started) VALUES (?)", (now,))
+            return True
+        return self._transaction(work)
+
+    def renew(self, ticket: str):
+        self._transaction(lambda conn, now: conn.execute(
+            "UPDATE leases SET expires = ? WHERE ticket = ?", (now + LEASE_TIMEOUT, ticket)
+        ))
+
+    def release(self, ticket: str):
+        self._transaction(lambda conn, now: (
+            conn.execute("DELETE FROM waiting WHERE ticket = ?", (ticket,)),
+            conn.execute("DELETE FROM leases WHERE ticket = ?", (ticket,))
+        ))
+
+    def state(self) -> dict:
+        """Calls waiting and in flight across all services, by priority class."""
+        names = {rank: name for name, rank in PRIORITIES.items()}
+        with self.lock:
+            conn = self._connect()
+            waiting = conn.execute("SELECT rank, COUNT(*) FROM waiting GROUP BY rank").fetchall()
+            in_flight = conn.execute("SELECT rank, COUNT(*) FROM leases GROUP BY rank").fetchall()
+            started = conn.execute("SELECT COUNT(*) FROM starts WHERE started >= ?", (time.time() - 60,)).fetchone()[0]
+        return {
+            "waiting": {names.get(rank, rank): count for rank, count in waiting},
+            "in_flight": {names.get(rank, rank): count for rank, count in in_flight},
+            "started_last_minute": started
+        }
+
+
+store = GovernorStore(STORE_PATH)
+
+
+# === Admission ===
+_lock = threading.Lock()
+_admitted = defaultdict(int)
+_state = {"snapshot": {}, "refreshed": None, "refreshing": False}  # last store.state(), see stats()
+
+# Calls of this process waiting for a slot, in queue order, as (rank, enqueued, ticket, event); one list per
+# event loop. When a slot is released here, or a waiter here is admitted, only the first local waiter is woken
+# to retry at once; slots freed by other processes are noticed at its next poll.
+_waiters = weakref.WeakKeyDictionary()
+
+def _local_waiters() -> list:
+    return _waiters.setdefault(asyncio.get_running_loop(), [])
+
+def _wake_next():
+    waiters = _waiters.get(asyncio.get_running_loop())
+    if waiters:
+        waiters[0][3].set()
+
+async def _renew_lease(ticket: str):
+    while True:
+        await asyncio.sleep(LEASE_RENEW_INTERVAL)
+        try:
+            await asyncio.to_thread(store.renew, ticket)
+        except Exception as e:
+            print(f"Failed to renew LLM governor lease: {e!r}", flush=True)
+
+
+@asynccontextmanager
+async def slot(priority: str = DEFAULT_PRIORITY):
+    """Holds one of the shared LLM call slots for the duration of the block.
+
+    Calls wait while the shared limits, or waiting calls of a higher priority
+    class, leave no slot free; the time spent waiting is recorded per priority class.
+    """
+    if not ENABLED:
+        yield
+        return
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown LLM priority: {priority}")
+
+    ticket = uuid.uuid4().hex
+    queued = time.perf_counter()
+    waiters, waiter = _local_waiters(), None
+    try:
+        try:
+            enqueued = await asyncio.to_thread(store.enqueue, ticket, PRIORITIES[priority])
+            waiter = (PRIORITIES[priority], enqueued, ticket, asyncio.Event())
+            bisect.insort(waiters, waiter)
+            delay = POLL_INTERVAL
+            while True:
+                waiter[3].clear()  # cleared before the attempt so a wake-up during it is not lost
+                if await asyncio.to_thread(store.try_acquire, ticket, PRIORITIES[priority]):
+                    break
+                resilience.timeout()  # a call whose deadline passed while queued gives up its place
+                # Backing off keeps many waiters from contending with acquire and release for the write lock
+                try:
+                    await asyncio.wait_for(waiter[3].wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                delay = min(2 * delay, MAX_POLL_INTERVAL)
+        finally:
+            if waiter is not None:
+                waiters.remove(waiter)
+                _wake_next()  # the next local waiter may find a free slot now
+        metrics.record_latency(f"llm queue wait {priority}", time.perf_counter() - queued)
+        with _lock:
+            _admitted[priority] += 1
+        renewal = asyncio.create_task(_renew_lease(ticket))
+        try:
+            yield
+        finally:
+            renewal.cancel()
+    finally:
+        await asyncio.to_thread(store.release, ticket)
+        _wake_next()
+
+def _refresh_state():
+    try:
+        snapshot = store.state()
+    except Exception as e:
+        print(f"Failed to read the LLM governor state: {e!r}", flush=True)
+        snapshot = None
+    with _lock:
+        if snapshot is not None:
+            _state.update(snapshot=snapshot, refreshed=time.time())
+        _state["refreshing"] = False
+
+def stats() -> dict:
+    """Counters of this process and the shared queue state, never reading the store itself.
+
+    The queue state is re-read in a background thread once it is older than
+    STATE_MAX_AGE, so /metrics handlers can call this on the event loop.
+    """
+    if not ENABLED:
+        return {"enabled": False}
+    with _lock:
+        admitted, snapshot, refreshed = dict(_admitted), _state["snapshot"], _state["refreshed"]
+        if not _state["refreshing"] and (refreshed is None or time.time() - refreshed > STATE_MAX_AGE):
+            _state["refreshing"] = True
+            threading.Thread(target=_refresh_state, daemon=True).start()
+    return {
+        "enabled": True,
+        "max_concurrency": MAX_CONCURRENCY,
+        "requests_per_minute": REQUESTS_PER_MINUTE,
+        "admitted_here": admitted,
+        **snapshot,
+        "state_age_s": round(time.time() - refreshed, 1) if refreshed is not None else None
+    }
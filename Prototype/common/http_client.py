@@ -0,0 +1,208 @@
+import os, time, asyncio, threading, weakref
+from urllib.parse import urlsplit
+
+import httpx, requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError
+from urllib3.util.retry import Retry
+
+from common import metrics, resilience
+
+# === Configuration ===
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05"))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", "0.2"))
+
+DEFAULT_TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+RETRY_STATUSES = (502, 503, 504)
+
+
+def hop_name(method: str, url: str) -> str:
+    """Metric name for a call, e.g. `GET mma/patient_notes` (ids in the path are dropped)."""
+    parts = urlsplit(url)
+    segment = parts.path.strip("/").split("/")[0]
+    return f"http {method.upper()} {parts.hostname}/{segment}"
+
+
+# === Sync Client ===
+_session = None
+_session_lock = threading.Lock()
+
+def session() -> requests.Session:
+    """Process-wide keep-alive session; failed connects are retried with backoff (see `request` for the rest)."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                # Only connects are retried here, like the async transport; a retry after the request
+                # was sent would resend its X-Deadline-Ms, so `request` retries those itself
+                retry = Retry(
+                    total=RETRIES,
+                    connect=RETRIES,
+                    read=False,
+                    backoff_factor=BACKOFF_FACTOR
+                )
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+                s = requests.Session()
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+                _session = s
+    return _session
+
+def target(url: str) -> str:
+    """Circuit breaker name of the service behind `url`, e.g. `oa:8000`."""
+    return urlsplit(url).netloc
+
+def with_deadline(kwargs: dict, default_timeout):
+    """Caps the call's timeout at the current deadline and forwards what is left of it."""
+    timeout = kwargs.get("timeout", default_timeout)
+    if isinstance(timeout, tuple):
+        kwargs["timeout"] = tuple(resilience.timeout(t) for t in timeout)
+    else:
+        kwargs["timeout"] = resilience.timeout(timeout)
+    # Replaces the header of an earlier attempt with the same kwargs, so every retry sends the time left now
+    headers = {k: v for k, v in (kwargs.get("headers") or {}).items() if k.lower() != resilience.DEADLINE_HEADER.lower()}
+    headers.update(resilience.deadline_headers())
+    if headers or "headers" in kwargs:
+        kwargs["headers"] = headers
+
+def call_failed(breaker):
+    """A call cut short by our own deadline says nothing about the target's health."""
+    left = resilience.remaining()
+    if left is not None and left <= 0:
+        breaker.abandon()
+    else:
+        breaker.failure()
+
+def is_read_error(e: requests.RequestException) -> bool:
+    """The request was sent, but the response did not arrive in full."""
+    if isinstance(e, (requests.ReadTimeout, requests.exceptions.ChunkedEncodingError)):
+        return True
+    return isinstance(e, requests.ConnectionError) and bool(e.args) and isinstance(e.args[0], ProtocolError)
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """A call through the keep-alive session, failing fast while the target's circuit breaker is open.
+
+    Idempotent methods are also retried on 502/503/504 and read errors, each attempt
+    with the deadline recomputed.
+    """
+    breaker = resilience.breaker(target(url))
+    name = hop_name(method, url)
+    attempts = RETRIES + 1 if method.upper() in IDEMPOTENT_METHODS else 1
+    for attempt in range(attempts):
+        with_deadline(kwargs, DEFAULT_TIMEOUT)
+        breaker.before()
+        started = time.perf_counter()
+        try:
+            response = session().request(method, url, **kwargs)
+        except requests.RequestException as e:
+            metrics.increment(f"{name} errors")
+            call_failed(breaker)
+            # Failed connects were already retried by the session
+            if not is_read_error(e) or attempt == attempts - 1:
+                raise
+        except Exception:
+            metrics.increment(f"{name} errors")
+            call_failed(breaker)
+            raise
+        except BaseException:
+            breaker.abandon()
+            raise
+        else:
+            if response.status_code >= 500:
+                breaker.failure()
+            else:
+                breaker.success()
+            if response.status_code not in RETRY_STATUSES or attempt == attempts - 1:
+                return response
+            response.close()
+        finally:
+            metrics.record_latency(name, time.perf_counter() - started)
+        time.sleep(BACKOFF_FACTOR * (2 ** attempt))
+
+def iter_events(response: requests.Response):
+    """Yields `{"id", "event", "data"}` for each server-sent event of a streamed response."""
+    event = {}
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if "data" in event:
+                yield event
+            event = {}
+        elif line.startswith(":"):
+            continue  # keep-alive comment
+        else:
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if field == "data":
+                event["data"] = event["data"] + "\n" + value if "data" in event else value
+            elif field in ("id", "event"):
+                event[field] = value
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+# === Async Client ===
+# httpx clients are bound to the event loop they were first used on, so one is kept per loop
+_async_clients = weakref.WeakKeyDictionary()
+
+def async_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE),
+            transport=httpx.AsyncHTTPTransport(retries=RETRIES)  # retries failed connects only
+        )
+        _async_clients[loop] = client
+    return client
+
+async def aclose():
+    """Closes the current event loop's client; call it before the loop ends (asyncio.run returns or a long-lived loop is stopped)."""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+async def arequest(method: str, url: str, **kwargs) -> httpx.Response:
+    """Like `request`, but non-blocking. Idempotent methods are also retried on 502/503/504 and read errors."""
+    breaker = resilience.breaker(target(url))
+    name = hop_name(method, url)
+    attempts = RETRIES + 1 if method.upper() in IDEMPOTENT_METHODS else 1
+    for attempt in range(attempts):
+        with_deadline(kwargs, READ_TIMEOUT)
+        breaker.before()
+        started = time.perf_counter()
+        try:
+            response = await async_client().request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            metrics.increment(f"{name} errors")
+            call_failed(breaker)
+            # Failed connects were already retried by the transport
+            if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)) or attempt == attempts - 1:
+                raise
+        except BaseException:
+            breaker.abandon()  # cancelled, or not an HTTP failure
+            raise
+        else:
+            if response.status_code >= 500:
+                breaker.failure()
+            else:
+                breaker.success()
+            if response.status_code not in RETRY_STATUSES or attempt == attempts - 1:
+                return response
+        finally:
+            metrics.record_latency(name, time.perf_counter() - started)
+        await asyncio.sleep(BACKOFF_FACTOR * (2 ** attempt))
+
+async def aget(url: str, **kwargs) -> httpx.Response:
+    return await arequest("GET", url, **kwargs)
+
+async def apost(url: str, **kwargs) -> httpx.Response:
+    return await arequest("POST", url, **kwargs)
@@ -0,0 +1,395 @@
+import os, re, json, time, asyncio, sqlite3, hashlib, threading
+from collections import OrderedDict, defaultdict
+from pathlib import Path
+
+from openai import AsyncOpenAI, APITimeoutError
+
+from common import governor, metrics, resilience
+
+# === Configuration ===
+CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+CACHE_PATH = Path(os.getenv("LLM_CACHE_PATH", "memory/llm_cache.db"))
+CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))  # seconds
+CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "20000"))  # on disk; least recently used go first
+MEMORY_CACHE_SIZE = int(os.getenv("LLM_MEMORY_CACHE_SIZE", "512"))
+
+CASSETTE_MODE = os.getenv("LLM_CASSETTE_MODE", "off")  # off, record or replay
+CASSETTE_PATH = Path(os.getenv("LLM_CASSETTE_PATH", "memory/llm_cassette.jsonl"))
+CASSETTE_REPLAY_LATENCY = os.getenv("LLM_CASSETTE_REPLAY_LATENCY", "0") == "1"  # sleep for the recorded latency
+CASSETTE_MISS = os.getenv("LLM_CASSETTE_MISS", "error")  # unrecorded prompts in replay: error, or live to call the API
+
+# The OpenAI client used for every call. Created on first use; services may replace it,
+# e.g. with different retry settings.
+client = None
+
+def openai_client() -> AsyncOpenAI:
+    global client
+    if client is None:
+        client = AsyncOpenAI()
+    return client
+
+
+# === Response Cache ===
+class ResponseCache:
+    """LRU of recent responses in memory, backed by SQLite on disk.
+
+    Entries expire after `ttl` seconds. When the disk holds more than
+    `max_entries`, the least recently used tenth is evicted.
+    """
+
+    def __init__(self, path: Path, ttl: float, max_entries: int, memory_size: int):
+        self.path, self.ttl, self.max_entries, self.memory_size = path, ttl, max_entries, memory_size
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # key -> (created, entry)
+        self.conn = None
+        self.entries = 0
+        self.hits = self.misses = 0
+        self.latency_saved = 0.0
+
+    def _connect(self):
+        if self.conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    entry TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_by_use ON responses (last_used)")
+            self.entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return self.conn
+
+    def _remember(self, key, created, entry):
+        self.memory[key] = (created, entry)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def get(self, key: str):
+        """The cached entry for `key`, or None if it is missing or expired."""
+        now = time.time()
+        with self.lock:
+            if key in self.memory:
+                created, entry = self.memory[key]
+                if now - created <= self.ttl:
+                    self.memory.move_to_end(key)
+                    return entry
+                del self.memory[key]
+
+            conn = self._connect()
+            row = conn.execute("SELECT entry, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.entries -= 1
+                return None
+            conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            entry = json.loads(row[0])
+            self._remember(key, row[1], entry)
+            return entry
+
+    def put(self, key: str, entry: dict):
+        now = time.time()
+        with self.lock:
+            self._remember(key, now, entry)
+            conn = self._connect()
+            inserted = conn.execute(
+                "INSERT OR REPLACE INTO responses (key, entry, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(entry), now, now)
+            ).rowcount
+            self.entries += inserted
+            if self.entries > self.max_entries:
+                conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+                excess = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+                if excess > 0:
+                    conn.execute(
+                        "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                        (excess + self.max_entries // 10,)
+                    )
+                self.entries = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def record(self, hit: bool, latency_saved: float = 0.0):
+        with self.lock:
+            if hit:
+                self.hits += 1
+                self.latency_saved += latency_saved
+            else:
+                self.misses += 1
+        metrics.increment("llm cache hits" if hit else "llm cache misses")
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": CACHE_ENABLED,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+                "latency_saved_s": round(self.latency_saved, 2),
+                "memory_entries": len(self.memory),
+                "disk_entries": self.entries
+            }
+
+
+cache = ResponseCache(CACHE_PATH, CACHE_TTL, CACHE_MAX_ENTRIES, MEMORY_CACHE_SIZE)
+
+def cache_key(model: str, messages: list, temperature=None, tools=None, **kwargs) -> str:
+    request = {"model": model, "messages": messages, "temperature": temperature, "tools": tools, **kwargs}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+def cache_stats() -> dict:
+    return cache.stats()
+
+
+# === Cassette ===
+# Parts of a prompt that change from one run to the next without changing its meaning
+VOLATILE_PATTERNS = [
+    (re.compile(r"\b\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?\b"), "<date>"),
+    (re.compile(r"\b(?:Mon|Tues|Wednes|Thurs|Fri|Satur|Sun)day, [A-Z][a-z]+ \d{1,2}\b"), "<date>"),
+    (re.compile(r"\b\d{1,2}:\d{2}(?: ?[AP]M)?\b"), "<time>"),
+    (re.compile(r"\b[0-9a-f]{32}\b"), "<id>")
+]
+
+def normalize(text: str) -> str:
+    text = " ".join(str(text or "").split())
+    for pattern, placeholder in VOLATILE_PATTERNS:
+        text = pattern.sub(placeholder, text)
+    return text
+
+def prompt_hash(model: str, messages: list, tools: list = None) -> str:
+    """Hash of a request with whitespace, dates, times and hex ids normalized away."""
+    normalized = [[m.get("role"), normalize(m.get("content"))] for m in messages]
+    tool_names = sorted(t["function"]["name"] for t in tools or [])
+    return hashlib.sha256(json.dumps([model, normalized, tool_names]).encode()).hexdigest()[:32]
+
+class CassetteMiss(LookupError):
+    pass
+
+class Cassette:
+    """LLM responses with their latency, recorded as JSON lines of `{"key", "model", "entry"}`.
+
+    The prompt itself is not stored; `key` is its normalized hash. A prompt recorded
+    several times is replayed in recorded order, starting over once all were served.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.recorded = None  # key -> [entry], loaded on first replay
+        self.positions = defaultdict(int)
+
+    def record(self, key: str, model: str, entry: dict):
+        line = json.dumps({"key": key, "model": model, "entry": entry}, separators=(",", ":"))
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+        metrics.increment("llm cassette recorded")
+
+    def _load(self):
+        self.recorded = defaultdict(list)
+        if self.path.exists():
+            with open(self.path) as f:
+                for line in f:
+                    if line.strip():
+                        row = json.loads(line)
+                        self.recorded[row["key"]].append(row["entry"])
+        print(f"Loaded {sum(map(len, self.recorded.values()))} LLM responses from {self.path}", flush=True)
+
+    def next(self, key: str):
+        """The next recorded entry for `key`, or None."""
+        with self.lock:
+            if self.recorded is None:
+                self._load()
+            entries = self.recorded.get(key)
+            if not entries:
+                metrics.increment("llm cassette misses")
+                return None
+            entry = entries[self.positions[key] % len(entries)]
+            self.positions[key] += 1
+        metrics.increment("llm cassette hits")
+        return entry
+
+
+cassette = Cassette(CASSETTE_PATH)
+
+async def record(model: str, messages: list, tools: list, entry: dict):
+    if CASSETTE_MODE == "record":
+        await asyncio.to_thread(cassette.record, prompt_hash(model, messages, tools), model, entry)
+
+async def replay(model: str, messages: list, tools: list = None):
+    """The recorded entry for a request, or None to call the API (LLM_CASSETTE_MISS=live)."""
+    key = prompt_hash(model, messages, tools)
+    entry = await asyncio.to_thread(cassette.next, key)
+    if entry is None and CASSETTE_MISS != "live":
+        raise CassetteMiss(f"No recorded {model} response for prompt {key} in {CASSETTE_PATH}")
+    return entry
+
+
+# === Chat Completions ===
+BREAKER = "llm"  # circuit breaker shared by all calls to the API
+
+def is_outage(error: Exception) -> bool:
+    """Whether an API error says the API is unhealthy, as opposed to a bad request."""
+    status = getattr(error, "status_code", None)
+    return status is None or status >= 500 or status == 429
+
+def api_call_failed(breaker, error: Exception, deadline_bound: bool):
+    if isinstance(error, APITimeoutError) and deadline_bound:
+        breaker.abandon()
+        metrics.increment("deadline exceeded")
+        raise resilience.DeadlineExceeded("Deadline exceeded during the LLM call") from error
+    if is_outage(error):
+        breaker.failure()
+    else:
+        breaker.abandon()
+
+def to_entry(response, latency: float) -> dict:
+    message = response.choices[0].message
+    usage = response.usage
+    return {
+        "content": message.content,
+        "tool_calls": [
+            {"name": call.function.name, "arguments": call.function.arguments}
+            for call in (message.tool_calls or [])
+        ],
+        "usage": {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "total_tokens": usage.total_tokens
+        } if usage else None,
+        "latency": latency
+    }
+
+async def chat(messages: list, model: str, temperature: float = None, tools: list = None,
+               use_cache: bool = None, before_request=None, priority: str = governor.DEFAULT_PRIORITY, **kwargs) -> dict:
+    """One chat completion, answered from the response cache when possible.
+
+    Returns `{"content", "tool_calls": [{"name", "arguments"}], "usage", "latency", "cached"}`.
+    By default only deterministic calls are cached: temperature 0 or tool extraction.
+    `before_request` is awaited right before a call that goes to the API (not on cache
+    hits), e.g. to take rate-limit tokens. Calls to the API wait for a slot from the
+    shared governor in their `priority` class (see common/governor.py), are cut off at
+    the request's deadline and fail fast with CircuitOpen while the API is unhealthy.
+
+    With LLM_CASSETTE_MODE=record every response is also appended to the cassette;
+    with replay, responses come from the cassette and are flagged as cached.
+    """
+    if CASSETTE_MODE == "replay":
+        entry = await replay(model, messages, tools)
+        if entry is not None:
+            if CASSETTE_REPLAY_LATENCY:
+                await asyncio.sleep(entry.get("latency", 0.0))
+            return dict(entry, cached=True)
+
+    if use_cache is None:
+        use_cache = CACHE_ENABLED and (temperature == 0 or tools is not None)
+
+    key = None
+    if use_cache:
+        key = cache_key(model, messages, temperature, tools, **kwargs)
+        entry = await asyncio.to_thread(cache.get, key)
+        if entry is not None:
+            cache.record(hit=True, latency_saved=entry.get("latency", 0.0))
+            await record(model, messages, tools, entry)
+            return dict(entry, cached=True)
+        cache.record(hit=False)
+
+    breaker = resilience.breaker(BREAKER)
+    resilience.timeout()
+    breaker.check()
+    if before_request is not None:
+        await before_request()
+
+    request = {"model": model, "messages": messages, **kwargs}
+    if temperature is not None:
+        request["temperature"] = temperature
+    if tools is not None:
+        request["tools"] = tools
+
+    async with governor.slot(priority):
+        left = resilience.timeout()
+        if left is not None:
+            request["timeout"] = left
+        breaker.before()
+        started = time.perf_counter()
+        try:
+            response = await openai_client().chat.completions.create(**request)
+        except Exception as e:
+            metrics.increment(f"llm {model} errors")
+            api_call_failed(breaker, e, left is not None)
+            raise
+        except BaseException:
+            breaker.abandon()
+            raise
+        breaker.success()
+        latency = time.perf_counter() - started
+    metrics.record_latency(f"llm {model}", latency)
+
+    entry = to_entry(response, latency)
+    if use_cache:
+        await asyncio.to_thread(cache.put, key, entry)
+    await record(model, messages, tools, entry)
+    return dict(entry, cached=False)
+
+async def ask(messages: list, model: str, temperature: float = None, priority: str = governor.DEFAULT_PRIORITY, **kwargs) -> str:
+    """The text of one chat completion."""
+    return (await chat(messages, model, temperature, priority=priority, **kwargs))["content"]
+
+async def stream(messages: list, model: str, temperature: float = None, priority: str = governor.DEFAULT_PRIORITY, **kwargs):
+    """Yields the text of one chat completion as it is generated. Streamed calls bypass the response cache
+    and hold their governor slot until the last chunk."""
+    if CASSETTE_MODE == "replay":
+        entry = await replay(model, messages)
+        if entry is not None:
+            words = entry["content"].split(" ")
+            ttft = entry.get("ttft", 0.0) if CASSETTE_REPLAY_LATENCY else 0.0
+            pace = (entry.get("latency", 0.0) - ttft) / len(words) if CASSETTE_REPLAY_LATENCY else 0.0
+            await asyncio.sleep(ttft)
+            for i, word in enumerate(words):
+                yield word if i == 0 else " " + word
+                await asyncio.sleep(pace)
+            return
+
+    breaker = resilience.breaker(BREAKER)
+    resilience.timeout()
+    breaker.check()
+    request = {"model": model, "messages": messages, "stream": True, **kwargs}
+    if temperature is not None:
+        request["temperature"] = temperature
+
+    async with governor.slot(priority):
+        left = resilience.timeout()
+        if left is not None:
+            request["timeout"] = left
+        breaker.before()
+        started = time.perf_counter()
+        ttft, text = None, ""
+        try:
+            response = await openai_client().chat.completions.create(**request)
+            async for chunk in response:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                if ttft is None:
+                    ttft = time.perf_counter() - started
+                    metrics.record_latency(f"llm {model} time to first token", ttft)
+                text += delta
+                yield delta
+        except Exception as e:
+            metrics.increment(f"llm {model} errors")
+            api_call_failed(breaker, e, left is not None)
+            raise
+        except BaseException:
+            breaker.abandon()  # e.g. the consumer stopped reading
+            raise
+        breaker.success()
+        latency = time.perf_counter() - started
+        metrics.record_latency(f"llm {model}", latency)
+    await record(model, messages, None, {"content": text, "tool_calls": [], "usage": None, "latency": latency, "ttft": ttft or latency})
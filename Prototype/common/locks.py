@@ -0,0 +1,43 @@
+import time, asyncio
+from contextlib import asynccontextmanager
+
+from common import metrics, resilience
+
+
+class KeyedLock:
+    """One asyncio lock per key, e.g. per patient, so work on one key runs one at a time.
+
+    Holders of the same key are served in arrival order; different keys never wait
+    on each other. A key's lock is dropped once nobody holds or waits for it.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.locks = {}  # key -> [lock, holders and waiters]
+
+    @asynccontextmanager
+    async def hold(self, key):
+        """Holds the key's lock for the block; raises DeadlineExceeded if the request's deadline passes while waiting."""
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            lock, queued = entry[0], time.perf_counter()
+            if lock.locked():
+                metrics.increment(f"{self.name} lock contended")
+            try:
+                await asyncio.wait_for(lock.acquire(), resilience.timeout())
+            except asyncio.TimeoutError:
+                metrics.increment("deadline exceeded")
+                raise resilience.DeadlineExceeded(f"Deadline exceeded waiting for {self.name} lock") from None
+            metrics.record_latency(f"{self.name} lock wait", time.perf_counter() - queued)
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+    def stats(self) -> dict:
+        return {"keys": len(self.locks), "waiting": sum(users - 1 for lock, users in self.locks.values() if lock.locked())}
@@ -0,0 +1,207 @@
+import os, copy, json, time, atexit, sqlite3, threading
+from pathlib import Path
+from urllib.parse import quote
+
+from common import metrics
+
+# === Configuration ===
+BACKEND = os.getenv("MEMORY_BACKEND", "json")  # "json" (one file per patient, for development) or "sqlite" (WAL mode)
+FLUSH_INTERVAL = float(os.getenv("MEMORY_FLUSH_INTERVAL", "0"))  # seconds writes are buffered before one batched flush; 0 writes through
+
+
+# === Store ===
+class MemoryStore:
+    """Agent memory records keyed by patient id, e.g. `{"patient_id", "chat_history", ...}`.
+
+    Reading or writing a record only touches that patient's data, so a turn costs
+    the same however many patients are stored. Writes go to a buffer that is
+    flushed in one commit, right away or every MEMORY_FLUSH_INTERVAL seconds;
+    reads see buffered writes. Backends implement `_read` and `_write`.
+    """
+
+    backend = None
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.dirty = {}  # patient_id -> record not flushed yet
+        self.flusher = None
+        atexit.register(self.flush)
+
+    def _read(self, patient_id: str):
+        raise NotImplementedError
+
+    def _write(self, records: dict):
+        """Persists `{patient_id: record}` in one commit."""
+        raise NotImplementedError
+
+    def get(self, patient_id: str):
+        """A copy of the patient's record, or None if there is none."""
+        with self.lock:
+            record = self.dirty.get(patient_id)
+            if record is None:
+                return self._read(patient_id)
+            return copy.deepcopy(record)
+
+    def update(self, patient_id: str, fields: dict):
+        """Sets `fields` on the patient's record, creating the record if needed."""
+        with self.lock:
+            record = self.get(patient_id) or {"patient_id": patient_id}
+            record.update(copy.deepcopy(fields))
+            self._stage(patient_id, record)
+
+    def append(self, patient_id: str, field: str, item):
+        """Appends `item` to the list in the record's `field`, creating both if needed."""
+        with self.lock:
+            record = self.get(patient_id) or {"patient_id": patient_id}
+            record.setdefault(field, []).append(copy.deepcopy(item))
+            self._stage(patient_id, record)
+
+    def _stage(self, patient_id, record):
+        self.dirty[patient_id] = record
+        if FLUSH_INTERVAL <= 0:
+            self.flush()
+        elif self.flusher is None:
+            self.flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+            self.flusher.start()
+
+    def flush(self):
+        """Writes all buffered records in one commit; they stay buffered if it fails."""
+        with self.lock:
+            if not self.dirty:
+                return
+            started = time.perf_counter()
+            self._write(self.dirty)
+            metrics.record_latency("memory flush", time.perf_counter() - started)
+            metrics.increment("memory records flushed", len(self.dirty))
+            self.dirty = {}
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Failed to flush memory to {self.path}: {e!r}", flush=True)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"backend": self.backend, "path": str(self.path), "buffered": len(self.dirty)}
+
+    def migrate_from_json(self, json_path: Path, group: str = None) -> int:
+        """Imports a legacy list-of-records JSON file once, then renames it to `*.migrated`.
+
+        With `group`, every entry is appended to that list field of its patient's
+        record (for files holding several entries per patient). Otherwise patients
+        that already have a record are left untouched. Returns the number of
+        imported entries.
+        """
+        if not json_path.exists():
+            return 0
+        try:
+            with open(json_path) as f:
+                raw = json.load(f)
+        except json.JSONDecodeError:
+            print(f"Warning: {json_path} is not valid JSON. Skipping migration.", flush=True)
+            return 0
+
+        imported = 0
+        with self.lock:
+            for entry in raw:
+                patient_id = entry.get("patient_id")
+                if not patient_id:
+                    continue
+                if group:
+                    record = self.get(patient_id) or {"patient_id": patient_id}
+                    record.setdefault(group, []).append({k: v for k, v in entry.items() if k != "patient_id"})
+                elif self.get(patient_id) is None:
+                    record = entry
+                else:
+                    continue
+                self.dirty[patient_id] = record
+                imported += 1
+            self.flush()
+
+        json_path.rename(json_path.with_name(json_path.name + ".migrated"))
+        print(f"Migrated {imported} record(s) from {json_path} to {self.path}", flush=True)
+        return imported
+
+
+class JsonStore(MemoryStore):
+    """One JSON file per patient in a directory, each replaced atomically."""
+
+    backend = "json"
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+    def _file(self, patient_id):
+        return self.path / f"{quote(patient_id, safe='')}.json"
+
+    def _read(self, patient_id):
+        path = self._file(patient_id)
+        if not path.exists():
+            return None
+        with open(path) as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                print(f"Warning: {path} is not valid JSON. Starting fresh.", flush=True)
+                return None
+
+    def _write(self, records):
+        for patient_id, record in records.items():
+            path = self._file(patient_id)
+            tmp = path.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                json.dump(record, f, indent=2)
+            tmp.replace(path)
+
+
+class SqliteStore(MemoryStore):
+    """Records as JSON rows in SQLite (WAL mode); a flush is one transaction."""
+
+    backend = "sqlite"
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS records (
+                patient_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+
+    def _read(self, patient_id):
+        row = self.conn.execute("SELECT data FROM records WHERE patient_id = ?", (patient_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, records):
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.executemany(
+                "INSERT INTO records (patient_id, data, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT (patient_id) DO UPDATE SET data = excluded.data, updated = excluded.updated",
+                [(patient_id, json.dumps(record), now) for patient_id, record in records.items()]
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+
+BACKENDS = {"json": JsonStore, "sqlite": SqliteStore}
+
+def open_store(path: Path, backend: str = None) -> MemoryStore:
+    """The store named by `path` without suffix: a `path/` directory (json) or `path.db` (sqlite)."""
+    backend = backend or BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown MEMORY_BACKEND: {backend}")
+    return BACKENDS[backend](path.with_suffix(".db") if backend == "sqlite" else path)
@@ -0,0 +1,50 @@
+import threading
+from collections import defaultdict, deque
+
+# Number of most recent samples kept per latency series
+SAMPLE_WINDOW = 2048
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_latencies = defaultdict(lambda: deque(maxlen=SAMPLE_WINDOW))
+
+
+def increment(name: str, value: int = 1):
+    with _lock:
+        _counters[name] += value
+
+def record_latency(name: str, seconds: float):
+    with _lock:
+        _latencies[name].append(seconds)
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(samples) -> dict:
+    samples = list(samples)
+    return {
+        "count": len(samples),
+        "mean_ms": round(1000 * sum(samples) / len(samples), 2) if samples else None,
+        "p50_ms": round(1000 * percentile(samples, 0.50), 2) if samples else None,
+        "p95_ms": round(1000 * percentile(samples, 0.95), 2) if samples else None,
+        "p99_ms": round(1000 * percentile(samples, 0.99), 2) if samples else None,
+    }
+
+def snapshot() -> dict:
+    """Counters and latency percentiles (over the last SAMPLE_WINDOW samples) recorded in this process."""
+    with _lock:
+        counters = dict(_counters)
+        latencies = {name: list(samples) for name, samples in _latencies.items()}
+    return {
+        "counters": counters,
+        "latencies": {name: summarize(samples) for name, samples in latencies.items()}
+    }
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _latencies.clear()
@@ -0,0 +1,64 @@
+import os, time, asyncio
+
+from common import http_client, llm, metrics, resilience
+
+# === Configuration ===
+ENABLED = os.getenv("STREAM_REPLIES", "1") != "0"
+OA_CHUNK_URL = "http://oa:8000/receive_chunk"
+FLUSH_INTERVAL = 0.15  # seconds between partial-reply posts to OA after the first one
+# Sent when the LLM fails, is rate limited past the turn deadline or its breaker is open
+FALLBACK_REPLY = "Thank you for sharing that. Could you tell me a little more about it?"
+
+
+async def post_partial(patient_id, turn_index, text):
+    try:
+        await http_client.apost(OA_CHUNK_URL, json={"patient_id": patient_id, "turn_index": turn_index, "text": text}, timeout=3)
+    except Exception as e:
+        # The complete reply is still delivered through /receive_message
+        print(f"Failed to send partial reply to OA: {e}", flush=True)
+
+async def stream_reply(patient_id: str, turn_index: int, messages: list, model: str, temperature: float = None, started: float = None, fallback: str = FALLBACK_REPLY):
+    """Generates a health coach reply, forwarding the text to OA while it is generated.
+
+    OA receives the reply so far right after the first token and then at most every
+    FLUSH_INTERVAL. Returns `(reply, time_to_first_token)`, measured from `started`
+    (a `time.perf_counter()` value, by default now). With STREAM_REPLIES=0 the reply
+    is generated in one call and the time to first token is the full generation time.
+    If generation fails, `fallback` is returned instead, so callers should pass one that
+    fits the turn. Text streamed before a failure is never returned: it may stop
+    mid-sentence, and OA replaces it with the fallback once the caller sends it.
+    """
+    started = started if started is not None else time.perf_counter()
+    reply, ttft, posts = "", None, []
+    try:
+        if not ENABLED:
+            reply = await llm.ask(messages, model=model, temperature=temperature, priority="interactive")
+            ttft = time.perf_counter() - started
+        else:
+            last_post = 0.0
+            async for delta in llm.stream(messages, model=model, temperature=temperature, priority="interactive"):
+                reply += delta
+                now = time.perf_counter()
+                if ttft is None:
+                    ttft = now - started
+                if now - last_post >= FLUSH_INTERVAL:
+                    # Posted concurrently so generation never waits on OA; OA keeps the longest text
+                    posts.append(asyncio.create_task(post_partial(patient_id, turn_index, reply)))
+                    last_post = now
+    except Exception as e:
+        # The patient gets an answer within the turn deadline, even if only a holding one
+        print(f"Reply for patient {patient_id} (turn {turn_index}) failed, sending fallback: {e!r}", flush=True)
+        metrics.increment("reply fallbacks")
+        if reply.strip():
+            print(f"Discarded {len(reply)} characters of the truncated reply for patient {patient_id}", flush=True)
+            metrics.increment("reply truncated")
+        reply = fallback
+        resilience.clear_deadline()  # delivering the fallback must not fail on the deadline that caused it
+    # Partial posts must land before the caller sends the complete reply
+    await asyncio.gather(*posts)
+    if ttft is None:
+        ttft = time.perf_counter() - started
+
+    metrics.record_latency("reply time to first token", ttft)
+    print(f"Reply for patient {patient_id} (turn {turn_index}): first token after {ttft * 1000:.0f} ms", flush=True)
+    return reply, ttft
@@ -0,0 +1,159 @@
+import os, time, threading, contextvars
+
+from common import metrics
+
+# === Configuration ===
+DEADLINE_HEADER = "X-Deadline-Ms"  # time left for the request when it was sent, in milliseconds
+TURN_BUDGET = float(os.getenv("TURN_BUDGET", "45"))  # seconds a patient turn may take across all hops
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))  # consecutive failures that open a breaker
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "30"))  # seconds an open breaker fails fast before a trial call
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+class CircuitOpen(ConnectionError):
+    pass
+
+
+# === Deadlines ===
+# Absolute time.monotonic() by which the current request must be answered, or None
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+def remaining():
+    """Seconds left until the current deadline, or None without one."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def start_deadline(seconds: float):
+    """Gives the current request at most `seconds`; an earlier deadline from upstream is kept."""
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    _deadline.set(deadline if current is None else min(current, deadline))
+
+def clear_deadline():
+    """Detaches background work started by a request from the request's deadline."""
+    _deadline.set(None)
+
+def timeout(default=None):
+    """`default` capped at the time left; raises DeadlineExceeded once it has run out."""
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        metrics.increment("deadline exceeded")
+        raise DeadlineExceeded("Deadline exceeded before the call was made")
+    return left if default is None else min(default, left)
+
+def deadline_headers() -> dict:
+    left = remaining()
+    return {} if left is None else {DEADLINE_HEADER: str(max(0, int(left * 1000)))}
+
+class DeadlineMiddleware:
+    """Applies the deadline in an incoming DEADLINE_HEADER to the request it belongs to."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        budget = dict(scope["headers"]).get(DEADLINE_HEADER.lower().encode())
+        try:
+            budget = float(budget) / 1000 if budget is not None else None
+        except ValueError:
+            budget = None
+        if budget is not None and budget <= 0:
+            from starlette.responses import JSONResponse  # type: ignore
+            metrics.increment("deadline exceeded")
+            response = JSONResponse({"status": "error", "reason": "Deadline exceeded"}, status_code=504)
+            return await response(scope, receive, send)
+
+        token = _deadline.set(time.monotonic() + budget) if budget is not None else None
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if token is not None:
+                _deadline.reset(token)
+
+
+# === Circuit Breakers ===
+class CircuitBreaker:
+    """Fails calls to one target fast after BREAKER_FAILURES consecutive failures.
+
+    After BREAKER_RESET seconds one trial call is let through: success closes the
+    breaker again, failure keeps it open for another BREAKER_RESET.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+        self.trips = 0
+
+    def check(self):
+        """Raises CircuitOpen while the breaker is open, without taking the trial call; for failing fast early."""
+        with self.lock:
+            rejected = self.state == "open" and time.monotonic() - self.opened_at < BREAKER_RESET
+        if rejected:
+            metrics.increment(f"breaker {self.name} rejected")
+            raise CircuitOpen(f"Circuit breaker for {self.name} is open")
+
+    def before(self):
+        """Raises CircuitOpen if the call must not be made."""
+        with self.lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self.opened_at >= BREAKER_RESET:
+                self.state = "half_open"
+            if self.state == "half_open" and not self.trial_running:
+                self.trial_running = True
+                return
+        metrics.increment(f"breaker {self.name} rejected")
+        raise CircuitOpen(f"Circuit breaker for {self.name} is open")
+
+    def success(self):
+        with self.lock:
+            if self.state != "closed":
+                print(f"Circuit breaker for {self.name} closed", flush=True)
+            self.state, self.failures, self.trial_running = "closed", 0, False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= BREAKER_FAILURES):
+                if self.state == "closed":
+                    self.trips += 1
+                    metrics.increment(f"breaker {self.name} trips")
+                    print(f"Circuit breaker for {self.name} opened after {self.failures} failures", flush=True)
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def abandon(self):
+        """Ends a call that says nothing about the target's health, e.g. one cut off by a deadline."""
+        with self.lock:
+            self.trial_running = False
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {"state": self.state, "consecutive_failures": self.failures, "trips": self.trips}
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def breaker(name: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+def breaker_states() -> dict:
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {b.name: b.to_dict() for b in breakers}